@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for cleaned face annotations, keyed by the SHA-256 of the image
+bytes so the same picture is only ever sent to the detector once, whatever it
+happens to be called on disk.
+
+Entries are small JSON files. When the cache grows past max_bytes the least
+recently used entries are removed; reading an entry counts as a use. The
+bookkeeping is DiskIndex, which render_cache and image_store use as well.
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+SCHEMA_VERSION = 1
+
+# returned by AnnotationCache.get() on a miss, since None is a valid cached value (no faces)
+MISS = object()
+
+
+def content_key(content):
+    """
+    :param content: raw bytes of an image file
+    :return: hex SHA-256 digest used as the cache key
+    """
+    return hashlib.sha256(content).hexdigest()
+
+
+# most files whose digest file_key() remembers
+FILE_KEYS_MAX = 1024
+
+_file_keys = collections.OrderedDict()
+_file_keys_lock = threading.Lock()
+
+
+def file_key(path):
+    """
+    content_key() of a file, remembered while the file's size and modification time stay the
+    same so the memes served over and over are not hashed on every request.
+    :param path: path of an image file
+    :return: hex SHA-256 digest of the file's bytes
+    """
+    stat = os.stat(path)
+    stamp = (path, stat.st_mtime_ns, stat.st_size)
+    with _file_keys_lock:
+        key = _file_keys.get(stamp)
+        if key is not None:
+            _file_keys.move_to_end(stamp)
+            return key
+    with open(path, 'rb') as image_file:
+        key = content_key(image_file.read())
+    with _file_keys_lock:
+        _file_keys[stamp] = key
+        while len(_file_keys) > FILE_KEYS_MAX:
+            _file_keys.popitem(last=False)
+    return key
+
+
+class DiskIndex:
+    """
+    Size and last use of every entry file in a cache directory, for removing the least recently
+    used entries once they pass a total size. It does no locking of its own, the cache using it
+    holds its lock around every call.
+    """
+
+    def __init__(self, directory, suffix, max_bytes, on_drop=None):
+        """
+        :param directory: folder the entries are kept in, created if missing
+        :param suffix: file extension of the entries, e.g. '.json'
+        :param max_bytes: total size of the entries to keep before evicting
+        :param on_drop: called with the key of every entry drop() removes
+        """
+        self.directory = directory
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.on_drop = on_drop
+        # key -> [size, last use], rebuilt from the files on startup
+        self._entries = {}
+        self.total = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if not name.endswith(suffix):
+                continue
+            stat = os.stat(os.path.join(directory, name))
+            self._entries[name[:-len(suffix)]] = [stat.st_size, stat.st_mtime]
+            self.total += stat.st_size
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def add(self, key, size):
+        """
+        Record a new or rewritten entry, without evicting.
+        """
+        if key in self._entries:
+            self.total -= self._entries[key][0]
+        self._entries[key] = [size, time.time()]
+        self.total += size
+
+    def touch(self, key):
+        """
+        Mark an entry as used now, in the index and on its file's modification time.
+        """
+        now = time.time()
+        self._entries[key][1] = now
+        try:
+            os.utime(self.path(key), (now, now))
+        except OSError:
+            pass
+
+    def evict(self, keep=None):
+        """
+        Drop the least recently used entries until the total is within max_bytes.
+        :param keep: key of an entry that is never dropped, e.g. the one just added
+        """
+        if self.total <= self.max_bytes:
+            return
+        for key in sorted(self._entries, key=lambda k: self._entries[k][1]):
+            if self.total <= self.max_bytes:
+                break
+            if key != keep:
+                self.drop(key)
+
+    def drop(self, key):
+        """
+        Remove an entry and its file.
+        """
+        size, _ = self._entries.pop(key)
+        self.total -= size
+        if self.on_drop is not None:
+            self.on_drop(key)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class AnnotationCache:
+    def __init__(self, directory='.cache/annotations', max_bytes=64 * 1024 * 1024):
+        """
+        :param directory: folder the entries are kept in, created if missing
+        :param max_bytes: total size of the entries to keep before evicting
+        """
+        self.directory = os.path.join(directory, 'v%d' % SCHEMA_VERSION)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = DiskIndex(self.directory, '.json', max_bytes)
+
+    def get(self, key):
+        """
+        Look up the cleaned faces for an image.
+        :param key: see content_key()
+        :return: the value stored by put(), or MISS
+        """
+        with self._lock:
+            if key not in self._index:
+                return MISS
+            try:
+                with open(self._index.path(key), 'r') as entry_file:
+                    entry = json.load(entry_file)
+            except (OSError, ValueError):
+                self._index.drop(key)
+                return MISS
+            if entry.get('schema') != SCHEMA_VERSION:
+                self._index.drop(key)
+                return MISS
+            self._index.touch(key)
+            return entry['value']
+
+    def put(self, key, value):
+        """
+        Store the cleaned faces for an image and evict old entries if needed.
+        :param key: see content_key()
+        :param value: output of VisionDetector.clean_face_features() (must be JSON serializable)
+        """
+        data = json.dumps({'schema': SCHEMA_VERSION, 'value': value}).encode('utf-8')
+        with self._lock:
+            path = self._index.path(key)
+            tmp = '%s.%d.tmp' % (path, threading.get_ident())
+            with open(tmp, 'wb') as entry_file:
+                entry_file.write(data)
+            os.replace(tmp, path)
+            self._index.add(key, len(data))
+            self._index.evict()
+
+    def __len__(self):
+        return len(self._index)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Run a face detector backend from an asyncio event loop with many requests in
+flight at once.
+
+A synchronous detector waits out a whole round trip per image. AsyncDetector
+keeps up to `concurrency` detections running on a thread pool (the Vision
+client this repo uses has no asyncio interface), starts no more than `rate`
+of them per second with a token bucket sized to the API quota, and retries
+requests that failed for a retryable reason (throttling, unavailability,
+timeouts) with exponential backoff and full jitter. A server's Retry-After
+holds back the whole bucket, not just the request it was sent for. Cache hits
+go through neither the pool nor the bucket.
+
+Example Usage:
+    async def study(paths):
+        async with AsyncDetector(detectors.get_detector('cloud'), concurrency=32, rate=30) as detector:
+            return await detector.find_faces_batch(paths)
+    studied = asyncio.run(study(paths))
+"""
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import annotation_cache
+import metrics
+
+# detections in flight at once
+CONCURRENCY = 32
+# detections started per second; the Vision API's default quota is 1,800 requests a minute
+RATE = 30.0
+# attempts after the first one for a request that keeps failing for a retryable reason
+RETRIES = 5
+# first backoff in seconds, doubled on every further retry up to MAX_BACKOFF
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+# HTTP statuses, and google.rpc.Code values, worth trying again
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+RETRYABLE_GRPC = {4: 'DEADLINE_EXCEEDED', 8: 'RESOURCE_EXHAUSTED', 14: 'UNAVAILABLE'}
+
+
+def is_retryable(error):
+    """
+    :param error: an exception raised by a detector
+    :return: True if the same request may well succeed later: a retryable HTTP status
+             (google.api_core exceptions keep it in .code) or gRPC code (.grpc_status_code,
+             see vision_detector.VisionError), or a timeout or dropped connection
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, 'code', None)
+    if isinstance(status, int) and status in RETRYABLE_STATUS:
+        return True
+    code = getattr(error, 'grpc_status_code', None)
+    # grpc.StatusCode members are (int, name) pairs
+    code = getattr(code, 'value', (code,))[0]
+    return code in RETRYABLE_GRPC
+
+
+def retry_after(error):
+    """
+    :param error: an exception raised by a detector
+    :return: the seconds the server asked to wait before trying again, or None
+    """
+    value = getattr(error, 'retry_after', None)
+    if value is None:
+        response = getattr(error, 'response', None)
+        value = getattr(response, 'headers', {}).get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):  # an HTTP date rather than seconds
+        return None
+
+
+def backoff_delay(attempt, base=BACKOFF, cap=MAX_BACKOFF, hint=None):
+    """
+    :param attempt: number of retries made so far
+    :param base: first backoff in seconds
+    :param cap: longest backoff in seconds
+    :param hint: seconds the server asked to wait, see retry_after()
+    :return: seconds to wait before the next attempt, drawn uniformly from
+             [0, min(cap, base * 2 ** attempt)] and never less than hint
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    return max(delay, hint) if hint is not None else delay
+
+
+class TokenBucket:
+    """
+    Lets `rate` acquisitions through per second on average, and up to `burst` at once
+    after a quiet spell. Only for use from one event loop.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        """
+        :param rate: tokens added per second
+        :param burst: most tokens held, defaults to one second's worth (at least 1)
+        :param clock: monotonic clock in seconds
+        """
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """
+        Wait until a token is available and take it.
+        """
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """
+        Hold every acquisition back for that long, e.g. when the server says the quota is used up.
+        Pauses overlap rather than add up.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class AsyncDetector:
+    def __init__(self, detector, concurrency=CONCURRENCY, rate=RATE, burst=None,
+                 retries=RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        """
+        :param detector: the detectors.FaceDetector backend that does the work
+        :param concurrency: most detections in flight at once
+        :param rate: most detections started per second, None for no limit
+        :param burst: detections that may start at once after a quiet spell, see TokenBucket
+        :param retries: attempts after the first one for a retryable failure
+        :param backoff: first backoff in seconds, doubled on every retry
+        :param max_backoff: longest backoff in seconds
+        """
+        self.detector = detector
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='detect')
+        # made on first use, so it belongs to the loop the detector is used from
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Shut the thread pool down once the detections running on it are finished.
+        """
+        self._pool.shutdown(wait=True)
+
+    async def find_faces(self, image):
+        """
+        :param image: string of directory/file_name
+        :return: list of face_record.Face, or None if there are no usable faces
+        """
+        return await self.find_faces_bytes(self.detector._read_bytes(image))
+
+    async def find_faces_bytes(self, content):
+        """
+        Find the faces in an image that is already in memory, see FaceDetector.find_faces_bytes().
+        :param content: bytes of an encoded image
+        :return: list of face_record.Face, or None if there are no usable faces
+        """
+        key, cleaned = self.detector.cached(content)
+        if cleaned is not annotation_cache.MISS:
+            return cleaned
+        return await self._call(self.detector.detect_bytes, content, key)
+
+    async def find_faces_batch(self, img_paths):
+        """
+        Detect every image concurrently.
+        :param img_paths: list of strings of directory/file_name
+        :return: list of (path, list of face_record.Face or None, error string or None),
+                 in the same order as img_paths
+        """
+        async def find(path):
+            try:
+                return path, await self.find_faces(path), None
+            except Exception as e:  # one bad image should not fail the batch
+                return path, None, str(e)
+
+        return list(await asyncio.gather(*(find(path) for path in img_paths)))
+
+    async def _call(self, fn, *args):
+        """
+        Run fn on the thread pool once a slot and a token are free, retrying retryable failures.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            async with self._semaphore:
+                if self.bucket is not None:
+                    await self.bucket.acquire()
+                try:
+                    return await loop.run_in_executor(self._pool, fn, *args)
+                except Exception as e:
+                    if attempt >= self.retries or not is_retryable(e):
+                        raise
+                    error = e
+            # back off without holding a slot, so other requests can go ahead
+            metrics.count('detect_retries', backend=self.detector.name)
+            hint = retry_after(error)
+            if hint is not None and self.bucket is not None:
+                # the server wants everyone to wait, not only this request
+                self.bucket.pause(hint)
+            await asyncio.sleep(backoff_delay(attempt, self.backoff, self.max_backoff, hint))
+            attempt += 1
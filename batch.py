@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""
+Command line batch driver: put every face from a list of source images on
+every image of a target directory or manifest.
+
+Every (target, source) pair is one swap, rendered on a pool of processes (see
+pipeline.render_meme()). The faces of all images are detected first, many at
+a time, through async_detector.AsyncDetector and the annotation cache. Each
+finished pair is appended to a journal file as soon as its output is written,
+so a run that crashes or is stopped can be started again with the same
+arguments and only does the pairs that are not done yet; failed pairs are
+tried again. Progress, throughput and the time left are logged every few
+seconds while the swaps run.
+
+A manifest is a text file with one target path per line (blank lines and
+lines starting with # are skipped), relative to the manifest's folder, or a
+.json file holding a list of such paths. Long source lists can be read from
+a file with one path per line by passing it as @file.
+
+Example Usage:
+    python batch.py --targets images/ --sources photos/aaron.jpg photos/multiple.jpg --out louvre/
+    python batch.py --targets memes.txt --sources @faces.txt --out louvre/ --workers 8 --detector local
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import async_detector
+import faceSwap2
+import metrics
+import pipeline
+
+logger = logging.getLogger(__name__)
+
+# files in a target directory that are swapped onto
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+# journal statuses of a pair that does not need to be swapped again
+FINISHED = ('done', 'no_face')
+# seconds between progress reports
+PROGRESS_INTERVAL = 5.0
+# swaps handed to the pool ahead of the ones running, per worker
+QUEUED_PER_WORKER = 4
+
+
+class Journal:
+    """
+    Append-only record of the (target, source) pairs a batch has finished, one JSON object per
+    line, written through to disk after every pair.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the journal file, created if missing; the pairs already in it are loaded
+        """
+        self.path = path
+        # (target, source) -> the last entry for that pair
+        self.entries = {}
+        torn = False
+        if os.path.exists(path):
+            with open(path, 'r') as journal_file:
+                for line in journal_file:
+                    torn = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # the last line of a run that was killed mid-write
+                        continue
+                    self.entries[(entry['target'], entry['source'])] = entry
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a')
+        if torn:
+            self._file.write('\n')
+
+    def finished(self, target, source):
+        """
+        :return: True if the pair was swapped, and its output is still there, or has nothing to swap
+        """
+        entry = self.entries.get((target, source))
+        if entry is None or entry['status'] not in FINISHED:
+            return False
+        return entry['status'] != 'done' or os.path.exists(entry['output'])
+
+    def record(self, target, source, status, output=None, error=None):
+        """
+        :param target: path of the target image
+        :param source: path of the source image
+        :param status: 'done', 'no_face' or 'failed'
+        :param output: where the result was written
+        :param error: why the pair failed
+        """
+        entry = {'target': target, 'source': source, 'status': status, 'output': output,
+                 'error': error, 'time': time.time()}
+        self.entries[(target, source)] = entry
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Progress:
+    """
+    Counts finished swaps and logs progress, throughput and the time left every interval seconds.
+    """
+
+    def __init__(self, total, interval=PROGRESS_INTERVAL, clock=time.monotonic):
+        """
+        :param total: swaps to do in this run
+        :param interval: seconds between reports
+        """
+        self.total = total
+        self.interval = interval
+        self.clock = clock
+        self.done = 0
+        self.failed = 0
+        self.start = self.last_report = clock()
+
+    def add(self, failed=False):
+        self.done += 1
+        self.failed += failed
+        now = self.clock()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def rate(self):
+        """
+        :return: swaps finished per second so far
+        """
+        elapsed = self.clock() - self.start
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        rate = self.rate()
+        left = (self.total - self.done) / rate if rate else float('inf')
+        logger.info("%d/%d swaps (%.0f%%), %d failed, %.2f swaps/s, %s left",
+                    self.done, self.total, 100.0 * self.done / max(self.total, 1), self.failed, rate,
+                    _duration(left))
+
+
+def _duration(seconds):
+    if seconds == float('inf'):
+        return "unknown"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%dh%02dm%02ds" % (hours, minutes, seconds) if hours else "%dm%02ds" % (minutes, seconds)
+
+
+def _init_worker():
+    # Ctrl-C reaches the whole process group; only the parent stops, and it shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pipeline._init_render_worker()
+
+
+def load_targets(spec):
+    """
+    :param spec: a directory of images or a manifest file, see the module docstring
+    :return: list of target image paths
+    """
+    if os.path.isdir(spec):
+        return [os.path.normpath(os.path.join(spec, name)) for name in sorted(os.listdir(spec))
+                if name.lower().endswith(IMAGE_EXTENSIONS)]
+    root = os.path.dirname(spec)
+    with open(spec, 'r') as manifest:
+        if spec.lower().endswith('.json'):
+            paths = json.load(manifest)
+        else:
+            paths = [line.strip() for line in manifest]
+    return [os.path.normpath(os.path.join(root, path)) for path in paths if path and not path.startswith('#')]
+
+
+def output_path(out_dir, target, source, ext='.jpg'):
+    """
+    :return: where the swap of source onto target is written, named after both and unique to the pair
+    """
+    digest = hashlib.sha1(('%s\0%s' % (target, source)).encode('utf-8')).hexdigest()[:8]
+    name = '%s_%s_%s%s' % (os.path.splitext(os.path.basename(target))[0],
+                           os.path.splitext(os.path.basename(source))[0], digest, ext)
+    return os.path.join(out_dir, name)
+
+
+def detect(detector, paths, concurrency=async_detector.CONCURRENCY, rate=None):
+    """
+    Find the faces in many images at once.
+    :param detector: a detectors.FaceDetector
+    :param paths: image paths
+    :param concurrency: most detections in flight at once
+    :param rate: most detections started per second, None for no limit
+    :return: (faces, errors): dict of path -> list of face_record.Face, or None for images without
+             faces, and dict of path -> error string for the images that could not be studied
+    """
+    async def study():
+        async with async_detector.AsyncDetector(detector, concurrency, rate) as fast:
+            return await fast.find_faces_batch(paths)
+
+    faces = {}
+    errors = {}
+    with metrics.span('study_memes', mode='batch'):
+        studied = asyncio.run(study()) if paths else []
+    for path, found, error in studied:
+        if error is not None:
+            logger.warning("Could not study %s: %s", path, error)
+            errors[path] = error
+        else:
+            faces[path] = found or None
+    return faces, errors
+
+
+def run_batch(detector, targets, sources, out_dir, journal, workers=None, concurrency=async_detector.CONCURRENCY,
+              rate=None, ext='.jpg', progress_interval=PROGRESS_INTERVAL, **options):
+    """
+    Swap every source onto every target, skipping the pairs the journal has finished.
+    :param detector: a detectors.FaceDetector
+    :param targets: paths of the images whose faces are covered
+    :param sources: paths of the images whose faces cover them
+    :param out_dir: folder the results are written to
+    :param journal: the run's Journal
+    :param workers: number of render processes, defaults to the number of CPUs
+    :param concurrency: most face detections in flight at once
+    :param rate: most face detections started per second, None for no limit
+    :param ext: image format of the results, as a file extension
+    :param progress_interval: seconds between progress reports
+    :param options: swap settings passed on to pipeline.render_meme(), e.g. precision, warp or blend
+    :return: (pairs done, pairs failed) in this run
+    """
+    pairs = [(target, source) for target in targets for source in sources]
+    pending = [pair for pair in pairs if not journal.finished(*pair)]
+    logger.info("%d pairs, %d finished by earlier runs, %d to do", len(pairs), len(pairs) - len(pending),
+                len(pending))
+    if not pending:
+        return 0, 0
+
+    start = time.monotonic()
+    faces, errors = detect(detector, sorted(set(path for pair in pending for path in pair)), concurrency, rate)
+    logger.info("studied %d images in %.1fs, %d failed", len(faces) + len(errors), time.monotonic() - start,
+                len(errors))
+
+    jobs = []
+    failed = 0
+    for target, source in pending:
+        error = errors.get(target) or errors.get(source)
+        if error is not None:
+            # tried again next run
+            journal.record(target, source, 'failed', error=error)
+            failed += 1
+        elif faces[target] is None or faces[source] is None:
+            # nothing to swap, and the detector will not find a face there next time either
+            journal.record(target, source, 'no_face')
+        else:
+            jobs.append((target, source))
+    os.makedirs(out_dir, exist_ok=True)
+
+    progress = Progress(len(jobs), progress_interval)
+    queued = max(workers or os.cpu_count() or 1, 1) * QUEUED_PER_WORKER
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    running = {}
+    try:
+        jobs = iter(jobs)
+        while True:
+            # keep the pool busy without pickling every job up front
+            while len(running) < queued:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                target, source = job
+                location = output_path(out_dir, target, source, ext)
+                future = pool.submit(pipeline.render_meme, target, source, faces[target], faces[source],
+                                     location, **options)
+                running[future] = (target, source, location)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                target, source, location = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:  # one failed swap should not lose the rest
+                    metrics.count('render_failures')
+                    logger.warning("failed to swap %s onto %s: %s", source, target, e)
+                    journal.record(target, source, 'failed', error="%s: %s" % (type(e).__name__, e))
+                    progress.add(failed=True)
+                else:
+                    journal.record(target, source, 'done', output=location)
+                    progress.add()
+    finally:
+        # on an interrupt, drop the queued swaps; the journal already has every finished one
+        pool.shutdown(wait=True, cancel_futures=True)
+    progress.report()
+    return progress.done - progress.failed, progress.failed + failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1].strip(), fromfile_prefix_chars='@')
+    parser.add_argument('--targets', required=True, help="directory of images or manifest file to swap onto")
+    parser.add_argument('--sources', nargs='+', required=True, help="images whose faces are swapped in")
+    parser.add_argument('--out', required=True, help="folder the results are written to")
+    parser.add_argument('--journal', help="checkpoint file of finished pairs, defaults to OUT/journal.jsonl")
+    parser.add_argument('--workers', type=int, default=None, help="render processes, defaults to the CPU count")
+    parser.add_argument('--detector', default='cloud', help="face detector backend, see detectors.get_detector()")
+    parser.add_argument('--cache-dir', default='.cache/annotations', help="face annotation cache, '' for none")
+    parser.add_argument('--concurrency', type=int, default=async_detector.CONCURRENCY,
+                        help="face detections in flight at once")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="face detections started per second, defaults to %g for the cloud backend "
+                             "and no limit otherwise" % async_detector.RATE)
+    parser.add_argument('--precision', choices=faceSwap2.PRECISIONS, default=pipeline.SWAP_PRECISION)
+    parser.add_argument('--region', choices=pipeline.SWAP_REGIONS, default=pipeline.SWAP_REGION)
+    parser.add_argument('--warp', choices=faceSwap2.WARPS, default=pipeline.SWAP_WARP)
+    parser.add_argument('--blend', choices=faceSwap2.BLENDS, default=pipeline.SWAP_BLEND)
+    parser.add_argument('--ext', default='.jpg', help="image format of the results")
+    parser.add_argument('--progress', type=float, default=PROGRESS_INTERVAL, help="seconds between reports")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    targets = load_targets(args.targets)
+    sources = [os.path.normpath(path) for path in args.sources]
+    rate = args.rate if args.rate is not None else (async_detector.RATE if args.detector == 'cloud' else None)
+    swapper = pipeline.Pipeline(detector=args.detector, cache_dir=args.cache_dir or None, render_cache_dir=None)
+    with Journal(args.journal or os.path.join(args.out, 'journal.jsonl')) as journal:
+        try:
+            done, failed = run_batch(swapper.detector, targets, sources, args.out, journal, args.workers,
+                                     args.concurrency, rate, args.ext, args.progress, precision=args.precision,
+                                     region=args.region, warp=args.warp, blend=args.blend)
+        except KeyboardInterrupt:
+            logger.warning("interrupted, run the same command again to go on from %s", journal.path)
+            return 130
+    logger.info("%d swaps written to %s, %d failed", done, args.out, failed)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
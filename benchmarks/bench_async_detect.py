@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of async_detector.AsyncDetector against an in-process fake server.
+
+The fake server answers each detection after a configurable latency, rejects
+a fraction of requests at random with a throttling error, and rejects every
+request beyond its own per-second quota the way the Vision API does once the
+quota is used up. The images are first studied one at a time, as
+FaceDetector.find_faces_batch() does, and then through AsyncDetector at each
+of the requested concurrencies. For each run the script reports images per
+second, the most requests the server saw in flight at once, how many were
+throttled and retried, and how many images failed. It exits with status 1 if
+a run lets more requests in flight than its concurrency, starts them faster
+than its rate, or loses an image to throttling.
+
+Example Usage:
+    python benchmarks/bench_async_detect.py --latency 0.2 --concurrency 8 32 64
+    python benchmarks/bench_async_detect.py --throttle 0.2 --quota 40 --rate 30
+"""
+import argparse
+import asyncio
+import glob
+import os
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import async_detector
+import detectors
+import metrics
+
+
+class Throttled(Exception):
+    # shaped like google.api_core.exceptions.TooManyRequests
+    code = 429
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class FakeServer:
+    def __init__(self, latency, jitter=0.0, throttle=0.0, quota=None, seed=0):
+        """
+        :param latency: seconds each request takes
+        :param jitter: up to this many seconds are added to the latency at random
+        :param throttle: fraction of requests rejected with Throttled at random
+        :param quota: requests accepted per second, further ones are rejected; None for no quota
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.quota = quota
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.starts = []  # time of every request
+        self.accepted = []  # time of every request that was not throttled
+        self.throttled = 0
+
+    def request(self):
+        with self.lock:
+            now = time.monotonic()
+            self.starts.append(now)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if self.quota is not None and sum(1 for t in self.accepted if t > now - 1.0) >= self.quota:
+                rejected = Throttled("quota exceeded", retry_after=1.0)
+            elif self.random.random() < self.throttle:
+                rejected = Throttled("try again later")
+            else:
+                rejected = None
+            if rejected is not None:
+                self.throttled += 1
+            else:
+                self.accepted.append(now)
+        try:
+            time.sleep(delay)
+            if rejected is not None:
+                raise rejected
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def max_rate(self, window=1.0):
+        """
+        :return: the most requests started in any window of that many seconds
+        """
+        starts = sorted(self.starts)
+        most = 0
+        first = 0
+        for last, start in enumerate(starts):
+            while starts[first] <= start - window:
+                first += 1
+            most = max(most, last - first + 1)
+        return most
+
+
+class FakeServerDetector(detectors.FixtureDetector):
+    """
+    Synthesized faces, each after a round trip to the fake server.
+    """
+    name = 'fake'
+
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+
+    def detect(self, content):
+        self.server.request()
+        return super().detect(content)
+
+
+def make_server(args):
+    return FakeServer(args.latency, args.jitter, args.throttle, args.quota)
+
+
+def run_sync(args, paths):
+    server = make_server(args)
+    detector = FakeServerDetector(server)
+    start = time.perf_counter()
+    results = []
+    for path in paths:
+        try:
+            results.append((path, detector.find_faces(path), None))
+        except Exception as e:
+            results.append((path, None, str(e)))
+    return server, results, time.perf_counter() - start
+
+
+def run_async(args, paths, concurrency):
+    server = make_server(args)
+    detector = FakeServerDetector(server)
+
+    async def study():
+        async with async_detector.AsyncDetector(detector, concurrency=concurrency, rate=args.rate,
+                                                backoff=args.backoff) as fast:
+            return await fast.find_faces_batch(paths)
+
+    start = time.perf_counter()
+    results = asyncio.run(study())
+    return server, results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--images', nargs='+', default=['images/*.jpg', 'photos/*.jpg'])
+    parser.add_argument('--count', type=int, default=120, help="images studied per run, reusing files as needed")
+    parser.add_argument('--latency', type=float, default=0.1, help="seconds per request")
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--throttle', type=float, default=0.1, help="fraction of requests throttled at random")
+    parser.add_argument('--quota', type=float, default=None, help="requests the server accepts per second")
+    parser.add_argument('--rate', type=float, default=async_detector.RATE, help="AsyncDetector rate limit")
+    parser.add_argument('--backoff', type=float, default=0.05, help="AsyncDetector first backoff in seconds")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[4, 16, 32])
+    parser.add_argument('--skip-sync', action='store_true', help="only run AsyncDetector")
+    args = parser.parse_args()
+
+    files = sorted(p for pattern in args.images for p in glob.glob(pattern))
+    paths = [files[i % len(files)] for i in range(args.count)]
+    sink = metrics.add_sink(metrics.MemorySink())
+
+    print("%d images, %.0f ms latency, %.0f%% throttled, quota %s, rate %s" %
+          (len(paths), args.latency * 1000, args.throttle * 100, args.quota, args.rate))
+    print("%-12s %10s %10s %10s %10s %8s %8s" %
+          ('run', 'images/s', 'in flight', 'max rate', 'throttled', 'retries', 'failed'))
+    runs = [] if args.skip_sync else [('sync', None)]
+    runs += [('async-%d' % c, c) for c in args.concurrency]
+    failed = False
+    for name, concurrency in runs:
+        sink.clear()
+        if concurrency is None:
+            server, results, elapsed = run_sync(args, paths)
+        else:
+            server, results, elapsed = run_async(args, paths, concurrency)
+        errors = sum(1 for _, _, error in results if error is not None)
+        max_rate = server.max_rate()
+        print("%-12s %10.1f %10d %10d %10d %8d %8d" %
+              (name, len(paths) / elapsed, server.max_in_flight, max_rate, server.throttled,
+               sink.total('detect_retries'), errors))
+        if concurrency is None:
+            continue
+        burst = max(args.rate, 1) if args.rate else 0
+        if server.max_in_flight > concurrency:
+            print("  more requests in flight than the concurrency of %d" % concurrency)
+            failed = True
+        if args.rate and max_rate > args.rate + burst:
+            print("  started %d requests in a second with a rate of %g" % (max_rate, args.rate))
+            failed = True
+        if errors:
+            print("  %d images failed" % errors)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Accuracy and cost of detecting faces at reduced resolution.
+
+Each image is run through a detector backend at full resolution and again
+with max_side set to each of the requested sizes (see
+detectors.downscale()). Faces found at a reduced size are matched to the
+full resolution faces by their box centres, and the distance between the
+rescaled landmarks and the full resolution ones is reported in pixels and as
+a fraction of the face width, along with the bytes sent to the detector and
+its latency. With --max-error the script fails when any size is less accurate
+than that, so it can be used as an accuracy check.
+
+Example Usage:
+    python benchmarks/bench_detect_scale.py --detector local --sides 1600 1024 640
+    python benchmarks/bench_detect_scale.py --detector cloud --sides 1024 --max-error 0.02
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+import numpy as np
+
+import detectors
+import roi
+
+
+def centre(face):
+    x0, y0, x1, y1 = roi.face_box(face)
+    return (x0 + x1) / 2.0, (y0 + y1) / 2.0, max(x1 - x0, 1)
+
+
+def landmark_errors(reference, faces):
+    """
+    :return: (list of (pixel error, error / face width) of every landmark of every matched face,
+              number of reference faces with no match)
+    """
+    errors = []
+    missed = 0
+    faces = list(faces or [])
+    for ref in reference or []:
+        rx, ry, width = centre(ref)
+        if not faces:
+            missed += 1
+            continue
+        # the closest face, as long as its centre lies inside the reference face
+        best = min(faces, key=lambda f: np.hypot(centre(f)[0] - rx, centre(f)[1] - ry))
+        bx, by, _ = centre(best)
+        if np.hypot(bx - rx, by - ry) > width / 2.0:
+            missed += 1
+            continue
+        faces.remove(best)
+        found = ref.valid_mask() & best.valid_mask()
+        for error in np.hypot(*(best.landmarks[found] - ref.landmarks[found]).T):
+            errors.append((error, error / width))
+    return errors, missed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--detector', default='local', help="backend, see detectors.get_detector()")
+    parser.add_argument('--images', nargs='+', default=['images/*.jpg', 'photos/*.jpg'])
+    parser.add_argument('--sides', type=int, nargs='+', default=[1600, 1024, 768, 512])
+    parser.add_argument('--max-error', type=float, default=None,
+                        help="largest allowed p90 landmark error as a fraction of the face width")
+    args = parser.parse_args()
+
+    paths = sorted(p for pattern in args.images for p in glob.glob(pattern))
+    contents = {}
+    for path in paths:
+        with open(path, 'rb') as image_file:
+            contents[path] = image_file.read()
+
+    full = detectors.get_detector(args.detector)
+    reference = {}
+    start = time.perf_counter()
+    for path in paths:
+        reference[path] = full.detect(contents[path])
+    full_ms = (time.perf_counter() - start) * 1000.0 / len(paths)
+    full_bytes = sum(len(c) for c in contents.values())
+    print("%d images, %d faces at full resolution, %.1f MB, %.1f ms per image" %
+          (len(paths), sum(len(f or []) for f in reference.values()), full_bytes / 1e6, full_ms))
+    print("%6s %9s %10s %10s %10s %10s %7s" %
+          ('side', 'bytes', 'ms/image', 'mean px', 'p90 px', 'p90 width', 'missed'))
+
+    failed = False
+    for side in args.sides:
+        detector = detectors.get_detector(args.detector, max_side=side)
+        errors = []
+        missed = 0
+        sent = 0
+        elapsed = 0.0
+        for path in paths:
+            start = time.perf_counter()
+            small, scale = detectors.downscale(contents[path], side)
+            faces = detectors.rescale_faces(detector.detect(small), scale)
+            elapsed += time.perf_counter() - start
+            sent += len(small)
+            face_errors, face_missed = landmark_errors(reference[path], faces)
+            errors.extend(face_errors)
+            missed += face_missed
+
+        pixels = sorted(e[0] for e in errors) or [0.0]
+        relative = sorted(e[1] for e in errors) or [0.0]
+        p90 = relative[int(0.9 * (len(relative) - 1))]
+        print("%6d %8.0f%% %10.1f %10.2f %10.2f %10.4f %7d" %
+              (side, 100.0 * sent / full_bytes, elapsed * 1000.0 / len(paths), np.mean(pixels),
+               pixels[int(0.9 * (len(pixels) - 1))], p90, missed))
+        if args.max_error is not None and p90 > args.max_error:
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the meme download stage.
+
+Serves the checked-in images/ folder from a local HTTP server that sleeps
+before every response, then downloads all of it once with the old one at a
+time meme.download_img() and once with the concurrent meme.download_imgs().
+
+Example Usage:
+    python benchmarks/bench_download.py --latency 0.1 --workers 8
+"""
+import argparse
+import filecmp
+import functools
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+import meme
+
+
+class SlowHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # so connections can be kept alive
+    latency = 0.0
+
+    def send_head(self):
+        time.sleep(self.latency)
+        return super().send_head()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory, latency):
+    handler = functools.partial(type('Handler', (SlowHandler,), {'latency': latency}),
+                                directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--latency', type=float, default=0.1, help="seconds added to every response")
+    parser.add_argument('--workers', type=int, default=meme.DOWNLOAD_WORKERS)
+    parser.add_argument('--limit', type=int, default=None, help="only download the first N images")
+    args = parser.parse_args()
+
+    images = os.path.join(ROOT, 'images')
+    names = sorted(os.listdir(images))[:args.limit]
+    server = serve(images, args.latency)
+    base = "http://127.0.0.1:%d/" % server.server_address[1]
+    urls = [base + name for name in names]
+
+    out = tempfile.mkdtemp()
+    try:
+        sequential_dir = os.path.join(out, 'sequential')
+        start = time.time()
+        for url in urls:
+            meme.download_img(url, os.path.join(sequential_dir, os.path.basename(url)))
+        sequential = time.time() - start
+
+        concurrent_dir = os.path.join(out, 'concurrent')
+        start = time.time()
+        paths = meme.download_imgs(urls, folder=concurrent_dir, workers=args.workers)
+        concurrent = time.time() - start
+
+        mismatch = filecmp.cmpfiles(sequential_dir, concurrent_dir, names, shallow=False)[1:]
+        print("%d images, %.0f ms latency" % (len(urls), args.latency * 1000))
+        print("sequential  %7.2f s" % sequential)
+        print("concurrent  %7.2f s (%d workers, %d jpg paths)" %
+              (concurrent, args.workers, sum(p is not None for p in paths)))
+        print("speedup     %7.1fx" % (sequential / concurrent))
+        if any(mismatch):
+            print("MISMATCHED FILES: %s" % (mismatch,))
+    finally:
+        server.shutdown()
+        shutil.rmtree(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for parallel swap rendering.
+
+Swaps a user photo onto every meme in images/ with Pipeline.render_memes at
+increasing worker counts and reports throughput and scaling. Faces come from
+the fixture detector, so no Vision API access is needed.
+
+Example Usage:
+    python benchmarks/bench_render.py --workers 1 2 4 8 --limit 32
+"""
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+import pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--limit', type=int, default=32, help="number of memes to render")
+    parser.add_argument('--source', default='photos/aaron.jpg')
+    args = parser.parse_args()
+
+    pipe = pipeline.Pipeline(detector='fixture', cache_dir=None)
+    memes = sorted(glob.glob('images/*.jpg'))[:args.limit]
+    source_faces = pipe.study_memes([args.source])[0]
+    meme_faces = pipe.study_memes(memes, with_paths=True)
+
+    out = tempfile.mkdtemp()
+    try:
+        jobs = [(m, args.source, faces, source_faces, os.path.join(out, "art#%d.jpg" % i))
+                for i, (m, faces) in enumerate(meme_faces)]
+        base = None
+        for workers in args.workers:
+            start = time.time()
+            results = pipe.render_memes(jobs, workers=workers)
+            elapsed = time.time() - start
+            failed = sum(error is not None for _, error in results)
+            base = base or elapsed
+            print("%2d workers  %7.2f s  %6.1f memes/s  scaling %.2fx  (%d failed)" %
+                  (workers, elapsed, len(jobs) / elapsed, base / elapsed, failed))
+    finally:
+        shutil.rmtree(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Regression benchmark for the crop and paste-back steps of Pipeline.create_meme.
+
+Times the per-pixel list comprehension crop and double loop paste that
+create_meme used to run against the slice views in roi.py, on a meme sized
+image with a single face box.
+
+Example Usage:
+    python benchmarks/bench_roi.py --width 2000 --height 1500 --face 400
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import roi
+
+
+def legacy_crop_paste(image, box, patch):
+    x0, y0, x1, y1 = box
+    width, height = x1 - x0, y1 - y0
+    sub_image = np.array([np.array([image[i + y0][j + x0] for j in range(width)]) for i in range(height)])
+    for i in range(height):
+        for j in range(width):
+            image[i + y0][j + x0] = patch[i][j]
+    return sub_image
+
+
+def roi_crop_paste(image, box, patch):
+    sub_image = roi.crop(image, box)
+    roi.paste(image, box, patch)
+    return sub_image
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--width', type=int, default=2000)
+    parser.add_argument('--height', type=int, default=1500)
+    parser.add_argument('--face', type=int, default=400, help="side of the square face box in pixels")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 256, (args.height, args.width, 3)).astype(np.uint8)
+    x0, y0 = args.width // 3, args.height // 3
+    box = roi.clamp_box((x0, y0, x0 + args.face, y0 + args.face), image.shape)
+    patch = rng.uniform(0, 255, (box[3] - box[1], box[2] - box[0], 3))
+
+    results = {}
+    for name, fn in (('legacy', legacy_crop_paste), ('roi', roi_crop_paste)):
+        runs = timeit.repeat(lambda: fn(image, box, patch), number=1, repeat=args.repeat)
+        results[name] = min(runs)
+        print("%-6s %10.3f ms/face" % (name, results[name] * 1000))
+    print("speedup %.0fx" % (results['legacy'] / results['roi']))
+
+
+if __name__ == "__main__":
+    main()
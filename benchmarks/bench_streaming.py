@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the streaming pipeline against the phased one.
+
+Fetch and detect are stubbed: each sleeps for a fixed latency and then hands
+back a checked-in image from images/ and its fixture faces. Render and write
+are the real pipeline.swap_meme and cv2.imwrite. The same stage functions
+and worker counts are run in phases (every meme through one stage before the
+next starts) and as a stream, and the time to the first written file and the
+overall throughput are reported.
+
+Example Usage:
+    python benchmarks/bench_streaming.py --memes 32 --fetch-latency 0.2 --detect-latency 0.3
+"""
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+import cv2
+import detectors
+import pipeline
+import streaming
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--memes', type=int, default=32)
+    parser.add_argument('--fetch-latency', type=float, default=0.2)
+    parser.add_argument('--detect-latency', type=float, default=0.3)
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--detect-workers', type=int, default=4)
+    parser.add_argument('--render-workers', type=int, default=2)
+    parser.add_argument('--queue-size', type=int, default=4)
+    parser.add_argument('--source', default='photos/aaron.jpg')
+    args = parser.parse_args()
+
+    detector = detectors.FixtureDetector()
+    user_faces = detector.find_faces(args.source)
+    paths = sorted(glob.glob('images/*.jpg'))
+    submissions = [SimpleNamespace(url=paths[i % len(paths)]) for i in range(args.memes)]
+    out = tempfile.mkdtemp()
+
+    def fetch(submission):
+        time.sleep(args.fetch_latency)
+        return submission.url
+
+    def detect(path):
+        time.sleep(args.detect_latency)
+        return path, detector.find_faces(path)
+
+    def render(item):
+        path, faces = item
+        return pipeline.swap_meme(path, args.source, faces, user_faces)
+
+    written = []
+
+    def write(image):
+        location = os.path.join(out, "art#%d.jpg" % len(written))
+        cv2.imwrite(location, image)
+        written.append(time.time())
+        return location
+
+    stages = [streaming.Stage('fetch', fetch, args.fetch_workers),
+              streaming.Stage('detect', detect, args.detect_workers),
+              streaming.Stage('render', render, args.render_workers),
+              streaming.Stage('write', write, 1)]
+
+    def report(name, start):
+        total = time.time() - start
+        print("%-9s first output %6.2f s  total %6.2f s  %5.1f memes/s" %
+              (name, written[0] - start, total, len(written) / total))
+
+    try:
+        # phased: every meme through a stage before the next stage starts
+        start = time.time()
+        items = submissions
+        for stage in stages:
+            with ThreadPoolExecutor(max_workers=stage.workers) as pool:
+                items = list(pool.map(stage.fn, items))
+        report('phased', start)
+
+        del written[:]
+        start = time.time()
+        for _ in streaming.run_stream(submissions, stages, args.queue_size):
+            pass
+        report('streaming', start)
+    finally:
+        shutil.rmtree(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the swap hot path.
+
+Runs every stage of a swap (decoding the meme with cv2.imread and through
+image_store.ImageStore, get_face_mask, transformation_from_points,
+warp_im, correct_colours, swap_faces on the face box, the whole frame and
+swap_window(), with the affine and the piecewise warp and with every blend
+of faceSwap2.BLENDS, a group photo through swap_meme and
+Pipeline.create_meme) against checked-in memes from images/ and a face
+from photos/, rescaled to several sizes. Landmarks come from the fixture
+detector, so no Vision API is needed. For each stage and size it reports
+latency percentiles, the peak and count of Python-tracked allocations
+(NumPy and OpenCV arrays included) and the process's peak RSS, and it can
+write everything to JSON and compare against an earlier run.
+
+Each blend mode has a latency budget, see BUDGETS_MS: the median a swap
+with that blend may take at each size, so pipeline.SWAP_BLEND can be
+picked by what a request can afford. --budgets fails the run if a blend
+goes over its budget.
+
+Example Usage:
+    python benchmarks/bench_swap.py --sizes 512 1024 2048 --repeat 20 --json bench.json
+    python benchmarks/bench_swap.py --json new.json --compare bench.json
+    python benchmarks/bench_swap.py --sizes 3840 --face-frac 0.05 --stages swap_faces_frame swap_faces_window
+    python benchmarks/bench_swap.py --stages swap_faces_window swap_faces_pyramid swap_faces_seamless --budgets
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+import cv2
+import numpy
+
+import detectors
+import faceSwap2
+import image_store
+import pipeline
+import roi
+
+# stage name -> setup(case) returning the callable that is timed
+STAGES = {}
+# faces in the swap_meme_group stage
+GROUP_SIZE = 4
+# latency budget of each blend mode: the p50 ms that swap_faces_window with that blend may take at
+# each size with the default --face-frac, on one core. Roughly 'alpha' 1x, 'pyramid' 1.3x and
+# 'seamless' 2.5x; faces that have to come back fast should not use 'seamless'.
+BUDGETS_MS = {
+    'swap_faces_window': {512: 10, 1024: 40, 2048: 200},  # 'alpha'
+    'swap_faces_pyramid': {512: 15, 1024: 50, 2048: 250},
+    'swap_faces_seamless': {512: 30, 1024: 100, 2048: 500},
+}
+
+
+def stage(name):
+    def register(setup):
+        STAGES[name] = setup
+        return setup
+    return register
+
+
+class Case:
+    """
+    One target meme and one source face at a given size, cropped to their face boxes the way
+    Pipeline.create_meme does, with everything the stages need precomputed.
+    """
+
+    def __init__(self, target, source, size, workdir, face_frac=0.4):
+        detector = detectors.FixtureDetector(face_frac=face_frac)
+        self.size = size
+        self.target_path = self._rescaled(target, size, workdir)
+        self.source_path = self._rescaled(source, size, workdir)
+        self.target = cv2.imread(self.target_path)
+        self.source = cv2.imread(self.source_path)
+        self.target_faces = detector.find_faces(self.target_path)
+        self.source_faces = detector.find_faces(self.source_path)
+
+        box1 = roi.clamp_box(roi.face_box(self.target_faces[0]), self.target.shape)
+        box2 = roi.clamp_box(roi.face_box(self.source_faces[0]), self.source.shape)
+        self.im1 = roi.crop(self.target, box1).copy()
+        self.im2 = roi.crop(self.source, box2).copy()
+        self.features1 = roi.shift_features(self.target_faces[0], box1)
+        self.features2 = roi.shift_features(self.source_faces[0], box2)
+        self.landmarks1 = numpy.matrix(self.features1.bound())
+        self.landmarks2 = numpy.matrix(self.features2.bound())
+        self.left_eye1, self.right_eye1 = faceSwap2.eye_points(self.features1)
+        self.m = faceSwap2.transformation_from_points(self.landmarks1, self.landmarks2)
+        self.warped2 = faceSwap2.warp_im(self.im2, self.m, self.im1.shape)
+
+    @staticmethod
+    def _rescaled(path, size, workdir):
+        """
+        Write a copy of an image whose longest side is size pixels.
+        """
+        im = cv2.imread(path)
+        scale = size / float(max(im.shape[:2]))
+        im = cv2.resize(im, (int(im.shape[1] * scale), int(im.shape[0] * scale)),
+                        interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+        out = os.path.join(workdir, "%d_%s.png" % (size, os.path.splitext(os.path.basename(path))[0]))
+        cv2.imwrite(out, im)
+        return out
+
+
+@stage('imread')
+def _imread(case):
+    return lambda: cv2.imread(case.target_path, cv2.IMREAD_COLOR)
+
+
+@stage('imread_store')
+def _imread_store(case):
+    # decoded once into a store in the work directory, then mapped
+    store = image_store.ImageStore(os.path.join(os.path.dirname(case.target_path), 'pixels'))
+    return lambda: store.imread(case.target_path, cv2.IMREAD_COLOR)
+
+
+@stage('get_face_mask')
+def _get_face_mask(case):
+    return lambda: faceSwap2.get_face_mask(case.im2, case.landmarks2)
+
+
+@stage('get_face_mask_f32')
+def _get_face_mask_f32(case):
+    return lambda: faceSwap2.get_face_mask_f32(case.im2, case.landmarks2)
+
+
+@stage('transformation_from_points')
+def _transformation_from_points(case):
+    return lambda: faceSwap2.transformation_from_points(case.landmarks1, case.landmarks2)
+
+
+@stage('warp_im')
+def _warp_im(case):
+    return lambda: faceSwap2.warp_im(case.im2, case.m, case.im1.shape)
+
+
+@stage('correct_colours')
+def _correct_colours(case):
+    return lambda: faceSwap2.correct_colours(case.im1, case.warped2, case.left_eye1, case.right_eye1)
+
+
+@stage('swap_faces')
+def _swap_faces(case):
+    return lambda: faceSwap2.swap_faces(case.im1, case.im2, case.features1, case.features2)
+
+
+@stage('swap_faces_f32')
+def _swap_faces_f32(case):
+    workspace = faceSwap2.Workspace()
+    prepared = faceSwap2.PreparedFace(case.im2, case.features2, 'float32')
+    return lambda: faceSwap2.swap_faces(case.im1, case.im2, case.features1, case.features2,
+                                        prepared, precision='float32', workspace=workspace)
+
+
+@stage('swap_faces_frame')
+def _swap_faces_frame(case):
+    # the face swapped across the whole meme rather than its face box
+    workspace = faceSwap2.Workspace()
+    return lambda: faceSwap2.swap_faces(case.target, case.im2, case.target_faces[0], case.features2,
+                                        precision='float32', workspace=workspace)
+
+
+@stage('swap_faces_window')
+def _swap_faces_window(case):
+    workspace = faceSwap2.Workspace()
+    return lambda: faceSwap2.swap_faces(case.target, case.im2, case.target_faces[0], case.features2,
+                                        precision='float32', workspace=workspace, window=True)
+
+
+@stage('swap_faces_piecewise')
+def _swap_faces_piecewise(case):
+    # swap_faces_window with the piecewise warp, see bench_warp.py for its quality
+    workspace = faceSwap2.Workspace()
+    prepared = faceSwap2.PreparedFace(case.im2, case.features2, 'float32')
+    return lambda: faceSwap2.swap_faces(case.target, case.im2, case.target_faces[0], case.features2, prepared,
+                                        precision='float32', workspace=workspace, window=True, warp='piecewise')
+
+
+@stage('swap_faces_pyramid')
+def _swap_faces_pyramid(case):
+    # swap_faces_window with Laplacian pyramid blending
+    workspace = faceSwap2.Workspace()
+    prepared = faceSwap2.PreparedFace(case.im2, case.features2, 'float32')
+    return lambda: faceSwap2.swap_faces(case.target, case.im2, case.target_faces[0], case.features2, prepared,
+                                        precision='float32', workspace=workspace, window=True, blend='pyramid')
+
+
+@stage('swap_faces_seamless')
+def _swap_faces_seamless(case):
+    # swap_faces_window with Poisson blending
+    workspace = faceSwap2.Workspace()
+    prepared = faceSwap2.PreparedFace(case.im2, case.features2, 'float32')
+    return lambda: faceSwap2.swap_faces(case.target, case.im2, case.target_faces[0], case.features2, prepared,
+                                        precision='float32', workspace=workspace, window=True, blend='seamless')
+
+
+@stage('swap_meme_group')
+def _swap_meme_group(case):
+    # a group photo: the target tiled GROUP_SIZE times side by side, one face in each tile
+    width = case.target.shape[1]
+    group = numpy.hstack([case.target] * GROUP_SIZE)
+    faces = [roi.shift_features(case.target_faces[0], (-width * i, 0)) for i in range(GROUP_SIZE)]
+    sources = case.source_faces * GROUP_SIZE
+    return lambda: pipeline.swap_meme(group, case.source_path, faces, sources)
+
+
+@stage('create_meme')
+def _create_meme(case):
+    swapper = pipeline.Pipeline(detector='fixture', cache_dir=None, render_cache_dir=None)
+    out = os.path.join(os.path.dirname(case.target_path), "out_%d.jpg" % case.size)
+    return lambda: swapper.create_meme(case.target_path, case.source_path,
+                                       case.target_faces, case.source_faces, out)
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def measure(fn, repeat, warmup):
+    """
+    :return: dict of latency percentiles in ms, allocation peak in KB and allocation count
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000.0)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    fn()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times.sort()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    return {'p50_ms': percentile(times, 0.5),
+            'p90_ms': percentile(times, 0.9),
+            'p99_ms': percentile(times, 0.99),
+            'mean_ms': sum(times) / len(times),
+            'peak_alloc_kb': peak / 1024.0,
+            'alloc_blocks': blocks,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def compare(results, baseline_path, threshold):
+    """
+    Print every stage whose median latency or allocation peak grew by more than threshold.
+    :return: number of regressions
+    """
+    with open(baseline_path, 'r') as baseline_file:
+        baseline = {(r['stage'], r['size']): r for r in json.load(baseline_file)['results']}
+    regressions = 0
+    for result in results:
+        old = baseline.get((result['stage'], result['size']))
+        if old is None:
+            continue
+        for metric in ('p50_ms', 'peak_alloc_kb'):
+            if old[metric] > 0 and result[metric] > old[metric] * (1 + threshold):
+                regressions += 1
+                print("REGRESSION %-28s %5d %-13s %10.2f -> %10.2f" %
+                      (result['stage'], result['size'], metric, old[metric], result[metric]))
+    return regressions
+
+
+def over_budget(results):
+    """
+    Print every stage whose median latency is over its budget, see BUDGETS_MS.
+    :return: number of stages over budget
+    """
+    over = 0
+    for result in results:
+        budget = BUDGETS_MS.get(result['stage'], {}).get(result['size'])
+        if budget is not None and result['p50_ms'] > budget:
+            over += 1
+            print("OVER BUDGET %-27s %5d %10.2f ms > %d ms" %
+                  (result['stage'], result['size'], result['p50_ms'], budget))
+    return over
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--target', default='images/15tdqe3f48t11.jpg')
+    parser.add_argument('--source', default='photos/aaron.jpg')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048],
+                        help="longest image side in pixels")
+    parser.add_argument('--stages', nargs='+', default=None, help="default: all of %s" % ', '.join(STAGES))
+    parser.add_argument('--face-frac', type=float, default=0.4,
+                        help="size of the fixture faces as a fraction of the image, e.g. 0.05 for a 4K meme")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="JSON from an earlier run to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.2, help="relative growth counted as a regression")
+    parser.add_argument('--budgets', action='store_true',
+                        help="run on one core and fail if a blend is over its latency budget")
+    args = parser.parse_args()
+    if args.budgets:
+        cv2.setNumThreads(1)
+
+    workdir = tempfile.mkdtemp()
+    results = []
+    try:
+        print("%-28s %5s %9s %9s %9s %11s %8s %8s" %
+              ('stage', 'size', 'p50 ms', 'p90 ms', 'p99 ms', 'peak KB', 'blocks', 'RSS MB'))
+        for size in args.sizes:
+            case = Case(args.target, args.source, size, workdir, args.face_frac)
+            for name in args.stages or list(STAGES):
+                result = dict(stage=name, size=size, **measure(STAGES[name](case), args.repeat, args.warmup))
+                results.append(result)
+                print("%-28s %5d %9.2f %9.2f %9.2f %11.0f %8d %8.0f" %
+                      (name, size, result['p50_ms'], result['p90_ms'], result['p99_ms'],
+                       result['peak_alloc_kb'], result['alloc_blocks'], result['peak_rss_mb']))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'meta': {'time': time.time(), 'python': platform.python_version(),
+                                'numpy': numpy.__version__, 'opencv': cv2.__version__,
+                                'machine': platform.machine(), 'args': vars(args)},
+                       'results': results}, out, indent=2)
+    failed = args.compare and compare(results, args.compare, args.threshold)
+    if args.budgets and over_budget(results):
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Quality and speed of the affine and piecewise warps of faceSwap2.WARPS.
+
+Each case swaps a face onto a deformed copy of its own image, so the ideal
+result is known: the copy itself. The copy is the source photo moved by a
+random similarity transform (which the affine warp can follow) and by
+smooth random bumps centred on some of the landmarks (which it cannot). The
+landmarks of the copy are moved with the same deformation, as a detector
+would report them. For each warp the script reports the PSNR of the swap
+against the copy inside the face box, the mean distance between where the
+target's landmarks land in the source and where they should, and the
+milliseconds per face of faceSwap2.swap_faces() with a PreparedFace reused
+across calls, the way pipeline.swap_meme() runs it. It exits with status 1
+if the piecewise warp is on average worse than the affine one.
+
+Example Usage:
+    python benchmarks/bench_warp.py --cases 10 --deform 0.06
+    python benchmarks/bench_warp.py --size 1024 --repeat 20 --json warp.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+import cv2
+import numpy
+
+import detectors
+import faceSwap2
+import piecewise
+from face_record import Face, corners
+
+
+def bump_field(centres, amplitudes, sigma):
+    """
+    Smooth displacement field: a Gaussian bump around every centre.
+    :param centres: (k, 2) array of bump centres
+    :param amplitudes: (k, 2) array of the displacement at the middle of each bump
+    :param sigma: width of the bumps in pixels
+    :return: function of an (n, 2) array of points returning their (n, 2) displacements
+    """
+    def field(points):
+        weights = numpy.exp(-((points[:, numpy.newaxis] - centres) ** 2).sum(axis=2) / (2 * sigma ** 2))
+        return weights.dot(amplitudes)
+    return field
+
+
+def deformed_case(image, face, deform, rng):
+    """
+    :param image: the source image
+    :param face: its face_record.Face
+    :param deform: largest displacement of a bump, as a fraction of the face size
+    :param rng: numpy.random.RandomState
+    :return: (target image, target Face)
+    """
+    x0, y0, x1, y1 = face.box()
+    size = max(x1 - x0, y1 - y0)
+    valid = face.valid_mask()
+    landmarks = face.landmarks[valid].astype(numpy.float64)
+    # bumps on the landmarks, gentle enough for the field to stay invertible
+    centres = landmarks[rng.choice(len(landmarks), 6, replace=False)]
+    sigma = size / 5.0
+    field = bump_field(centres, rng.uniform(-deform, deform, centres.shape) * size, sigma)
+
+    # a similarity transform without rotation, so the face box stays a box
+    scale = rng.uniform(0.85, 1.15)
+    shift = rng.uniform(-0.05, 0.05, 2) * size
+    height, width = image.shape[:2]
+    centre = numpy.array([width / 2.0, height / 2.0])
+
+    def forward(points):
+        points = points + field(points)
+        return (points - centre) * scale + centre + shift
+
+    # every target pixel's source position: undo the similarity transform, then solve
+    # q + field(q) = y for q by fixed point iteration, only where the bumps reach
+    map_x, map_y = numpy.meshgrid(numpy.arange(width, dtype=numpy.float64), numpy.arange(height, dtype=numpy.float64))
+    ys = (numpy.stack([map_x.ravel(), map_y.ravel()], axis=1) - centre - shift) / scale + centre
+    reach = 4 * sigma
+    near = ((ys[:, 0] > x0 - reach) & (ys[:, 0] < x1 + reach) & (ys[:, 1] > y0 - reach) & (ys[:, 1] < y1 + reach))
+    qs = ys.copy()
+    for _ in range(10):
+        qs[near] = ys[near] - field(qs[near])
+    target = cv2.remap(image, qs[:, 0].reshape(height, width).astype(numpy.float32),
+                       qs[:, 1].reshape(height, width).astype(numpy.float32), cv2.INTER_LINEAR,
+                       borderMode=cv2.BORDER_REFLECT)
+
+    # the landmarks move with the image; the box is the one around the moved corners
+    moved = face.landmarks.copy()
+    moved[valid] = numpy.rint(forward(landmarks)).astype(numpy.int32)
+    bx0, by0 = numpy.rint(forward(face.bound().astype(numpy.float64))).min(axis=0)
+    bx1, by1 = numpy.rint(forward(face.bound().astype(numpy.float64))).max(axis=0)
+    return target, Face(moved, face.valid, corners(int(bx0), int(by0), int(bx1), int(by1)), None)
+
+
+def psnr(a, b):
+    mse = ((a.astype(numpy.float64) - b.astype(numpy.float64)) ** 2).mean()
+    return float('inf') if mse == 0 else 10 * numpy.log10(255.0 ** 2 / mse)
+
+
+def landmark_error(target, face1, face2, m, warp, prepared):
+    """
+    :return: mean distance in source pixels between where face1's landmarks land and face2's
+    """
+    valid = face1.valid_mask() & face2.valid_mask()
+    if warp == 'piecewise':
+        triangulation = prepared.triangulation(face1)
+        (bx0, by0, _, _), map_x, map_y = piecewise.warp_maps(triangulation, triangulation.target_points(face1, m),
+                                                             m, target.shape)
+        x, y = face1.landmarks[valid].T
+        landed = numpy.stack([map_x[y - by0, x - bx0], map_y[y - by0, x - bx0]], axis=1)
+    else:
+        points = numpy.hstack([face1.landmarks[valid], numpy.ones((valid.sum(), 1))])
+        landed = numpy.asarray(points.dot(numpy.asarray(m)[:2].T))
+    return float(numpy.linalg.norm(landed - face2.landmarks[valid], axis=1).mean())
+
+
+def measure(fn, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000.0)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--source', default='photos/aaron.jpg')
+    parser.add_argument('--size', type=int, default=640, help="longest image side in pixels")
+    parser.add_argument('--cases', type=int, default=5, help="random deformations to try")
+    parser.add_argument('--deform', type=float, default=0.05,
+                        help="largest displacement of a bump as a fraction of the face size")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="write the results to this file")
+    args = parser.parse_args()
+
+    image = cv2.imread(args.source)
+    scale = args.size / float(max(image.shape[:2]))
+    image = cv2.resize(image, (int(image.shape[1] * scale), int(image.shape[0] * scale)),
+                       interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+    height, width = image.shape[:2]
+    side = int(min(height, width) * 0.4)
+    face = detectors.canonical_face((width - side) // 2, (height - side) // 2,
+                                    (width + side) // 2, (height + side) // 2)
+    rng = numpy.random.RandomState(args.seed)
+
+    results = []
+    print("%-6s %-10s %9s %11s %9s" % ('case', 'warp', 'PSNR dB', 'landmark px', 'ms/face'))
+    for case in range(args.cases):
+        target, target_face = deformed_case(image, face, args.deform, rng)
+        x0, y0, x1, y1 = target_face.box()
+        for warp in faceSwap2.WARPS:
+            prepared = faceSwap2.PreparedFace(image, face, 'float32')
+            workspace = faceSwap2.Workspace()
+
+            def swap():
+                return faceSwap2.swap_faces(target, image, target_face, face, prepared, precision='float32',
+                                            workspace=workspace, window=True, warp=warp)
+
+            swapped = swap()
+            m = faceSwap2.transformation_from_points(numpy.matrix(target_face.bound()), numpy.matrix(face.bound()))
+            result = {'case': case, 'warp': warp,
+                      'psnr_db': psnr(swapped[y0:y1, x0:x1], target[y0:y1, x0:x1]),
+                      'landmark_px': landmark_error(target, target_face, face, m, warp, prepared),
+                      'ms_per_face': measure(swap, args.repeat, args.warmup)}
+            results.append(result)
+            print("%-6d %-10s %9.2f %11.2f %9.2f" %
+                  (case, warp, result['psnr_db'], result['landmark_px'], result['ms_per_face']))
+
+    means = {}
+    for warp in faceSwap2.WARPS:
+        runs = [r for r in results if r['warp'] == warp]
+        means[warp] = {key: sum(r[key] for r in runs) / len(runs) for key in ('psnr_db', 'landmark_px', 'ms_per_face')}
+        print("%-6s %-10s %9.2f %11.2f %9.2f" % ('mean', warp, means[warp]['psnr_db'],
+                                                 means[warp]['landmark_px'], means[warp]['ms_per_face']))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'args': vars(args), 'results': results, 'means': means}, out, indent=2)
+    if means['piecewise']['psnr_db'] < means['affine']['psnr_db']:
+        print("the piecewise warp is worse than the affine one")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Blend a swapped face layer into its image with a Laplacian pyramid or with
+Poisson image editing, as alternatives to faceSwap2's feathered alpha mix.
+
+The feathered mix blends every frequency over the same few pixels, so a face
+whose colour correction is a little off shows a soft but visible rim.
+pyramid_blend() blends each band of a Laplacian pyramid with the matching
+level of a Gaussian pyramid of the alpha: fine detail switches over within a
+pixel or two while the overall colour fades in over the width of the
+coarsest level. Only the difference between the layer and the image is
+decomposed, which gives the same result as blending the two pyramids (the
+decomposition is linear and the collapse of an image's pyramid is the image)
+but needs no pyramid of the image at all. Wherever the alpha pyramid is 0
+the image is left exactly as it was, so the work stays inside the face's box
+grown by PYRAMID_MARGIN, and overlapping faces are merged first and share
+one pyramid (see compositor.Compositor).
+
+seamless_blend() hands the face to cv2.seamlessClone(), which solves a
+Poisson equation so the gradients inside the mask are the face's and the
+colours along its edge are the image's. It gives the smoothest seams and
+costs the most.
+
+Example Usage:
+    out = image.copy()
+    blend_into(image, box, layer, alpha, 'pyramid', out)
+"""
+import cv2
+import numpy as np
+
+import roi
+
+# Laplacian pyramid levels below the full resolution one, fewer for images too small for them
+PYRAMID_LEVELS = 4
+# pixels past the alpha's support that a PYRAMID_LEVELS pyramid blend can change
+PYRAMID_MARGIN = 2 ** (PYRAMID_LEVELS + 1)
+# alpha above which a pixel is inside the mask seamless_blend() clones
+SEAMLESS_THRESHOLD = 0.5
+
+
+def margin(mode):
+    """
+    :param mode: a faceSwap2.BLENDS mode
+    :return: pixels past the box of a face that blend_into() can write to
+    """
+    # the pyramid's box is also moved onto the grid of its coarsest level
+    return PYRAMID_MARGIN + 2 ** PYRAMID_LEVELS - 1 if mode == 'pyramid' else 0
+
+
+def pyramid_levels(shape, levels=PYRAMID_LEVELS):
+    """
+    :param shape: shape of the region being blended
+    :param levels: most levels wanted
+    :return: number of levels the region is big enough for
+    """
+    side = min(shape[:2])
+    while levels > 0 and side >> levels < 1:
+        levels -= 1
+    return levels
+
+
+def pyramid_blend(base, layer, alpha, out, levels=PYRAMID_LEVELS):
+    """
+    Laplacian pyramid blend of layer over base.
+    :param base: uint8 image
+    :param layer: float image the size of base, overwritten
+    :param alpha: (height, width) blend weights in [0, 1], of layer's dtype
+    :param out: array shaped like base to write the result into, saturated to [0, 255]
+    :param levels: most pyramid levels, see pyramid_levels()
+    :return: out
+    """
+    # only the difference is decomposed, and it is 0 wherever the layer is not used
+    diff = layer
+    diff -= base
+    diff[alpha <= 0] = 0
+    levels = pyramid_levels(diff.shape, levels)
+    gaussians = [diff]
+    masks = [alpha]
+    for _ in range(levels):
+        gaussians.append(cv2.pyrDown(gaussians[-1]))
+        masks.append(cv2.pyrDown(masks[-1]))
+
+    # collapse from the coarsest level, weighting every band by its level of the alpha pyramid
+    blended = gaussians[-1] * masks[-1][:, :, np.newaxis]
+    for level in range(levels - 1, -1, -1):
+        size = (gaussians[level].shape[1], gaussians[level].shape[0])
+        band = gaussians[level] - cv2.pyrUp(gaussians[level + 1], dstsize=size)
+        band *= masks[level][:, :, np.newaxis]
+        blended = cv2.pyrUp(blended, dstsize=size)
+        blended += band
+
+    blended += base
+    np.clip(blended, 0, 255, out=blended)
+    if out.dtype == np.uint8:
+        np.rint(blended, out=blended)
+    out[...] = blended
+    return out
+
+
+def seamless_blend(base, layer, alpha, out):
+    """
+    Poisson blend of layer over base with cv2.seamlessClone().
+    :param base: uint8 image
+    :param layer: float image the size of base
+    :param alpha: (height, width) blend weights, the mask is where they reach SEAMLESS_THRESHOLD
+    :param out: array shaped like base to write the result into
+    :return: out
+    """
+    mask = np.where(alpha >= SEAMLESS_THRESHOLD, 255, 0).astype(np.uint8)
+    # seamlessClone clears the outermost pixels of the mask, the box is worked out without them too
+    mask[0, :] = mask[-1, :] = 0
+    mask[:, 0] = mask[:, -1] = 0
+    if not mask.any():
+        out[...] = base
+        return out
+    x, y, width, height = cv2.boundingRect(mask)
+    source = np.clip(np.rint(layer), 0, 255).astype(np.uint8)
+    # the center places the mask's box of the source on the same box of base
+    out[...] = cv2.seamlessClone(source, np.ascontiguousarray(base), mask,
+                                 (x + width // 2, y + height // 2), cv2.NORMAL_CLONE)
+    return out
+
+
+def blend_into(image, box, layer, alpha, mode, out):
+    """
+    Blend a face layer into a box of an image.
+    :param image: the base image (uint8), not modified unless it is out
+    :param box: (x0, y0, x1, y1) box of image that layer and alpha cover
+    :param layer: float swapped face the size of the box, overwritten
+    :param alpha: blend weights in [0, 1], (height, width) or with a channel axis
+    :param mode: 'pyramid' or 'seamless', see faceSwap2.BLENDS
+    :param out: image shaped like image to write into; the box grown by margin(mode) is written
+    :return: out
+    """
+    if alpha.ndim == 3:
+        alpha = alpha[:, :, 0]  # get_face_mask repeats the same mask in every channel
+    alpha = alpha.astype(layer.dtype, copy=False)
+    if mode == 'pyramid':
+        pad = PYRAMID_MARGIN
+        # every level samples the same pixels as a pyramid of the whole image would
+        step = 2 ** PYRAMID_LEVELS
+        grown = roi.clamp_box(((box[0] - pad) // step * step, (box[1] - pad) // step * step,
+                               box[2] + pad, box[3] + pad), image.shape)
+        if grown != tuple(box):
+            # room for the coarse levels to fade out: the image itself, under an alpha of 0
+            inner = (box[0] - grown[0], box[1] - grown[1], box[2] - grown[0], box[3] - grown[1])
+            padded = roi.crop(image, grown).astype(layer.dtype)
+            roi.paste(padded, inner, layer)
+            padded_alpha = np.zeros(padded.shape[:2], dtype=layer.dtype)
+            roi.paste(padded_alpha, inner, alpha)
+            box, layer, alpha = grown, padded, padded_alpha
+        pyramid_blend(roi.crop(image, box), layer, alpha, roi.crop(out, box))
+    elif mode == 'seamless':
+        seamless_blend(roi.crop(image, box), layer, alpha, roi.crop(out, box))
+    else:
+        raise ValueError("unknown blend %r" % mode)
+    return out
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Composite several swapped faces onto one image in a single pass.
+
+Swapping the faces of a group photo one after the other blends every face
+into the image separately, and each swap colour corrects against a base that
+earlier swaps have already changed. The Compositor instead collects every
+face's layer and alpha (see faceSwap2.face_layer()), all computed against the
+untouched base. Faces whose boxes overlap are merged into one alpha map and
+one layer over the box covering them, where each pixel goes to whichever face
+has the higher alpha there, and that box is blended into the image once.
+With the 'pyramid' blend faces also merge when their pyramids would reach
+each other, and every group is decomposed once however many faces it has.
+
+Example Usage:
+    compositor = Compositor(image, precision='float32', blend='pyramid')
+    for box, layer, alpha in faces:
+        compositor.add(box, layer, alpha)
+    output = compositor.render()
+"""
+import itertools
+
+import numpy as np
+
+import blending
+import faceSwap2
+import metrics
+import roi
+
+
+class Compositor:
+    def __init__(self, image, precision='float64', blend='alpha'):
+        """
+        :param image: the base image as np.array, read but not modified until render()
+        :param precision: precision of the layers that will be added, see faceSwap2.PRECISIONS
+        :param blend: how the faces are blended into the image, see faceSwap2.BLENDS
+        """
+        if blend not in faceSwap2.BLENDS:
+            raise ValueError("unknown blend %r" % blend)
+        self.image = image
+        self.precision = precision
+        self.blend = blend
+        self.faces = []  # (box, layer, alpha (height, width))
+
+    def add(self, box, layer, alpha):
+        """
+        Add a face to the composite. The layer and alpha are copied, so they can be workspace
+        buffers that are reused for the next face.
+        :param box: (x0, y0, x1, y1) box of image the layer covers, see roi.clamp_box()
+        :param layer: swapped face the size of the box, see faceSwap2.face_layer()
+        :param alpha: blend weights in [0, 1], (height, width) or with a channel axis
+        """
+        if alpha.ndim == 3:
+            alpha = alpha[:, :, 0]  # get_face_mask repeats the same mask in every channel
+        self.faces.append((box, layer.copy(), alpha.copy()))
+
+    def groups(self, pad=0):
+        """
+        :param pad: pixels the boxes are grown by before checking whether they overlap
+        :return: list of (box, faces) where faces are the added faces whose boxes overlap, directly
+                 or through other faces, and box covers them all. Faces that overlap nothing are
+                 a group on their own, so the gaps between faces far apart are never blended.
+        """
+        groups = [(face[0], [face]) for face in self.faces]
+        # merge overlapping pairs until none are left, a merged box can reach further groups
+        merged = True
+        while merged:
+            merged = False
+            for i, j in itertools.combinations(range(len(groups)), 2):
+                if _overlap(groups[i][0], groups[j][0], pad):
+                    groups[i] = (_cover(groups[i][0], groups[j][0]), groups[i][1] + groups[j][1])
+                    del groups[j]
+                    merged = True
+                    break
+        return groups
+
+    def render(self, out=None):
+        """
+        Merge the faces and blend them into the image, one pass per group of overlapping faces.
+        :param out: image to write the result into, which may be the base image itself;
+                    defaults to a copy of the base image
+        :return: out
+        """
+        if out is None:
+            out = self.image.copy()
+        if not self.faces:
+            return out
+
+        metrics.observe('composite_faces', len(self.faces))
+        with metrics.span('composite', blend=self.blend):
+            # faces whose blends would write over each other's are blended together
+            for union, faces in self.groups(blending.margin(self.blend)):
+                self._blend(out, union, faces)
+        return out
+
+    def _blend(self, out, union, faces):
+        base = roi.crop(self.image, union)
+        dtype = np.float32 if self.precision == 'float32' else np.float64
+        layer = base.astype(dtype)
+        alpha = np.zeros(base.shape[:2], dtype=dtype)
+        for (x0, y0, x1, y1), face_layer, face_alpha in faces:
+            box = (x0 - union[0], y0 - union[1], x1 - union[0], y1 - union[1])
+            layer_view = roi.crop(layer, box)
+            alpha_view = roi.crop(alpha, box)
+            # label map: each pixel takes the layer of the face with the highest alpha there
+            take = face_alpha > alpha_view
+            layer_view[take] = face_layer[take]
+            np.maximum(alpha_view, face_alpha, out=alpha_view)
+
+        if self.blend != 'alpha':
+            blending.blend_into(self.image, union, layer, alpha, self.blend, out)
+        elif self.precision == 'float32':
+            faceSwap2.blend_f32(base, layer, alpha, roi.crop(out, union))
+        else:
+            alpha = alpha[:, :, np.newaxis]
+            roi.paste(out, union, base * (1.0 - alpha) + layer * alpha)
+
+
+def _overlap(a, b, pad=0):
+    return a[0] < b[2] + 2 * pad and b[0] < a[2] + 2 * pad and a[1] < b[3] + 2 * pad and b[1] < a[3] + 2 * pad
+
+
+def _cover(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Perceptual hash index for the scraped meme corpus, so reposts and the same
+picture under a different URL are recognized instead of being downloaded and
+sent to the detector again.
+
+Images are hashed with a 64 bit difference hash (dHash), which survives
+resizing and recompression, and near duplicates are found by Hamming distance
+with a BK-tree. The index is kept in a JSON file between runs.
+
+Example Usage:
+    index = DedupIndex('.cache/dedup.json')
+    index.index_folder('images/')
+    duplicate = index.find_duplicate(dhash_file('images/new.jpg'))
+"""
+import json
+import os
+import threading
+
+import cv2
+import numpy as np
+
+INDEX_VERSION = 1
+# largest Hamming distance between two dHashes that still counts as the same image
+MAX_DISTANCE = 6
+# item of a BKTree node whose entry was removed
+_REMOVED = object()
+
+
+def dhash(im, size=8):
+    """
+    Difference hash: shrink the image to (size + 1) x size grey pixels and record
+    whether each pixel is brighter than its right hand neighbour.
+    :param im: image as np.array, grey or BGR
+    :param size: hash is size * size bits
+    :return: the hash as an int
+    """
+    if im.ndim == 3:
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(im, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(''.join('1' if b else '0' for b in bits), 2)
+
+
+def dhash_bytes(content):
+    """
+    :param content: bytes of an encoded image
+    :return: the dHash of the image, or None if it could not be decoded
+    """
+    # a quarter size decode is plenty for an 9x8 thumbnail and much faster for JPEGs
+    im = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    return None if im is None else dhash(im)
+
+
+def dhash_file(path):
+    """
+    :param path: path of an image file
+    :return: the dHash of the image, or None if it could not be read
+    """
+    with open(path, 'rb') as image_file:
+        return dhash_bytes(image_file.read())
+
+
+def hamming(a, b):
+    """
+    :return: number of bits that differ between two hashes
+    """
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over hashes with Hamming distance, for finding every hash within
+    a given distance of a query without comparing against all of them.
+    """
+
+    def __init__(self):
+        # node is [hash, item, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        """
+        :param value: the hash
+        :param item: what to return when the hash is found
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = [value, item, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, item, {}]
+                return
+            node = child
+
+    def remove(self, value, item):
+        """
+        Forget one (hash, item) pair. Its node stays in place, as the tree is built around it,
+        but search() no longer returns it.
+        :return: True if the pair was found
+        """
+        node = self.root
+        while node is not None:
+            if node[0] == value and node[1] == item:
+                node[1] = _REMOVED
+                self.size -= 1
+                return True
+            node = node[2].get(hamming(value, node[0]))
+        return False
+
+    def search(self, value, radius):
+        """
+        :param value: the hash to look for
+        :param radius: the largest Hamming distance to return
+        :return: list of (distance, item) sorted by distance
+        """
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius and node[1] is not _REMOVED:
+                found.append((distance, node[1]))
+            # by the triangle inequality only these children can hold matches
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return sorted(found, key=lambda match: match[0])
+
+    def __len__(self):
+        return self.size
+
+
+class DedupIndex:
+    def __init__(self, path='.cache/dedup.json', max_distance=MAX_DISTANCE):
+        """
+        :param path: JSON file the index is kept in, created on save()
+        :param max_distance: largest Hamming distance treated as a duplicate
+        """
+        self.path = path
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self.hashes = {}  # image path -> dHash
+        self.urls = {}    # source URL -> image path
+        self.tree = BKTree()
+        if os.path.exists(path):
+            with open(path, 'r') as index_file:
+                saved = json.load(index_file)
+            if saved.get('version') == INDEX_VERSION:
+                for image_path, value in saved['hashes'].items():
+                    self._add(image_path, int(value, 16))
+                self.urls = saved['urls']
+
+    def _add(self, path, value):
+        self.hashes[path] = value
+        self.tree.add(value, path)
+
+    def add(self, path, value, url=None):
+        """
+        Record an image in the index. A path that is already indexed gets the new hash, as a
+        download can overwrite the file with a different picture.
+        :param path: where the image is stored
+        :param value: its dHash
+        :param url: the URL it was downloaded from, if any
+        """
+        with self._lock:
+            old = self.hashes.get(path)
+            if old != value:
+                if old is not None:
+                    self.tree.remove(old, path)
+                self._add(path, value)
+            if url:
+                self.urls[url] = path
+
+    def add_url(self, url, path):
+        """
+        Record that a URL gave an image that is already indexed, e.g. a repost.
+        :param url: the URL
+        :param path: where the indexed image is stored
+        """
+        with self._lock:
+            self.urls[url] = path
+
+    def seen_url(self, url):
+        """
+        :param url: an image URL
+        :return: the path of the image downloaded from it before, if it is still there
+        """
+        path = self.urls.get(url)
+        return path if path and os.path.exists(path) else None
+
+    def find_duplicate(self, value, exclude=None):
+        """
+        :param value: a dHash
+        :param exclude: a path to ignore, e.g. the image the hash came from
+        :return: path of the closest indexed image within max_distance, or None
+        """
+        if value is None:
+            return None
+        with self._lock:
+            matches = self.tree.search(value, self.max_distance)
+        for _, path in matches:
+            if path != exclude and os.path.exists(path):
+                return path
+        return None
+
+    def index_folder(self, folder):
+        """
+        Hash every image in a folder that is not in the index yet.
+        :param folder: folder of images
+        :return: number of images added
+        """
+        added = 0
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if path in self.hashes or not os.path.isfile(path):
+                continue
+            value = dhash_file(path)
+            if value is not None:
+                self.add(path, value)
+                added += 1
+        return added
+
+    def save(self):
+        """
+        Write the index to its JSON file.
+        """
+        with self._lock:
+            saved = {'version': INDEX_VERSION,
+                     'hashes': {path: '%016x' % value for path, value in self.hashes.items()},
+                     'urls': self.urls}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as index_file:
+            json.dump(saved, index_file)
+        os.replace(tmp, self.path)
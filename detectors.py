@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+Interchangeable face detector backends. Every backend returns faces as
+face_record.Face records, so the rest of the pipeline does not care where the
+landmarks came from.
+
+Backends:
+    cloud:   Google Cloud Vision (vision_detector.VisionDetector)
+    local:   OpenCV Haar cascade or DNN face detector plus an optional 68 point
+             landmark model (dlib .dat or OpenCV LBF .yaml), all on the CPU
+    fixture: landmarks read from a fixture file, or laid out deterministically
+             inside a centered box, for offline runs and load tests
+
+Example Usage:
+    detector = detectors.get_detector('local')
+    faces = detector.find_faces('photos/aaron.jpg')
+"""
+import io
+import json
+import os
+
+import cv2
+import numpy as np
+
+import annotation_cache
+import metrics
+from face_record import Face, corners, from_dicts, to_dicts
+
+# longest image side, in pixels, faces are detected at; larger images are shrunk and
+# re-encoded first and the landmarks scaled back up. None detects at full resolution.
+DETECT_MAX_SIDE = None
+DETECT_JPEG_QUALITY = 90
+
+# Vision landmark -> points of the 68 point iBUG layout (as used by dlib and
+# faceSwap.py) that are averaged to estimate it. "Left" is the left of the image.
+IBUG_TO_VISION = {
+    'LEFT_EYE': range(36, 42),
+    'RIGHT_EYE': range(42, 48),
+    'LEFT_OF_LEFT_EYEBROW': (17,),
+    'RIGHT_OF_LEFT_EYEBROW': (21,),
+    'LEFT_OF_RIGHT_EYEBROW': (22,),
+    'RIGHT_OF_RIGHT_EYEBROW': (26,),
+    'MIDPOINT_BETWEEN_EYES': (39, 42),
+    'NOSE_TIP': (30,),
+    'UPPER_LIP': (51,),
+    'LOWER_LIP': (57,),
+    'MOUTH_LEFT': (48,),
+    'MOUTH_RIGHT': (54,),
+    'MOUTH_CENTER': (62, 66),
+    'NOSE_BOTTOM_RIGHT': (35,),
+    'NOSE_BOTTOM_LEFT': (31,),
+    'NOSE_BOTTOM_CENTER': (33,),
+    'LEFT_EYE_TOP_BOUNDARY': (37, 38),
+    'LEFT_EYE_RIGHT_CORNER': (39,),
+    'LEFT_EYE_BOTTOM_BOUNDARY': (40, 41),
+    'LEFT_EYE_LEFT_CORNER': (36,),
+    'RIGHT_EYE_TOP_BOUNDARY': (43, 44),
+    'RIGHT_EYE_RIGHT_CORNER': (45,),
+    'RIGHT_EYE_BOTTOM_BOUNDARY': (46, 47),
+    'RIGHT_EYE_LEFT_CORNER': (42,),
+    'LEFT_EYEBROW_UPPER_MIDPOINT': (19,),
+    'RIGHT_EYEBROW_UPPER_MIDPOINT': (24,),
+    'LEFT_EAR_TRAGION': (0,),
+    'RIGHT_EAR_TRAGION': (16,),
+    'LEFT_EYE_PUPIL': range(36, 42),
+    'RIGHT_EYE_PUPIL': range(42, 48),
+    'FOREHEAD_GLABELLA': (21, 22),
+    'CHIN_GNATHION': (8,),
+    'CHIN_LEFT_GONION': (4,),
+    'CHIN_RIGHT_GONION': (12,),
+}
+
+# Typical position of every landmark inside a frontal face box, as fractions
+# of the box's width and height. Used when there is no landmark model.
+CANONICAL_LANDMARKS = {
+    'LEFT_EYE': (0.32, 0.38),
+    'RIGHT_EYE': (0.68, 0.38),
+    'LEFT_OF_LEFT_EYEBROW': (0.18, 0.28),
+    'RIGHT_OF_LEFT_EYEBROW': (0.43, 0.27),
+    'LEFT_OF_RIGHT_EYEBROW': (0.57, 0.27),
+    'RIGHT_OF_RIGHT_EYEBROW': (0.82, 0.28),
+    'MIDPOINT_BETWEEN_EYES': (0.50, 0.38),
+    'NOSE_TIP': (0.50, 0.58),
+    'UPPER_LIP': (0.50, 0.72),
+    'LOWER_LIP': (0.50, 0.82),
+    'MOUTH_LEFT': (0.36, 0.76),
+    'MOUTH_RIGHT': (0.64, 0.76),
+    'MOUTH_CENTER': (0.50, 0.77),
+    'NOSE_BOTTOM_RIGHT': (0.58, 0.63),
+    'NOSE_BOTTOM_LEFT': (0.42, 0.63),
+    'NOSE_BOTTOM_CENTER': (0.50, 0.65),
+    'LEFT_EYE_TOP_BOUNDARY': (0.32, 0.35),
+    'LEFT_EYE_RIGHT_CORNER': (0.40, 0.39),
+    'LEFT_EYE_BOTTOM_BOUNDARY': (0.32, 0.41),
+    'LEFT_EYE_LEFT_CORNER': (0.24, 0.39),
+    'RIGHT_EYE_TOP_BOUNDARY': (0.68, 0.35),
+    'RIGHT_EYE_RIGHT_CORNER': (0.76, 0.39),
+    'RIGHT_EYE_BOTTOM_BOUNDARY': (0.68, 0.41),
+    'RIGHT_EYE_LEFT_CORNER': (0.60, 0.39),
+    'LEFT_EYEBROW_UPPER_MIDPOINT': (0.30, 0.24),
+    'RIGHT_EYEBROW_UPPER_MIDPOINT': (0.70, 0.24),
+    'LEFT_EAR_TRAGION': (0.04, 0.50),
+    'RIGHT_EAR_TRAGION': (0.96, 0.50),
+    'LEFT_EYE_PUPIL': (0.32, 0.38),
+    'RIGHT_EYE_PUPIL': (0.68, 0.38),
+    'FOREHEAD_GLABELLA': (0.50, 0.28),
+    'CHIN_GNATHION': (0.50, 0.98),
+    'CHIN_LEFT_GONION': (0.14, 0.80),
+    'CHIN_RIGHT_GONION': (0.86, 0.80),
+}
+
+# dlib's predictor, same file faceSwap.py uses
+PREDICTOR_PATH = "./models/shape_predictor_68_face_landmarks.dat"
+
+
+def canonical_face(x0, y0, x1, y1):
+    """
+    Lay the canonical landmarks out inside a face box.
+    :param x0, y0: upper left corner of the face box
+    :param x1, y1: lower right corner of the face box
+    :return: a face_record.Face
+    """
+    width, height = x1 - x0, y1 - y0
+    landmarks = {name: (int(round(x0 + fx * width)), int(round(y0 + fy * height)))
+                 for name, (fx, fy) in CANONICAL_LANDMARKS.items()}
+    return Face.from_points(landmarks, corners(x0, y0, x1, y1),
+                            corners(x0 + width // 8, y0 + height // 5, x1 - width // 8, y1))
+
+
+def ibug_face(box, points):
+    """
+    Turn a 68 point iBUG landmark set into a Face.
+    :param box: (x0, y0, x1, y1) of the detected face
+    :param points: (68, 2) array of landmark positions
+    :return: a face_record.Face
+    """
+    points = np.asarray(points, dtype=np.float64)
+    landmarks = {}
+    for name, indices in IBUG_TO_VISION.items():
+        x, y = points[list(indices)].mean(axis=0)
+        landmarks[name] = (int(round(x)), int(round(y)))
+    xs, ys = points[:, 0], points[:, 1]
+    return Face.from_points(landmarks, corners(*[int(v) for v in box]),
+                            corners(int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max())))
+
+
+def decode(content, flags=cv2.IMREAD_COLOR):
+    """
+    :param content: bytes of an encoded image
+    :return: the decoded image as np.array, or None if it could not be decoded
+    """
+    return cv2.imdecode(np.frombuffer(content, dtype=np.uint8), flags)
+
+
+def downscale(content, max_side, quality=DETECT_JPEG_QUALITY):
+    """
+    Shrink an encoded image so its longest side is at most max_side, and re-encode it as JPEG.
+    :param content: bytes of an encoded image
+    :param max_side: longest side in pixels, None to leave the image as it is
+    :param quality: JPEG quality of the re-encoded image
+    :return: (bytes of the image, scale) where scale is the factor that takes coordinates in the
+             returned image back to the original; the original bytes and 1.0 when the image is
+             small enough already or cannot be decoded
+    """
+    if not max_side:
+        return content, 1.0
+    im = decode(content)
+    if im is None or max(im.shape[:2]) <= max_side:
+        return content, 1.0
+    height, width = im.shape[:2]
+    scale = max(height, width) / float(max_side)
+    size = (max(int(round(width / scale)), 1), max(int(round(height / scale)), 1))
+    small = cv2.resize(im, size, interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        return content, 1.0
+    return encoded.tobytes(), width / float(size[0])
+
+
+def rescale_faces(faces, scale):
+    """
+    Move faces found in a downscaled image back to the original image's coordinates.
+    :param faces: list of face_record.Face, or None
+    :param scale: the scale returned by downscale()
+    :return: new faces with every point multiplied by scale
+    """
+    if not faces or scale == 1.0:
+        return faces
+    return [face.scaled(scale) for face in faces]
+
+
+class FaceDetector:
+    """
+    Base class of the detector backends. A backend implements detect(), which
+    finds the faces in the bytes of an image; the cache and the batch API
+    come from here.
+    """
+    name = None
+
+    def __init__(self, cache=None, max_side=DETECT_MAX_SIDE):
+        """
+        :param cache: optional annotation_cache.AnnotationCache
+        :param max_side: longest side images are shrunk to before detection, see downscale();
+                         None to detect at full resolution
+        """
+        self.cache = cache
+        self.max_side = max_side
+
+    def params(self):
+        """
+        :return: dict of the settings that change which faces this detector finds
+        """
+        return {'max_side': self.max_side}
+
+    def cache_key(self, content):
+        """
+        :param content: bytes of an encoded image
+        :return: the annotation cache key of the image's faces with this detector's params(), so
+                 e.g. switching landmark models never reads the old model's landmarks
+        """
+        key = annotation_cache.content_key(content)
+        if self.max_side:
+            key = '%s-%d' % (key, self.max_side)
+        # max_side alone keeps the older keys, which backends without other settings still use
+        others = {name: value for name, value in self.params().items() if name != 'max_side'}
+        if others:
+            settings = json.dumps(others, sort_keys=True).encode('utf-8')
+            key = '%s-%s' % (key, annotation_cache.content_key(settings)[:16])
+        return key
+
+    def detect(self, content):
+        """
+        :param content: bytes of an encoded image
+        :return: list of face_record.Face, or None if there are no usable faces
+        """
+        raise NotImplementedError
+
+    def _read_bytes(self, image):
+        file_name = os.path.join(os.path.dirname(__file__), image)
+        with io.open(file_name, 'rb') as image_file:
+            return image_file.read()
+
+    def find_faces(self, image):
+        """
+        Find the faces in an image file, using the cache when the same image
+        bytes have been analyzed before.
+        :param image: string of directory/file_name
+        :return: list of face_record.Face, or None if there are no usable faces
+        """
+        return self.find_faces_bytes(self._read_bytes(image))
+
+    def find_faces_bytes(self, content):
+        """
+        Find the faces in an image that is already in memory, e.g. an upload, using the cache
+        when the same image bytes have been analyzed before.
+        :param content: bytes of an encoded image
+        :return: list of face_record.Face, or None if there are no usable faces
+        """
+        key, cleaned = self.cached(content)
+        if cleaned is not annotation_cache.MISS:
+            return cleaned
+        return self.detect_bytes(content, key)
+
+    def cached(self, content):
+        """
+        Look an image up without running the detector.
+        :param content: bytes of an encoded image
+        :return: (cache key or None, the faces as find_faces_bytes() returns them or annotation_cache.MISS)
+        """
+        if self.cache is None:
+            return None, annotation_cache.MISS
+        key = self.cache_key(content)
+        cleaned = self.cache.get(key)
+        if cleaned is annotation_cache.MISS:
+            metrics.count('cache_misses', backend=self.name)
+            return key, cleaned
+        metrics.count('cache_hits', backend=self.name)
+        return key, from_dicts(cleaned)
+
+    def detect_bytes(self, content, key=None):
+        """
+        Run the detector on an image at the detection resolution and store the result.
+        :param content: bytes of an encoded image
+        :param key: the image's cache key from cached(), None to leave the cache alone
+        :return: list of face_record.Face, or None if there are no usable faces
+        """
+        with metrics.span('detect', backend=self.name):
+            small, scale = downscale(content, self.max_side)
+            metrics.count('detect_bytes', len(small), backend=self.name)
+            cleaned = rescale_faces(self.detect(small), scale)
+        metrics.count('faces_found', len(cleaned) if cleaned else 0, backend=self.name)
+
+        if self.cache is not None and key is not None:
+            self.cache.put(key, to_dicts(cleaned))
+        return cleaned
+
+    def find_faces_batch(self, img_paths):
+        """
+        :param img_paths: list of strings of directory/file_name
+        :return: list of (path, list of face_record.Face or None, error string or None),
+                 in the same order as img_paths
+        """
+        results = []
+        for path in img_paths:
+            try:
+                results.append((path, self.find_faces(path), None))
+            except Exception as e:  # one bad image should not fail the batch
+                results.append((path, None, str(e)))
+        return results
+
+
+class LocalDetector(FaceDetector):
+    """
+    Offline backend. Faces are found with a Haar cascade (or an OpenCV DNN
+    face detector when a model is given), and landmarks come from a 68 point
+    model when one is available, or from CANONICAL_LANDMARKS otherwise.
+    """
+    name = 'local'
+
+    def __init__(self, cache=None, landmark_model=None, dnn_model=None,
+                 dnn_config=None, dnn_confidence=0.6, min_face=40, max_side=DETECT_MAX_SIDE):
+        """
+        :param cache: optional annotation_cache.AnnotationCache
+        :param landmark_model: dlib shape predictor (.dat) or OpenCV LBF facemark model (.yaml);
+                               defaults to PREDICTOR_PATH if that file exists
+        :param dnn_model: weights of an OpenCV DNN face detector (e.g. res10_300x300_ssd .caffemodel)
+        :param dnn_config: the matching network description (.prototxt)
+        :param dnn_confidence: lowest score a DNN detection is kept at
+        :param min_face: smallest face side in pixels the cascade looks for, at detection resolution
+        :param max_side: see FaceDetector
+        """
+        super().__init__(cache, max_side)
+        self.min_face = min_face
+        self.dnn_confidence = dnn_confidence
+        self.dnn_model = dnn_model
+        if dnn_model:
+            self.net = cv2.dnn.readNet(dnn_model, dnn_config)
+            self.cascade = None
+        else:
+            self.net = None
+            self.cascade = cv2.CascadeClassifier(
+                os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml'))
+
+        if landmark_model is None and os.path.exists(PREDICTOR_PATH):
+            landmark_model = PREDICTOR_PATH
+        self.landmark_model = landmark_model
+        self.predictor = None
+        self.facemark = None
+        if landmark_model and landmark_model.endswith('.dat'):
+            import dlib  # only needed for this model type
+            self.predictor = dlib.shape_predictor(landmark_model)
+        elif landmark_model:
+            self.facemark = cv2.face.createFacemarkLBF()  # needs opencv-contrib
+            self.facemark.loadModel(landmark_model)
+
+    def params(self):
+        params = super().params()
+        params.update(landmark_model=self.landmark_model, dnn_model=self.dnn_model,
+                      dnn_confidence=self.dnn_confidence, min_face=self.min_face)
+        return params
+
+    def _boxes(self, im):
+        if self.net is not None:
+            height, width = im.shape[:2]
+            blob = cv2.dnn.blobFromImage(cv2.resize(im, (300, 300)), 1.0, (300, 300),
+                                         (104.0, 177.0, 123.0))
+            self.net.setInput(blob)
+            detections = self.net.forward()[0, 0]
+            boxes = []
+            for detection in detections:
+                if detection[2] < self.dnn_confidence:
+                    continue
+                x0, y0, x1, y1 = detection[3:7] * [width, height, width, height]
+                boxes.append((int(x0), int(y0), int(x1), int(y1)))
+            return boxes
+
+        gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+        rects = self.cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5,
+                                              minSize=(self.min_face, self.min_face))
+        return [(int(x), int(y), int(x + w), int(y + h)) for x, y, w, h in rects]
+
+    def _landmarks(self, im, box):
+        if self.predictor is not None:
+            import dlib
+            shape = self.predictor(im, dlib.rectangle(*box))
+            return [(p.x, p.y) for p in shape.parts()]
+        if self.facemark is not None:
+            x0, y0, x1, y1 = box
+            ok, points = self.facemark.fit(im, np.array([[x0, y0, x1 - x0, y1 - y0]]))
+            return points[0][0] if ok else None
+        return None
+
+    def detect(self, content):
+        im = decode(content)
+        if im is None:
+            return None
+        cleaned = []
+        for box in self._boxes(im):
+            points = self._landmarks(im, box)
+            if points is None:
+                cleaned.append(canonical_face(*box))
+            else:
+                cleaned.append(ibug_face(box, points))
+        return cleaned or None
+
+
+class FixtureDetector(FaceDetector):
+    """
+    Deterministic backend for tests and offline load tests. Faces come from a
+    fixture mapping of image path (or SHA-256 of the image bytes) to cleaned
+    faces; any other image gets one canonical face centered in the frame.
+    """
+    name = 'fixture'
+
+    def __init__(self, cache=None, fixtures=None, face_frac=0.4, max_side=DETECT_MAX_SIDE):
+        """
+        :param cache: ignored, fixtures are already free to look up
+        :param fixtures: dict, or path to a JSON file, of path or content hash -> list of faces,
+                         as face_record.Face or feature dictionaries
+        :param face_frac: side of the synthesized face box as a fraction of the shorter image side
+        :param max_side: see FaceDetector; synthesized faces are laid out in the shrunk image
+        """
+        super().__init__(cache=None, max_side=max_side)
+        if isinstance(fixtures, str):
+            with open(fixtures, 'r') as fixture_file:
+                fixtures = json.load(fixture_file)
+        self.fixtures = {key: from_dicts(faces) for key, faces in (fixtures or {}).items()}
+        self.face_frac = face_frac
+
+    def params(self):
+        params = super().params()
+        params['face_frac'] = self.face_frac
+        return params
+
+    def find_faces(self, image):
+        if image in self.fixtures:
+            return self.fixtures[image]
+        return self.find_faces_bytes(self._read_bytes(image))
+
+    def cached(self, content):
+        key = annotation_cache.content_key(content)
+        if key in self.fixtures:
+            return None, self.fixtures[key]
+        return None, annotation_cache.MISS
+
+    def detect(self, content):
+        im = decode(content, cv2.IMREAD_GRAYSCALE)
+        if im is None:
+            return None
+        height, width = im.shape[:2]
+        side = int(min(height, width) * self.face_frac)
+        x0, y0 = (width - side) // 2, (height - side) // 2
+        return [canonical_face(x0, y0, x0 + side, y0 + side)]
+
+
+def get_detector(backend='cloud', cache=None, **options):
+    """
+    Make a detector backend by name.
+    :param backend: one of 'cloud', 'local' or 'fixture'
+    :param cache: optional annotation_cache.AnnotationCache
+    :param options: passed on to the backend's constructor
+    :return: a FaceDetector
+    """
+    if backend == 'cloud':
+        import vision_detector  # needs google-cloud-vision, so only imported when asked for
+        return vision_detector.VisionDetector(cache=cache, **options)
+    if backend == 'local':
+        return LocalDetector(cache=cache, **options)
+    if backend == 'fixture':
+        return FixtureDetector(cache=cache, **options)
+    raise ValueError("unknown detector backend %r" % backend)
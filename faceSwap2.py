@@ -22,9 +22,34 @@
 import cv2
 import numpy
 
+import blending
+import metrics
+import piecewise
+from face_record import as_face
+
 SCALE_FACTOR = 1
 FEATHER_AMOUNT = 11
 COLOUR_CORRECT_BLUR_FRAC = 0.6
+# pixels a face mask reaches past the convex hull of its landmarks: two blurs of FEATHER_AMOUNT
+FEATHER_REACH = 2 * (FEATHER_AMOUNT // 2)
+
+# swap_faces precisions. 'float64' is the original full-size three channel path.
+# 'float32' keeps one single channel float32 mask broadcast over the colour channels,
+# works in place in reusable buffers and returns uint8. Its output differs from the
+# float64 path by at most FLOAT32_TOLERANCE grey levels per channel (rounding of the
+# float32 colour correction and blend), which is not visible.
+PRECISIONS = ('float64', 'float32')
+FLOAT32_TOLERANCE = 2
+
+# how im2 is warped onto im1. 'affine' is the original single similarity transform fitted to
+# the face boxes; 'piecewise' also lines up every landmark both faces have, with one affine
+# transform per triangle of their Delaunay triangulation (see piecewise.py).
+WARPS = ('affine', 'piecewise')
+
+# how the swapped face is blended into im1. 'alpha' is the original feathered mix of the two;
+# 'pyramid' blends each band of a Laplacian pyramid over a matching width and 'seamless' is
+# Poisson blending with cv2.seamlessClone (see blending.py).
+BLENDS = ('alpha', 'pyramid', 'seamless')
 
 
 def draw_convex_hull(im, points, color):
@@ -58,50 +83,56 @@ def get_face_mask(im, landmarks):
                  (int(v[0]), int[v[1]])        landmarks[group],
                          color=1)"""
     draw_convex_hull(im, landmarks, color=1)
-    print("Drew hull")
 
     im = numpy.array([im, im, im]).transpose((1, 2, 0))
-    print("Drew hull")
-    print("IM LEN: %d\nIM HEIGHT:%d" %(len(im[0]), len(im)))
     im = (cv2.GaussianBlur(im, (FEATHER_AMOUNT, FEATHER_AMOUNT), 0) > 0) * 1.0
-    print("Gaussian 1")
 
     im = cv2.GaussianBlur(im, (FEATHER_AMOUNT, FEATHER_AMOUNT), 0)
-    print("Gaussian 2")
     return im
 
 
-def transformation_from_points(points1, points2):
+def get_face_mask_f32(im, landmarks, out=None):
     """
-    Method from original faceSwap.
-    Return an affine transformation [s * R | T] such that:
-
-        sum ||s*R*p1,i + T - p2,i||^2
-
-    is minimized.
-
-    :param points1: points of interest in image one
-    :param points2: points of image 2 to map to points1
-    :return: Transformation matrix approximating transformation from image2 onto image1 by solving procrustes problem.
+    Single channel float32 version of get_face_mask, a third of the blur work and a sixth
+    of the memory. Broadcast it over the colour channels with mask[:, :, numpy.newaxis].
+    :param im: The image that the mask refers to
+    :param landmarks: the points in the image being used to find regions of interest in the mask
+    :param out: optional (height, width) float32 array to build the mask in
+    :return: A (height, width) float32 mask of points in image to be replaced/moved to another image
     """
-    # Solve the procrustes problem by subtracting centroids, scaling by the
-    # standard deviation, and then using the SVD to calculate the rotation. See
-    # the following for more details:
-    #   https://en.wikipedia.org/wiki/Orthogonal_Procrustes_problem
-
-    points1 = points1.astype(numpy.float64)
-    points2 = points2.astype(numpy.float64)
-
-    c1 = numpy.mean(points1, axis=0)
-    c2 = numpy.mean(points2, axis=0)
-    points1 -= c1
-    points2 -= c2
+    if out is None:
+        out = numpy.empty(im.shape[:2], dtype=numpy.float32)
+    mask = out
+    mask.fill(0)
+    draw_convex_hull(mask, landmarks, color=1)
+    cv2.GaussianBlur(mask, (FEATHER_AMOUNT, FEATHER_AMOUNT), 0, dst=mask)
+    # same threshold as get_face_mask, done in place
+    numpy.greater(mask, 0, out=mask, casting='unsafe')
+    cv2.GaussianBlur(mask, (FEATHER_AMOUNT, FEATHER_AMOUNT), 0, dst=mask)
+    return mask
+
+
+def normalize_points(points):
+    """
+    First half of the procrustes problem in transformation_from_points: move the points
+    so their centroid is at the origin and scale them to unit standard deviation.
+    :param points: numpy.matrix of points, one per row
+    :return: tuple of (normalized points, centroid, scale)
+    """
+    points = points.astype(numpy.float64)
+    c = numpy.mean(points, axis=0)
+    points -= c
+    s = numpy.std(points)
+    points /= s
+    return points, c, s
 
-    s1 = numpy.std(points1)
-    s2 = numpy.std(points2)
-    points1 /= s1
-    points2 /= s2
 
+def transformation_from_normalized(points1, c1, s1, points2, c2, s2):
+    """
+    Second half of transformation_from_points, for points already passed through
+    normalize_points.
+    :return: Transformation matrix approximating transformation from image2 onto image1
+    """
     # singular value decomposition\
     # print(points1)
     # print(points2)
@@ -118,15 +149,42 @@ def transformation_from_points(points1, points2):
                          numpy.matrix([0., 0., 1.])])
 
 
-def warp_im(im, M, dshape):
+def transformation_from_points(points1, points2):
+    """
+    Method from original faceSwap.
+    Return an affine transformation [s * R | T] such that:
+
+        sum ||s*R*p1,i + T - p2,i||^2
+
+    is minimized.
+
+    :param points1: points of interest in image one
+    :param points2: points of image 2 to map to points1
+    :return: Transformation matrix approximating transformation from image2 onto image1 by solving procrustes problem.
+    """
+    # Solve the procrustes problem by subtracting centroids, scaling by the
+    # standard deviation, and then using the SVD to calculate the rotation. See
+    # the following for more details:
+    #   https://en.wikipedia.org/wiki/Orthogonal_Procrustes_problem
+    points1, c1, s1 = normalize_points(points1)
+    points2, c2, s2 = normalize_points(points2)
+    return transformation_from_normalized(points1, c1, s1, points2, c2, s2)
+
+
+def warp_im(im, M, dshape, out=None):
     """
     Method from original faceSwap. Applies the transformation matrix M to im
     :param im: Image to be warped
     :param M: Transformation matrix
-    :param dshape: ???
+    :param dshape: shape of the output image
+    :param out: optional array of shape dshape and im's dtype to warp into
     :return: The image after being transformed by matrix
     """
-    output_im = numpy.zeros(dshape, dtype=im.dtype)
+    if out is None:
+        output_im = numpy.zeros(dshape, dtype=im.dtype)
+    else:
+        output_im = out
+        output_im.fill(0)
     cv2.warpAffine(im,
                    M[:2],
                    (dshape[1], dshape[0]),
@@ -136,6 +194,24 @@ def warp_im(im, M, dshape):
     return output_im
 
 
+def colour_blur_amount(left_eye_points, right_eye_points):
+    """
+    Size of the Gaussian kernel used in colour correction, a fraction of the distance between the eyes.
+    :param left_eye_points: set of xy points describing the left eye
+    :param right_eye_points: set of xy points describing the right eye
+    :return: an odd kernel size, 1 (the original faceSwap2 value) unless both eyes have points
+    """
+    if not numpy.size(left_eye_points) or not numpy.size(right_eye_points):
+        return 1
+    blur_amount = COLOUR_CORRECT_BLUR_FRAC * numpy.linalg.norm(
+                              numpy.mean(left_eye_points, axis=0) -
+                              numpy.mean(right_eye_points, axis=0))
+    blur_amount = int(blur_amount)
+    if blur_amount % 2 == 0:
+        blur_amount += 1
+    return blur_amount
+
+
 def correct_colours(im1, im2, left_eye_points, right_eye_points):
     """
 
@@ -147,12 +223,7 @@ def correct_colours(im1, im2, left_eye_points, right_eye_points):
     :param right_eye_points: set of xy points describing the right eye in im2
     :return: Im2 after being color corrected
     """
-    blur_amount = COLOUR_CORRECT_BLUR_FRAC * numpy.linalg.norm(
-                              numpy.mean(left_eye_points, axis=0) -
-                              numpy.mean(right_eye_points, axis=0))
-    blur_amount = int(blur_amount)
-    if blur_amount % 2 == 0:
-        blur_amount += 1
+    blur_amount = colour_blur_amount(left_eye_points, right_eye_points)
     im1_blur = cv2.GaussianBlur(im1, (blur_amount, blur_amount), 0)
     im2_blur = cv2.GaussianBlur(im2, (blur_amount, blur_amount), 0)
 
@@ -163,86 +234,345 @@ def correct_colours(im1, im2, left_eye_points, right_eye_points):
             im2_blur.astype(numpy.float64))
 
 
-def subset(dict1, dict2):
+# maps 0 and 1 to 128 and 129, and every other uint8 value to itself
+_NONZERO_LUT = numpy.arange(256, dtype=numpy.uint8)
+_NONZERO_LUT[:2] += 128
+
+
+def correct_colours_f32(im1, im2, left_eye_points, right_eye_points, out):
     """
-    Helper method to find the intersecting subset of key-value pairs contained by two dictionaries.
-    :param dict1: a dictionary
-    :param dict2: another dictionary
-    :return: Tuple of dicts containing the values with identical keys in both dicts
+    float32 version of correct_colours that writes into a preallocated buffer.
+    :param im1: Base image in color correction (uint8)
+    :param im2: Additional image in color correction (uint8)
+    :param left_eye_points: set of xy points describing the left eye in im1
+    :param right_eye_points: set of xy points describing the right eye in im1
+    :param out: float32 array shaped like im2 to write the corrected im2 into
+    :return: out
     """
-    keys1 = set(dict1.keys())
-    keys2 = set(dict2.keys())
-    intersection1 = dict1.fromkeys(keys1 & keys2)
-    intersection2 = dict2.fromkeys(keys1 & keys2)
-    for key in intersection1.keys():
-        intersection1[key] = dict1[key]
-        intersection2[key] = dict2[key]
+    blur_amount = colour_blur_amount(left_eye_points, right_eye_points)
+    im1_blur = cv2.GaussianBlur(im1, (blur_amount, blur_amount), 0)
+    im2_blur = cv2.GaussianBlur(im2, (blur_amount, blur_amount), 0)
+
+    # Avoid divide-by-zero errors, as a lookup so no boolean temporary is needed.
+    cv2.LUT(im2_blur, _NONZERO_LUT, dst=im2_blur)
 
-    return intersection1, intersection2
+    out[...] = im2
+    out *= im1_blur
+    out /= im2_blur
+    return out
 
 
-def find_eyes(landmarks):
+def blend_f32(im1, im2, mask, out):
     """
-    Helper method to find all key-value pairs in a dict whose keys reference 'left_eye' and 'right_eye'
-    The dictionary should have string keys or it will return a None tuple
-    :param landmarks: Dictionary with String keys referencing left and right eyes
-    :return: a tuple of lists containing pixel locations of landmarks representing left_eye and right_eye
+    im1 * (1 - mask) + im2 * mask, computed in place as im1 + (im2 - im1) * mask.
+    :param im1: Base image (uint8)
+    :param im2: float32 image to blend on top, overwritten
+    :param mask: (height, width) float32 alpha, broadcast over the colour channels
+    :param out: uint8 array shaped like im1 to write the result into, saturated to [0, 255]
+    :return: out
     """
-    left_eye = {}
-    right_eye = {}
-    for key in landmarks.keys():
-        if str(key).startswith("left_eye"):
-            left_eye[key] = landmarks[key]
-        elif key.startswith("right_eye"):
-            right_eye[key] = landmarks[key]
-    return left_eye, right_eye
+    im2 -= im1
+    im2 *= mask[:, :, numpy.newaxis]
+    im2 += im1
+    numpy.clip(im2, 0, 255, out=im2)
+    numpy.rint(im2, out=im2)
+    out[...] = im2
+    return out
 
 
-def swap_faces(im1, im2, features1, features2):
+class Workspace:
+    """
+    Reusable buffers for the float32 swap path, so repeated swaps of the same size do not
+    allocate new full-size arrays every time.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype):
+        """
+        :param name: what the buffer is used for
+        :param shape: shape the buffer must have
+        :param dtype: dtype the buffer must have
+        :return: an uninitialized array, the same one as last time if shape and dtype match
+        """
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self._buffers[name] = numpy.empty(shape, dtype=dtype)
+        return buf
+
+
+def eye_points(features):
+    """
+    Helper method to pull the eye landmarks (not the eyebrows) out of a face as matrices for correct_colours.
+    :param features: a face_record.Face (or a feature dictionary in the older format)
+    :return: tuple of numpy.matrix of left eye points and right eye points (1 x 0 if there are none)
+    """
+    return tuple(numpy.matrix(points) if len(points) else numpy.matrix([])
+                 for points in as_face(features).eyes())
+
+
+class PreparedFace:
+    """
+    Everything swap_faces needs from the face that is pasted on top (im2) that does not
+    depend on the image it is pasted onto: its alignment landmarks, their centroid and
+    scale for the procrustes problem, its feathered mask and the triangulations of its
+    landmarks for the piecewise warp. Build it once per source face and pass it to
+    swap_faces for every target.
+    """
+
+    def __init__(self, im, features, precision='float64'):
+        """
+        :param im: Image whose face will be in final image
+        :param features: face_record.Face of im, its Face.bound() is used for alignment
+        :param precision: the swap_faces precision the mask is built for, see PRECISIONS
+        """
+        self.precision = precision
+        self.shape = im.shape
+        self.face = as_face(features)
+        if self.face.bound() is None:
+            raise ValueError("the source face has no bounding poly")
+        self.landmarks = numpy.matrix(self.face.bound())
+        # landmark bitmask -> piecewise.Triangulation, see triangulation()
+        self._triangulations = {}
+        self.normalized, self.centroid, self.scale = normalize_points(self.landmarks)
+        # everywhere outside this box the mask is 0
+        self.mask_box = hull_box(self.landmarks, FEATHER_REACH, im.shape)
+        if precision == 'float32':
+            # warpAffine's BORDER_TRANSPARENT fills the pixels that sample past the edge of a
+            # float32 image but skips them for float64, so the single channel mask is warped as
+            # float64 like get_face_mask's
+            self.mask = get_face_mask_f32(im, self.landmarks).astype(numpy.float64)
+        else:
+            self.mask = get_face_mask(im, self.landmarks)
+
+    def matches(self, im, landmarks1, precision='float64'):
+        """
+        :param im: the image passed to swap_faces as im2
+        :param landmarks1: the alignment landmarks of the target face, (4, 2) in BOUND_CORNERS order
+        :param precision: the precision passed to swap_faces
+        :return: True if this preparation can be used for a swap with those inputs
+        """
+        return (im.shape == self.shape and precision == self.precision and
+                landmarks1 is not None and len(landmarks1) == len(self.landmarks))
+
+    def triangulation(self, face1):
+        """
+        :param face1: face_record.Face of the target face
+        :return: piecewise.Triangulation of the landmarks both faces have, built the first
+                 time a target with that set of landmarks is seen
+        """
+        valid = face1.valid & self.face.valid
+        triangulation = self._triangulations.get(valid)
+        if triangulation is None:
+            triangulation = self._triangulations[valid] = piecewise.Triangulation(self.face, face1.valid_mask())
+        return triangulation
+
+
+def swap_faces(im1, im2, features1, features2, prepared2=None, precision='float64', workspace=None,
+               window=False, warp='affine', blend='alpha'):
     """
     Method to write out an image putting the face in im2 over the face in im1.
     Writes out to file at location (must be jpg probably)
     :param im1: Base image whose face will be replaced
     :param im2: Image whose face will be in final image
-    :param features1: Information on im1 including a large and small bounding box
-                      for the face as well as a dictionary of landmark points
-    :param features2: Information on im2 including a large and small bounding box
-                      for the face as well as a dictionary of landmark points
+    :param features1: face_record.Face of im1, with a large and small bounding box
+                      for the face as well as its landmark points
+    :param features2: face_record.Face of im2
+    :param prepared2: optional PreparedFace for im2 and features2, reused across calls to skip
+                      recomputing im2's mask and landmark normalization
+    :param precision: 'float64' returns a float64 image; 'float32' uses the reduced precision path
+                      and returns a uint8 image (see PRECISIONS)
+    :param workspace: optional Workspace whose buffers the float32 path reuses
+    :param window: only do the work inside swap_window(), for the same result at a cost that
+                   depends on the size of the face rather than of im1 (see face_layer_window)
+    :param warp: how im2 is warped onto im1, see WARPS
+    :param blend: how the face is blended into im1, see BLENDS
     :param location: The file to write the final image to
     :return: void
     """
-    landmarks1 = features1['outer_bound_dict']
-    landmarks2 = features2['outer_bound_dict']
-    # convert dicts into lists for mask style accessability (important)
-    landmarks1, landmarks2 = subset(landmarks1, landmarks2)
-    left_eye1, right_eye1 = find_eyes(landmarks1)
-    left_eye1 = list(left_eye1.values())
-    left_eye1 = numpy.matrix([int(v) for v in left_eye1])
-    right_eye1 = list(right_eye1.values())
-    right_eye1 = numpy.matrix([int(v) for v in right_eye1])
-    landmarks1 = list(landmarks1.values())
-    landmarks1 = numpy.matrix([(int(v[0]), int(v[1])) for v in landmarks1])
-    landmarks2 = list(landmarks2.values())
-    landmarks2 = numpy.matrix([(int(v[0]), int(v[1])) for v in landmarks2])
-    print("Made thousands of arrays :/")
+    if blend not in BLENDS:
+        raise ValueError("unknown blend %r" % blend)
+    if window:
+        (x0, y0, x1, y1), layer, alpha = face_layer_window(im1, im2, features1, features2, prepared2,
+                                                           precision, workspace, warp)
+        output_im = im1.copy() if precision == 'float32' else im1.astype(numpy.float64)
+        base, out = im1[y0:y1, x0:x1], output_im[y0:y1, x0:x1]
+    else:
+        layer, alpha = face_layer(im1, im2, features1, features2, prepared2, precision, workspace, warp)
+        x0, y0, x1, y1 = 0, 0, im1.shape[1], im1.shape[0]
+        base = im1
+        out = output_im = numpy.empty(im1.shape, dtype=numpy.uint8) if precision == 'float32' else None
 
-    # calculate points used for aligning image
-    # calculate transformation matrix
-    m = transformation_from_points(landmarks1, landmarks2)
-    print("calced Transform")
-    # calculate mask for im2
-    mask = get_face_mask(im2, landmarks2)  # INFINITY ISSUE
-    print("found mask")
-    # transform the mask of im2
-    warped_mask = warp_im(mask, m, im1.shape)
-    print("warped mask")
-    combined_mask = numpy.max([get_face_mask(im1, landmarks1), warped_mask],
-                              axis=0)
-    # warp and correct im2 to mask onto im1
-    warped_im2 = warp_im(im2, m, im1.shape)
-    warped_corrected_im2 = correct_colours(im1, warped_im2, left_eye1, right_eye1)
     # mask im2 onto im1
-    output_im = im1 * (1.0 - combined_mask) + warped_corrected_im2 * combined_mask
+    with metrics.span('swap_stage', stage='blend'):
+        if blend != 'alpha':
+            if output_im is None:
+                output_im = numpy.empty(im1.shape, dtype=numpy.float64)
+            blending.blend_into(im1, (x0, y0, x1, y1), layer, alpha, blend, output_im)
+        elif precision == 'float32':
+            blend_f32(base, layer, alpha, out)
+        elif out is None:
+            output_im = base * (1.0 - alpha) + layer * alpha
+        else:
+            out[...] = base * (1.0 - alpha) + layer * alpha
     # print("Writing to: %s" % location)
     # cv2.imwrite(location, output_im)
     return output_im
+
+
+def hull_box(points, pad, shape):
+    """
+    :param points: numpy.matrix of xy points, one per row
+    :param pad: pixels to grow the box by on every side
+    :param shape: shape of the image the box is clipped to
+    :return: (x0, y0, x1, y1) box around the points, exclusive of x1 and y1
+    """
+    points = numpy.asarray(points)
+    return (max(int(points[:, 0].min()) - pad, 0), max(int(points[:, 1].min()) - pad, 0),
+            min(int(points[:, 0].max()) + pad + 1, shape[1]), min(int(points[:, 1].max()) + pad + 1, shape[0]))
+
+
+def swap_window(shape, landmarks1, prepared2, M, blur_amount):
+    """
+    The part of im1 a swap can change, grown by the colour correction blur so that everything
+    in it can be computed from the window alone. Outside the combined mask the swap leaves im1
+    as it was; the mask reaches FEATHER_REACH past im1's face hull and as far as im2's mask
+    lands once warped, and colour correction reads blur_amount // 2 further.
+    :param shape: shape of im1
+    :param landmarks1: numpy.matrix of im1's alignment points
+    :param prepared2: PreparedFace of the face in im2
+    :param M: transformation matrix from im1 to im2, see transformation_from_points
+    :param blur_amount: colour correction kernel size, see colour_blur_amount
+    :return: (x0, y0, x1, y1) box of im1
+    """
+    # where the corners of im2's mask box land in im1, plus a pixel for interpolation
+    x0, y0, x1, y1 = prepared2.mask_box
+    corners = numpy.linalg.inv(M) * numpy.matrix([[x0, x1, x1, x0], [y0, y0, y1, y1], [1., 1., 1., 1.]])
+    x0, y0, x1, y1 = hull_box(landmarks1, FEATHER_REACH, shape)
+    pad = blur_amount // 2 + 1
+    return (max(min(x0, int(numpy.floor(corners[0].min())) - 1) - pad, 0),
+            max(min(y0, int(numpy.floor(corners[1].min())) - 1) - pad, 0),
+            min(max(x1, int(numpy.ceil(corners[0].max())) + 2) + pad, shape[1]),
+            min(max(y1, int(numpy.ceil(corners[1].max())) + 2) + pad, shape[0]))
+
+
+def _align(im1, im2, features1, features2, prepared2, precision, warp='affine'):
+    """
+    Line the faces up: the PreparedFace for im2, im1's alignment points in the same order, im1's
+    eyes, the transformation from im1 to im2 and, for the piecewise warp, the triangulation and
+    im1's points matching it (None for the affine warp).
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("unknown precision %r" % precision)
+    if warp not in WARPS:
+        raise ValueError("unknown warp %r" % warp)
+    features1 = as_face(features1)
+    if features1.bound() is None:
+        raise ValueError("the target face has no bounding poly")
+    # both bounds list their corners in BOUND_CORNERS order, so the points already line up
+    if prepared2 is None or not prepared2.matches(im2, features1.bound(), precision):
+        prepared2 = PreparedFace(im2, features2, precision)
+    landmarks1 = numpy.matrix(features1.bound())
+    left_eye1, right_eye1 = eye_points(features1)
+
+    # calculate points used for aligning image
+    # calculate transformation matrix
+    with metrics.span('swap_stage', stage='transform'):
+        points1, c1, s1 = normalize_points(landmarks1)
+        m = transformation_from_normalized(points1, c1, s1,
+                                           prepared2.normalized, prepared2.centroid, prepared2.scale)
+        pieces = None
+        if warp == 'piecewise':
+            triangulation = prepared2.triangulation(features1)
+            pieces = (triangulation, triangulation.target_points(features1, m))
+    return prepared2, landmarks1, left_eye1, right_eye1, m, pieces
+
+
+def face_layer(im1, im2, features1, features2, prepared2=None, precision='float64', workspace=None,
+               warp='affine'):
+    """
+    Everything swap_faces does short of blending: im2 warped onto im1's face and colour
+    corrected, and the alpha to blend it with. Several faces' layers can be merged and
+    blended in one pass, see compositor.Compositor.
+    Takes the same parameters as swap_faces.
+    :return: (layer, alpha). For 'float64' both are float64 and alpha has a channel axis like
+             get_face_mask; for 'float32' both are float32, alpha is (height, width), and both
+             are workspace buffers that the next call with the same workspace overwrites
+    """
+    prepared2, landmarks1, left_eye1, right_eye1, m, pieces = _align(im1, im2, features1, features2, prepared2,
+                                                                     precision, warp)
+    return _layer(im1, im2, prepared2, landmarks1, left_eye1, right_eye1, m, pieces, precision, workspace)
+
+
+def face_layer_window(im1, im2, features1, features2, prepared2=None, precision='float64', workspace=None,
+                      warp='affine'):
+    """
+    face_layer computed only inside swap_window(), so a small face in a large image costs
+    as much as the face rather than the image. Blended into the same window of im1 the
+    result is the same as face_layer's.
+    Takes the same parameters as swap_faces.
+    :return: (box, layer, alpha) where box is the (x0, y0, x1, y1) window of im1 that layer and
+             alpha cover, see face_layer
+    """
+    prepared2, landmarks1, left_eye1, right_eye1, m, pieces = _align(im1, im2, features1, features2, prepared2,
+                                                                     precision, warp)
+    blur_amount = colour_blur_amount(left_eye1, right_eye1)
+    box = swap_window(im1.shape, landmarks1, prepared2, m, blur_amount)
+    if pieces is not None:
+        # inside the ring the piecewise warp can reach further than the similarity transform
+        reach = hull_box(pieces[1], blur_amount // 2 + 2, im1.shape)
+        box = (min(box[0], reach[0]), min(box[1], reach[1]), max(box[2], reach[2]), max(box[3], reach[3]))
+    x0, y0, x1, y1 = box
+    # window coordinates, the eyes only set the blur size so they can stay as they are
+    landmarks1 = landmarks1 - numpy.matrix([[x0, y0]])
+    m = m * numpy.matrix([[1., 0., x0], [0., 1., y0], [0., 0., 1.]])
+    if pieces is not None:
+        pieces = (pieces[0], pieces[1] - (x0, y0))
+    layer, alpha = _layer(im1[y0:y1, x0:x1], im2, prepared2, landmarks1, left_eye1, right_eye1, m, pieces,
+                          precision, workspace)
+    return box, layer, alpha
+
+
+def _warp(im, m, maps, dshape, out=None):
+    # warp_im, or the piecewise warp when there are maps for it
+    if maps is None:
+        return warp_im(im, m, dshape, out)
+    return piecewise.warp(im, m, maps, dshape, out)
+
+
+def _layer(im1, im2, prepared2, landmarks1, left_eye1, right_eye1, m, pieces, precision, workspace):
+    maps = None
+    if pieces is not None:
+        with metrics.span('swap_stage', stage='triangles'):
+            maps = piecewise.warp_maps(pieces[0], pieces[1], m, im1.shape)
+
+    if precision == 'float32':
+        if workspace is None:
+            workspace = Workspace()
+        # transform the mask of im2 and merge it with im1's, in place
+        with metrics.span('swap_stage', stage='mask'):
+            combined_mask = get_face_mask_f32(im1, landmarks1,
+                                              workspace.get('mask', im1.shape[:2], numpy.float32))
+            warped_mask = _warp(prepared2.mask, m, maps, im1.shape[:2],
+                                workspace.get('warped_mask', im1.shape[:2], numpy.float64))
+            numpy.maximum(combined_mask, warped_mask, out=combined_mask)
+        # warp and correct im2 to mask onto im1
+        with metrics.span('swap_stage', stage='warp'):
+            warped_im2 = _warp(im2, m, maps, im1.shape)
+        with metrics.span('swap_stage', stage='colour'):
+            corrected = correct_colours_f32(im1, warped_im2, left_eye1, right_eye1,
+                                            workspace.get('corrected', im1.shape, numpy.float32))
+        return corrected, combined_mask
+
+    # transform the mask of im2
+    with metrics.span('swap_stage', stage='mask'):
+        warped_mask = _warp(prepared2.mask, m, maps, im1.shape)
+        combined_mask = numpy.max([get_face_mask(im1, landmarks1), warped_mask],
+                                  axis=0)
+    # warp and correct im2 to mask onto im1
+    with metrics.span('swap_stage', stage='warp'):
+        warped_im2 = _warp(im2, m, maps, im1.shape)
+    with metrics.span('swap_stage', stage='colour'):
+        warped_corrected_im2 = correct_colours(im1, warped_im2, left_eye1, right_eye1)
+    return warped_corrected_im2, combined_mask
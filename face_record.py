@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Compact record of one detected face.
+
+A Face keeps every landmark in a fixed (35, 2) int32 array indexed by the
+Vision API's Landmark.Type enum (see LANDMARK_NAMES), a bitmask of which of
+them the detector found, and the outer and inner bounding polygons as (4, 2)
+int32 arrays in BOUND_CORNERS order. Picking landmarks out of a face is then
+fancy indexing instead of walking string-keyed dictionaries.
+
+The older feature dictionary format, as returned by clean_face_features()
+before there was a Face, is still what the annotation cache and fixture files
+hold; Face.from_dict() and Face.to_dict() convert between the two.
+
+Example Usage:
+    face = Face.from_dict({'outer_bound_dict': {...}, 'inner_bound_dict': {...},
+                           'facial_features_dict': {'LEFT_EYE': (120, 80), ...}})
+    left_eye, right_eye = face.eyes()
+    face.shifted(-x0, -y0).to_dict()
+"""
+import numpy as np
+
+# map int (constant type) to readable string, matches the Vision API's Landmark.Type enum
+LANDMARK_NAMES = [
+    'UNKNOWN_LANDMARK',
+    'LEFT_EYE',
+    'RIGHT_EYE',
+    'LEFT_OF_LEFT_EYEBROW',
+    'RIGHT_OF_LEFT_EYEBROW',
+    'LEFT_OF_RIGHT_EYEBROW',
+    'RIGHT_OF_RIGHT_EYEBROW',
+    'MIDPOINT_BETWEEN_EYES',
+    'NOSE_TIP',
+    'UPPER_LIP',
+    'LOWER_LIP',
+    'MOUTH_LEFT',
+    'MOUTH_RIGHT',
+    'MOUTH_CENTER',
+    'NOSE_BOTTOM_RIGHT',
+    'NOSE_BOTTOM_LEFT',
+    'NOSE_BOTTOM_CENTER',
+    'LEFT_EYE_TOP_BOUNDARY',
+    'LEFT_EYE_RIGHT_CORNER',
+    'LEFT_EYE_BOTTOM_BOUNDARY',
+    'LEFT_EYE_LEFT_CORNER',
+    'RIGHT_EYE_TOP_BOUNDARY',
+    'RIGHT_EYE_RIGHT_CORNER',
+    'RIGHT_EYE_BOTTOM_BOUNDARY',
+    'RIGHT_EYE_LEFT_CORNER',
+    'LEFT_EYEBROW_UPPER_MIDPOINT',
+    'RIGHT_EYEBROW_UPPER_MIDPOINT',
+    'LEFT_EAR_TRAGION',
+    'RIGHT_EAR_TRAGION',
+    'LEFT_EYE_PUPIL',
+    'RIGHT_EYE_PUPIL',
+    'FOREHEAD_GLABELLA',
+    'CHIN_GNATHION',
+    'CHIN_LEFT_GONION',
+    'CHIN_RIGHT_GONION',
+]
+LANDMARK_INDEX = {name: i for i, name in enumerate(LANDMARK_NAMES)}
+NUM_LANDMARKS = len(LANDMARK_NAMES)
+
+# order of the vertices of a Vision bounding poly; the labels do not match the actual
+# corners (the first vertex is the upper left one), see roi.face_box()
+BOUND_CORNERS = ['LOWER_LEFT', 'LOWER_RIGHT', 'UPPER_RIGHT', 'UPPER_LEFT']
+
+# the eye landmarks used for colour correction, not counting the eyebrows
+LEFT_EYE_LANDMARKS = np.array([i for i, name in enumerate(LANDMARK_NAMES)
+                               if name.startswith('LEFT_EYE') and not name.startswith('LEFT_EYEBROW')])
+RIGHT_EYE_LANDMARKS = np.array([i for i, name in enumerate(LANDMARK_NAMES)
+                                if name.startswith('RIGHT_EYE') and not name.startswith('RIGHT_EYEBROW')])
+
+_BITS = np.int64(1) << np.arange(NUM_LANDMARKS, dtype=np.int64)
+
+
+def corners(x0, y0, x1, y1):
+    """
+    Describe a box the way a bounding poly is kept.
+    :param x0, y0: upper left corner of the box
+    :param x1, y1: lower right corner of the box
+    :return: (4, 2) int32 array of vertices in BOUND_CORNERS order
+    """
+    return np.array([(x0, y0), (x1, y0), (x1, y1), (x0, y1)], dtype=np.int32)
+
+
+class Face:
+    __slots__ = ('landmarks', 'valid', 'outer', 'inner')
+
+    def __init__(self, landmarks=None, valid=0, outer=None, inner=None):
+        """
+        :param landmarks: (35, 2) int32 array of landmark positions indexed by LANDMARK_NAMES
+        :param valid: bitmask with bit i set when landmark i was found
+        :param outer: (4, 2) int32 array of the bounding poly of the entire face, or None
+        :param inner: (4, 2) int32 array of the bounding poly of the skin part only, or None
+        """
+        self.landmarks = np.zeros((NUM_LANDMARKS, 2), dtype=np.int32) if landmarks is None else landmarks
+        self.valid = int(valid)
+        self.outer = outer
+        self.inner = inner
+
+    @classmethod
+    def from_points(cls, points, outer=None, inner=None):
+        """
+        :param points: dict of landmark name or Landmark.Type int -> (x, y)
+        :param outer: vertices of the outer bounding poly, see corners()
+        :param inner: vertices of the inner bounding poly
+        :return: a Face; coordinates are truncated to ints
+        """
+        landmarks = np.zeros((NUM_LANDMARKS, 2), dtype=np.int32)
+        valid = 0
+        for key, (x, y) in points.items():
+            index = key if isinstance(key, int) else LANDMARK_INDEX[key]
+            landmarks[index] = (int(x), int(y))
+            valid |= 1 << index
+        return cls(landmarks, valid, _vertices(outer), _vertices(inner))
+
+    @classmethod
+    def from_dict(cls, feature):
+        """
+        :param feature: one feature dictionary in the format clean_face_features() used to return
+        :return: the Face
+        """
+        outer = feature.get('outer_bound_dict')
+        inner = feature.get('inner_bound_dict')
+        return cls.from_points(feature.get('facial_features_dict') or {},
+                               [outer[c] for c in BOUND_CORNERS if c in outer] if outer else None,
+                               [inner[c] for c in BOUND_CORNERS if c in inner] if inner else None)
+
+    def to_dict(self):
+        """
+        :return: the face as a feature dictionary, in the format clean_face_features() used to return
+        """
+        def bound(vertices):
+            if vertices is None:
+                return None
+            return {c: (int(x), int(y)) for c, (x, y) in zip(BOUND_CORNERS, vertices)}
+
+        return {'outer_bound_dict': bound(self.outer),
+                'inner_bound_dict': bound(self.inner),
+                'facial_features_dict': {LANDMARK_NAMES[i]: (int(x), int(y))
+                                         for i, (x, y) in enumerate(self.landmarks) if self.valid >> i & 1}}
+
+    def valid_mask(self):
+        """
+        :return: (35,) bool array, True where the landmark was found
+        """
+        return (self.valid & _BITS) != 0
+
+    def has(self, name):
+        """
+        :param name: a landmark name from LANDMARK_NAMES
+        :return: True if the landmark was found
+        """
+        return bool(self.valid >> LANDMARK_INDEX[name] & 1)
+
+    def points(self, indices):
+        """
+        :param indices: array of landmark indices, e.g. LEFT_EYE_LANDMARKS
+        :return: (n, 2) int32 array of the positions of those landmarks that were found
+        """
+        return self.landmarks[indices[self.valid_mask()[indices]]]
+
+    def eyes(self):
+        """
+        :return: tuple of (n, 2) arrays of the left eye and right eye landmarks that were found
+        """
+        return self.points(LEFT_EYE_LANDMARKS), self.points(RIGHT_EYE_LANDMARKS)
+
+    def bound(self):
+        """
+        :return: the (4, 2) outer bounding poly, the inner one if there is no outer one, or None
+                 if the face has neither. Both list their corners in BOUND_CORNERS order.
+        """
+        return self.outer if self.outer is not None else self.inner
+
+    def box(self):
+        """
+        :return: (x0, y0, x1, y1) spanned by bound(), or None if the face has no bounding poly
+        """
+        vertices = self.bound()
+        if vertices is None or not len(vertices):
+            return None
+        x0, y0 = vertices.min(axis=0)
+        x1, y1 = vertices.max(axis=0)
+        return int(x0), int(y0), int(x1), int(y1)
+
+    def shifted(self, dx, dy):
+        """
+        :return: a new Face with every point moved by (dx, dy)
+        """
+        offset = np.array((dx, dy), dtype=np.int32)
+        return Face(self.landmarks + offset, self.valid,
+                    None if self.outer is None else self.outer + offset,
+                    None if self.inner is None else self.inner + offset)
+
+    def scaled(self, scale):
+        """
+        :return: a new Face with every point multiplied by scale and rounded
+        """
+        def scale_points(points):
+            return None if points is None else np.rint(points * scale).astype(np.int32)
+
+        return Face(scale_points(self.landmarks), self.valid, scale_points(self.outer), scale_points(self.inner))
+
+    def __eq__(self, other):
+        return (isinstance(other, Face) and self.valid == other.valid and
+                np.array_equal(self.landmarks[self.valid_mask()], other.landmarks[other.valid_mask()]) and
+                _same(self.outer, other.outer) and _same(self.inner, other.inner))
+
+    def __repr__(self):
+        return 'Face(box=%r, landmarks=%d)' % (self.box(), bin(self.valid).count('1'))
+
+
+def _vertices(vertices):
+    if vertices is None:
+        return None
+    return np.array([(int(x), int(y)) for x, y in vertices], dtype=np.int32).reshape(-1, 2)
+
+
+def _same(a, b):
+    if a is None or b is None:
+        return a is b
+    return np.array_equal(a, b)
+
+
+def as_face(feature):
+    """
+    :param feature: a Face, or a feature dictionary in the old format
+    :return: a Face (None stays None)
+    """
+    if feature is None or isinstance(feature, Face):
+        return feature
+    return Face.from_dict(feature)
+
+
+def to_dicts(faces):
+    """
+    :param faces: list of Faces, or None
+    :return: the faces as feature dictionaries, for JSON
+    """
+    return None if faces is None else [face.to_dict() for face in faces]
+
+
+def from_dicts(features):
+    """
+    :param features: list of feature dictionaries (or Faces), or None
+    :return: list of Faces
+    """
+    return None if features is None else [as_face(feature) for feature in features]
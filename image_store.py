@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Store of decoded images, so the same JPEG is only ever decoded once.
+
+A batch swaps the same user photo onto hundreds of memes and the popular
+memes come back again and again; decoding them costs more than most of the
+swap. ImageStore keeps each decoded image as a .npy file named after the
+SHA-256 of the encoded file (see annotation_cache.file_key()) and hands out
+read-only numpy.memmap views of it, so nothing is decoded or copied on a hit
+and every process reading the same image, e.g. Pipeline.render_memes()'s
+workers, shares the same pages of the OS cache. When the files pass max_bytes
+the least recently used are removed; a process that still has one mapped
+keeps its view.
+
+Example Usage:
+    store = ImageStore('.cache/pixels')
+    im = store.imread('photos/aaron.jpg')  # decoded the first time only
+    im.flags.writeable  # False, copy it before drawing on it
+"""
+import os
+import threading
+
+import cv2
+import numpy as np
+
+import metrics
+from annotation_cache import DiskIndex, file_key
+
+SCHEMA_VERSION = 1
+
+
+class ImageStore:
+    def __init__(self, directory='.cache/pixels', max_bytes=1024 * 1024 * 1024):
+        """
+        :param directory: folder the decoded images are kept in, created if missing
+        :param max_bytes: total size of the decoded images to keep before evicting
+        """
+        self.directory = os.path.join(directory, 'v%d' % SCHEMA_VERSION)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = DiskIndex(self.directory, '.npy', max_bytes)
+
+    def imread(self, path, flags=cv2.IMREAD_COLOR):
+        """
+        cv2.imread() that decodes each file only once.
+        :param path: path of an encoded image
+        :param flags: cv2.IMREAD_* flags the image is decoded with
+        :return: read-only numpy.memmap of the decoded image, or None if it cannot be decoded
+        """
+        key = '%s-%d' % (file_key(path), flags)
+        image = self.get(key)
+        if image is not None:
+            metrics.count('image_store_hits')
+            return image
+        metrics.count('image_store_misses')
+        with metrics.span('decode'):
+            image = cv2.imread(path, flags)
+        if image is None:
+            return None
+        return self.put(key, image)
+
+    def get(self, key):
+        """
+        :param key: see imread()
+        :return: read-only numpy.memmap of the stored image, or None on a miss
+        """
+        path = self._index.path(key)
+        with self._lock:
+            if key not in self._index:
+                # another process may have stored it since the index was built
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    return None
+                self._index.add(key, size)
+            self._index.touch(key)
+        try:
+            image = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):  # evicted by another process, or a broken file
+            with self._lock:
+                if key in self._index:
+                    self._index.drop(key)
+            return None
+        return image
+
+    def put(self, key, image):
+        """
+        Store a decoded image and evict old ones if needed.
+        :param key: see imread()
+        :param image: the decoded image as np.array
+        :return: read-only numpy.memmap of the stored copy
+        """
+        path = self._index.path(key)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as entry_file:
+            np.save(entry_file, np.ascontiguousarray(image))
+        with self._lock:
+            os.replace(tmp, path)
+            self._index.add(key, os.path.getsize(path))
+            self._index.evict(keep=key)
+        return np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self._index)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+In-process job queue for work that is too slow to do inside a web request.
+Submitting returns straight away with a Job whose status can be polled, a
+fixed pool of worker threads runs the jobs, and once max_pending jobs are
+waiting further submissions are refused with QueueFull instead of piling up.
+
+Example Usage:
+    queue = JobQueue(run=lambda job: do_work(*job.payload), workers=2, max_pending=16)
+    job = queue.submit(arg1, arg2)
+    ...
+    queue.get(job.id).status  # 'queued', 'running', 'done' or 'failed'
+"""
+import collections
+import queue
+import threading
+import time
+import uuid
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, payload):
+        """
+        :param payload: tuple of arguments for the job, see JobQueue.submit()
+        """
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        """
+        :return: JSON friendly description of the job (without its payload or result)
+        """
+        return {'id': self.id, 'status': self.status, 'error': self.error,
+                'created': self.created, 'finished': self.finished}
+
+
+class JobQueue:
+    def __init__(self, run, workers=2, max_pending=16, keep=256):
+        """
+        :param run: called with each Job; its return value becomes job.result and
+                    an exception marks the job failed
+        :param workers: number of worker threads; with 0 nothing runs until run_next() is called,
+                        which lets tests step through jobs in their own thread
+        :param max_pending: most jobs waiting to run before submit() raises QueueFull
+        :param keep: number of finished jobs remembered for get()
+        """
+        self.run = run
+        self.keep = keep
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._jobs = collections.OrderedDict()
+        self._finished = collections.deque()
+        self._lock = threading.Lock()
+        self._threads = []
+        for n in range(workers):
+            thread = threading.Thread(target=self._work, name='job-worker-%d' % n, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, *payload):
+        """
+        Queue a job.
+        :param payload: arguments for the job, available to run() as job.payload
+        :return: the new Job
+        :raises QueueFull: if max_pending jobs are already waiting
+        """
+        job = Job(payload)
+        with self._lock:
+            try:
+                self._pending.put_nowait(job)
+            except queue.Full:
+                raise QueueFull("%d jobs already waiting" % self._pending.maxsize)
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        """
+        :param job_id: id of a submitted job
+        :return: the Job, or None if it is unknown or has been forgotten
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        """
+        :return: number of jobs waiting to run
+        """
+        return self._pending.qsize()
+
+    def run_next(self, timeout=None):
+        """
+        Run the next waiting job in the calling thread.
+        :param timeout: seconds to wait for a job, None to wait forever
+        :return: the Job that was run, or None if none arrived in time
+        """
+        try:
+            job = self._pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        job.status = RUNNING
+        try:
+            job.result = self.run(job)
+            job.status = DONE
+        except Exception as e:
+            job.error = "%s: %s" % (type(e).__name__, e)
+            job.status = FAILED
+        job.finished = time.time()
+        job.payload = None  # the inputs can be large, drop them once they are used
+        self._forget_old(job)
+        return job
+
+    def _work(self):
+        while True:
+            self.run_next()
+
+    def _forget_old(self, job):
+        with self._lock:
+            self._finished.append(job.id)
+            while len(self._finished) > self.keep:
+                self._jobs.pop(self._finished.popleft(), None)
@@ -3,76 +3,218 @@
 Module for querying reddit for 2018's top classy memes, for use in swapping faces.
 
 Example Usage:
+    reddit = get_secrets('cert.txt')
+    gen = MemeGenerator(reddit, ['wholesomememes', 'memes'], limit=25, state_path='.cache/reddit.json')
+    paths = download_imgs([submission.url for submission in gen.get_memes(10)])
 
 Todo:
     * For todos.
 
 """
 
+import collections
+import html
+import itertools
+import json
+import logging
 import os, sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import praw
 import requests, urllib.parse as parse, urllib
 import urllib.request as urlrequest
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import cv2
 
+import metrics
+
+logger = logging.getLogger(__name__)
+
 img_folder = "images/"
 valid_img = ["png", "bmp", "jpg", "jpeg"]
 
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_TIMEOUT = (5, 30)  # (connect, read) seconds
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+STATE_VERSION = 1
+SEEN_MAX = 10000           # submission IDs remembered by MemeGenerator
+MAX_PAGES_PER_CALL = 20    # pages get_memes() reads before giving up on finding num new ones
+
 class MemeGenerator:
-    def __init__(self, reddit, subreddit, limit=25):
+    def __init__(self, reddit, subreddit, limit=25, state_path=None, prefetch=True):
         """
         Args:
             reddit (praw.reddit): an instance of PRAW that has been successfully authenticated,
                                   or in read-only mode.
-            subreddit (string): the name of the subreddit to browse
-            limit (int): the number of hottest submissions to retain
+            subreddit (string): the name of the subreddit to browse, or a list of names whose
+                                hot feeds are interleaved
+            limit (int): the number of hot submissions fetched from each subreddit per page
+            state_path (str): JSON file the paging cursors and seen submission IDs are kept in
+                              between runs; None to start from the top every time. The saved
+                              cursor of a subreddit is the last submission get_memes() returned
+                              from it, so those still queued are listed again by the next run.
+            prefetch (bool): fetch the next page in the background after get_memes() returns
 
         """
         if reddit == None:
             raise ValueError("reddit auth cannot be null")
 
         self.reddit = reddit
-        self.subreddit = reddit.subreddit(subreddit)
+        names = [subreddit] if isinstance(subreddit, str) else list(subreddit)
+        self.subreddits = [(name, reddit.subreddit(name)) for name in names]
 
         self.limit = limit
+        self.state_path = state_path
         self.hot_entries = []
+        self._lock = threading.Lock()
+        self.cursors = {}   # subreddit name -> fullname of the last submission paged past
+        self.returned = {}  # subreddit name -> fullname of the last submission handed out
+        self._listed_from = {}  # ID of each submission in hot_entries -> its subreddit's name
+        self.seen = collections.OrderedDict()  # IDs of submissions already handed out
+        self._load_state()
+        self._prefetch = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self._next_page = None
 
     def get_memes(self, num=1):
         """
-        Get the next top meme/image from /r/subreddit.
+        Get the next top memes/images from the subreddits. Submissions handed out before,
+        in this run or a previous one with the same state_path, are skipped.
 
         Args:
             num (int): number of memes to pop off
 
         Returns:
-            str: the next image as a URL from /r/subreddit.
+            list: up to num submissions; fewer only when the subreddits have no more new ones.
         """
-        if not self.hot_entries: # NOTE: we populate hot_entries on demand
-            self.load_memes()
-
-        hot = []
-        if len(self.hot_entries) < num:
-            hot = self.hot_entries
-            self.hot_entries = []
-            return self.hot_entries
+        pages = 0
+        wrapped = set()  # subreddits whose listing ran out during this call
+        while len(self.hot_entries) < num and pages < MAX_PAGES_PER_CALL:
+            pages += 1
+            added, exhausted = self.load_memes()
+            # every listing had been read to its end, and starting over found nothing new
+            if not added and len(wrapped) == len(self.subreddits):
+                break
+            wrapped.update(exhausted)
 
         hot = self.hot_entries[:num]
         self.hot_entries = self.hot_entries[num:]
-
+        with self._lock:
+            for submission in hot:
+                self.seen[submission.id] = True
+                self.returned[self._listed_from.pop(submission.id)] = _fullname(submission)
+            while len(self.seen) > SEEN_MAX:
+                self.seen.popitem(last=False)
+        self.save_state()
+
+        # a page is only worth fetching ahead if the queue will run dry soon
+        if (self._prefetch is not None and self._next_page is None and
+                len(self.hot_entries) < self.limit * len(self.subreddits)):
+            self._next_page = self._prefetch.submit(self._fetch_page)
         return hot
 
     def load_memes(self):
         """
-        Load the hot_entries list with the newest set of entries, and stores it
-        within the internal self.hot_entries list.
+        Add the next page of every subreddit to the internal self.hot_entries list,
+        interleaved one submission from each subreddit at a time. Only submissions
+        not seen or queued before are added.
+
+        Returns:
+            tuple: the number of submissions added, and the set of names of the subreddits
+                   whose listing ran out (they start again from the top next time)
+        """
+        if self._next_page is not None:
+            future, self._next_page = self._next_page, None
+            pages = future.result()
+        else:
+            pages = self._fetch_page()
+
+        queued = set(submission.id for submission in self.hot_entries)
+        with self._lock:
+            seen = set(self.seen)
+        added = 0
+        for column in itertools.zip_longest(*pages):
+            for (name, _), submission in zip(self.subreddits, column):
+                if submission is None or submission.id in seen or submission.id in queued:
+                    continue
+                queued.add(submission.id)
+                self.hot_entries.append(submission)
+                self._listed_from[submission.id] = name
+                added += 1
+        metrics.count('memes_listed', added)
+        return added, set(name for (name, _), page in zip(self.subreddits, pages) if not page)
+
+    def _fetch_page(self):
+        """
+        Fetch one page of the hot feed of each subreddit, after its cursor, and move the cursors on.
+        A subreddit whose listing has run out starts again from the top next time, where any new
+        submissions are.
 
-        NOTE: This means that some entries may end up being re-queried (depending
-        on what images are new; essentially, refresh the hot_entries queue.)
+        Returns:
+            list: a list of submissions per subreddit
+        """
+        pages = []
+        with metrics.span('reddit_listing'):
+            for name, subreddit in self.subreddits:
+                with self._lock:
+                    after = self.cursors.get(name)
+                params = {'after': after} if after else {}
+                page = list(subreddit.hot(limit=self.limit, params=params))
+                with self._lock:
+                    if page:
+                        self.cursors[name] = _fullname(page[-1])
+                    else:
+                        self.cursors.pop(name, None)
+                pages.append(page)
+        return pages
+
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        with open(self.state_path, 'r') as state_file:
+            state = json.load(state_file)
+        if state.get('version') != STATE_VERSION:
+            return
+        self.cursors = {name: after for name, after in state['cursors'].items()
+                        if name in dict(self.subreddits)}
+        self.returned = dict(self.cursors)
+        self.seen = collections.OrderedDict((submission_id, True) for submission_id in state['seen'])
+
+    def save_state(self):
+        """
+        Write the cursors and seen submission IDs to state_path, if there is one. The cursors
+        saved are those of the submissions handed out, not of the pages fetched: the queued
+        and prefetched submissions past them are not handed out yet.
+        """
+        if not self.state_path:
+            return
+        with self._lock:
+            state = {'version': STATE_VERSION, 'cursors': dict(self.returned), 'seen': list(self.seen)}
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp, self.state_path)
+
+    def close(self):
+        """
+        Stop prefetching. Waits for a page that is being fetched.
         """
+        if self._prefetch is not None:
+            self._prefetch.shutdown(wait=True)
+            self._prefetch = None
+        self._next_page = None
 
-        for submission in self.subreddit.hot(limit=self.limit):
-            self.hot_entries.append(submission)
+def _fullname(submission):
+    """
+    The fullname ('t3_' + ID) reddit pages a listing after.
+    """
+    return getattr(submission, 'fullname', None) or 't3_' + submission.id
 
 def get_secrets(cert_path):
     """
@@ -108,16 +250,17 @@ def get_secrets(cert_path):
 
     return reddit
 
-def download_img(url, tgt=None):
+def _target_path(url, tgt=None, folder=img_folder):
     """
-    Download the image at the URL.
+    Work out where the image at the URL is saved.
 
     Args:
         url (str): a URL, formatted https://*.*/*.jpg
         tgt (str): a filename to save to. If None, we use the basename of url
+        folder (str): the folder tgt is placed in when tgt is None
 
     Returns:
-        The path to the downloaded image; None if there is no image.
+        The path to save to; None if the URL is not an image.
     """
     parse_url = parse.urlparse(url)
     if not bool(parse_url.scheme):
@@ -125,7 +268,7 @@ def download_img(url, tgt=None):
         raise ValueError("url is invalid")
 
     if not tgt:
-        tgt = img_folder + os.path.basename(parse_url.path)
+        tgt = os.path.join(folder, os.path.basename(parse_url.path))
 
     os.makedirs(os.path.dirname(tgt), exist_ok=True)
 
@@ -133,7 +276,26 @@ def download_img(url, tgt=None):
     if tgt[tgt.rfind(".") + 1:] not in valid_img:
         return None
 
-    urlrequest.urlretrieve(url, tgt)
+    return tgt
+
+def download_img(url, tgt=None):
+    """
+    Download the image at the URL.
+
+    Args:
+        url (str): a URL, formatted https://*.*/*.jpg
+        tgt (str): a filename to save to. If None, we use the basename of url
+
+    Returns:
+        The path to the downloaded image; None if there is no image.
+    """
+    tgt = _target_path(url, tgt)
+    if tgt is None:
+        return None
+
+    with metrics.span('download'):
+        urlrequest.urlretrieve(url, tgt)
+    metrics.count('images_fetched')
     if tgt[tgt.rfind('.'):] != '.jpg':
         return None
         # TODO:
@@ -149,6 +311,153 @@ def download_img(url, tgt=None):
         
     return tgt
 
+def make_session(pool_size=DOWNLOAD_WORKERS, retries=DOWNLOAD_RETRIES):
+    """
+    Make a requests session whose connections are kept alive and reused,
+    with up to pool_size open connections per host.
+
+    Args:
+        pool_size (int): connections kept per host, match this to the number of workers
+        retries (int): retries for connection errors and 429/5xx responses
+
+    Returns:
+        a requests.Session
+    """
+    retry = Retry(total=retries, backoff_factor=0.5,
+                  status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_img(session, url, tgt, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Stream the image at the URL to tgt in chunks. The body is written to a
+    temporary file first, so tgt never holds a partial download.
+
+    Args:
+        session (requests.Session): see make_session()
+        url (str): a URL, formatted https://*.*/*.jpg
+        tgt (str): a filename to save to
+        timeout (tuple): (connect, read) timeouts in seconds
+    """
+    part = "%s.%d.part" % (tgt, threading.get_ident())
+    try:
+        with session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            with open(part, 'wb') as part_file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    part_file.write(chunk)
+        os.replace(part, tgt)
+    except BaseException:
+        # a failed or interrupted download leaves nothing behind in the image folder
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+        raise
+
+def download_imgs(urls, folder=img_folder, workers=DOWNLOAD_WORKERS,
+                  timeout=DOWNLOAD_TIMEOUT, retries=DOWNLOAD_RETRIES, session=None):
+    """
+    Download a batch of images concurrently. Saves to the same paths as
+    download_img() would.
+
+    Args:
+        urls (list): URLs, formatted https://*.*/*.jpg
+        folder (str): the folder to save into
+        workers (int): the most downloads running at once
+        timeout (tuple): (connect, read) timeouts in seconds
+        retries (int): retries per URL for connection errors and 429/5xx responses
+        session (requests.Session): session to reuse; one is made if None
+
+    Returns:
+        A list the same length as urls with the path to each downloaded image;
+        None where there is no image or the download failed.
+    """
+    if session is None:
+        session = make_session(workers, retries)
+
+    def download(url):
+        return download_with(session, url, folder, timeout)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(download, urls))
+
+def download_with(session, url, folder=img_folder, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Download one image over a shared session, saving to the same path as download_img() would.
+
+    Args:
+        session (requests.Session): see make_session()
+        url (str): a URL, formatted https://*.*/*.jpg
+        folder (str): the folder to save into
+        timeout (tuple): (connect, read) timeouts in seconds
+
+    Returns:
+        The path to the downloaded image; None if there is no image or the download failed.
+    """
+    try:
+        tgt = _target_path(url, folder=folder)
+    except ValueError:
+        return None
+    if tgt is None:
+        return None
+    try:
+        with metrics.span('download'):
+            fetch_img(session, url, tgt, timeout)
+    except (requests.RequestException, OSError) as e:
+        metrics.count('download_failures')
+        logger.warning("Failed to download %s: %s", url, e)
+        return None
+    metrics.count('images_fetched')
+    if tgt[tgt.rfind('.'):] != '.jpg':
+        return None  # see download_img
+    return tgt
+
+def preview_url(submission):
+    """
+    Find the smallest preview image reddit made for a submission. It is a few
+    kilobytes, enough to recognize an image we already have without downloading it.
+
+    Args:
+        submission (praw.models.Submission): a submission from MemeGenerator.get_memes()
+
+    Returns:
+        The URL of the preview; None if the submission has none.
+    """
+    try:
+        resolutions = submission.preview['images'][0]['resolutions']
+    except (AttributeError, KeyError, IndexError, TypeError):
+        return None
+    if not resolutions:
+        return None
+    # reddit HTML-escapes the query string of preview URLs
+    return html.unescape(resolutions[0]['url'])
+
+def fetch_bytes(session, url, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Download a small file into memory.
+
+    Args:
+        session (requests.Session): see make_session()
+        url (str): the URL to fetch
+        timeout (tuple): (connect, read) timeouts in seconds
+
+    Returns:
+        The body; None if the download failed.
+    """
+    try:
+        with metrics.span('fetch_bytes'):
+            response = session.get(url, timeout=timeout)
+            response.raise_for_status()
+    except requests.RequestException:
+        metrics.count('download_failures')
+        return None
+    return response.content
+
 if __name__ == "__main__":
     # test case:
     reddit = get_secrets('cert.txt')
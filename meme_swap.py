@@ -1,11 +1,145 @@
-import os
 
+import base64
+import binascii
+import glob
+import hashlib
+import random
+import threading
+import time
+
+import cv2
+import numpy as np
 from flask import Flask
 from flask import request
 from flask import render_template
 from flask import jsonify
+from flask import Response
+from flask import url_for
+
+import jobs
+import metrics
+import render_cache
 
 app = Flask(__name__)
+app.config.update(
+    DETECTOR='cloud',      # face detector backend used by the swap jobs, see detectors.py
+    JOB_WORKERS=2,         # swaps running at once
+    JOB_QUEUE_SIZE=16,     # swaps waiting before /upload answers 429
+    MEME_GLOB='images/*.jpg',
+    MAX_CONTENT_LENGTH=4 * 1024 * 1024,  # largest upload accepted, bigger ones get 413
+)
+
+# request bodies that are the image itself rather than a form
+RAW_UPLOAD_TYPES = ('image/jpeg', 'image/png', 'application/octet-stream')
+
+# totals of everything recorded through metrics.py in this process, served at /metrics
+app.extensions['metrics'] = metrics.add_sink(metrics.PrometheusSink())
+
+# held while get_pipeline() and get_job_queue() create what they share, so concurrent first
+# requests all get the same one
+_extensions_lock = threading.Lock()
+
+
+def get_pipeline():
+    """
+    The Pipeline used by swap jobs, created on first use so the app starts without a detector.
+    """
+    if 'pipeline' not in app.extensions:
+        with _extensions_lock:
+            if 'pipeline' not in app.extensions:
+                import pipeline
+                app.extensions['pipeline'] = pipeline.Pipeline(detector=app.config['DETECTOR'])
+    return app.extensions['pipeline']
+
+
+def get_job_queue():
+    """
+    The app's jobs.JobQueue, created on first use. Tests can put their own in
+    app.extensions['job_queue'] (e.g. one with no worker threads).
+    """
+    if 'job_queue' not in app.extensions:
+        with _extensions_lock:
+            if 'job_queue' not in app.extensions:
+                app.extensions['job_queue'] = jobs.JobQueue(run_swap,
+                                                            workers=app.config['JOB_WORKERS'],
+                                                            max_pending=app.config['JOB_QUEUE_SIZE'])
+    return app.extensions['job_queue']
+
+
+def result_key(content, meme_path, options):
+    """
+    :param content: bytes of the user's image
+    :param meme_path: path of the meme
+    :param options: the swap settings, see pipeline.swap_options(). Both images' faces come from
+                    the pipeline's detector, whose settings are part of the key.
+    :return: the render_cache key of the swap, or None if the pipeline has no render cache
+    """
+    swapper = get_pipeline()
+    if swapper.render_cache is None:
+        return None
+    return render_cache.render_key(render_cache.file_key(meme_path), hashlib.sha256(content).hexdigest(),
+                                   swapper.render_params(options, format='.jpg'))
+
+
+def run_swap(job):
+    """
+    Swap the face in an uploaded image onto a meme, or read the result back from the render
+    cache. Jobs for the same swap that run at the same time render it only once.
+    :param job: jobs.Job whose payload is (bytes of the user's image, path of the meme,
+                pipeline.swap_options(), result_key())
+    :return: the swapped meme as JPEG bytes
+    """
+    content, meme_path, options, key = job.payload
+    metrics.observe('job_wait_seconds', time.time() - job.created)
+    swapper = get_pipeline()
+    if key is None:
+        return render_swap(content, meme_path, options)
+    return swapper.render_cache.get_or_render(key, lambda: render_swap(content, meme_path, options))
+
+
+def render_swap(content, meme_path, options):
+    """
+    Swap the face in an uploaded image onto a meme. The upload is decoded and analyzed
+    straight from memory, it is never written to disk.
+    :param content: bytes of the user's image
+    :param meme_path: path of the meme
+    :param options: the swap settings, see pipeline.swap_options()
+    :return: the swapped meme as JPEG bytes
+    """
+    import pipeline
+    swapper = get_pipeline()
+    user_image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if user_image is None:
+        raise ValueError("the upload is not an image")
+    user_faces = swapper.detector.find_faces_bytes(content)
+    if not user_faces:
+        raise ValueError("no face found in the uploaded image")
+    meme_faces = swapper.detector.find_faces(meme_path)
+    if not meme_faces:
+        raise ValueError("no face found in %s" % meme_path)
+    image = pipeline.swap_meme(meme_path, user_image, meme_faces, user_faces,
+                               source_key=hashlib.sha256(content).hexdigest(), **options)
+    return render_cache.encode(image, '.jpg')
+
+
+def read_upload():
+    """
+    Get the bytes of the uploaded image. It can be sent as the raw request body
+    (image/jpeg, image/png or application/octet-stream), as a multipart 'file' part, or, as
+    older pages did, as a base64 data URI in the 'file' form field. Flask answers 413 to
+    anything over MAX_CONTENT_LENGTH before it is read.
+    :return: bytes of the encoded image, or None if there is none
+    :raises binascii.Error: if the form field is not valid base64
+    """
+    if request.mimetype in RAW_UPLOAD_TYPES:
+        return request.get_data(cache=False) or None
+    if 'file' in request.files:
+        return request.files['file'].read() or None
+    if 'file' in request.form:
+        # 'data:image/jpeg;base64,...' as sent by webcam.js
+        return base64.b64decode(request.form['file'].split(',', 1)[-1], validate=True) or None
+    return None
+
 
 @app.route('/', methods=['GET'])
 def meme_swap():
@@ -14,13 +148,75 @@ def meme_swap():
 @app.route('/upload', methods=['GET', 'POST'])
 def upload():
     if request.method == 'POST':
-        filename = request.form['file']
+        try:
+            content = read_upload()
+        except binascii.Error:
+            return jsonify(error="the upload is not valid base64"), 400
+        if content is None:
+            return jsonify(error="no image uploaded"), 400
+        memes = glob.glob(app.config['MEME_GLOB'])
+        if not memes:
+            return jsonify(error="no memes to swap onto yet"), 503
+        meme_path = request.args.get('meme') or request.form.get('meme') or random.choice(memes)
+        if meme_path not in memes:
+            return jsonify(error="unknown meme"), 400
+
+        # the settings are read once, so the cache key and the render always agree
+        import pipeline
+        options = pipeline.swap_options()
+        # the same face on the same meme is served from the render cache without queueing a job
+        key = result_key(content, meme_path, options)
+        if key is not None and get_pipeline().render_cache.get(key) is not None:
+            return jsonify(status=jobs.DONE, result_url=url_for('render_result', key=key))
 
-        print(filename)
+        try:
+            job = get_job_queue().submit(content, meme_path, options, key)
+        except jobs.QueueFull:
+            metrics.count('jobs_rejected')
+            return jsonify(error="too many swaps in progress, try again shortly"), 429
+        metrics.count('jobs_submitted')
 
-        return jsonify(request.form['file'])
+        return jsonify(job_id=job.id, status=job.status,
+                       status_url=url_for('job_status', job_id=job.id)), 202
 
     return render_template("meme_snap.html")
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify(error="unknown job"), 404
+
+    status = job.to_dict()
+    if job.status == jobs.DONE:
+        status['result_url'] = url_for('job_result', job_id=job.id)
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify(error="unknown job"), 404
+    if job.status != jobs.DONE:
+        return jsonify(job.to_dict()), 409
+
+    return Response(job.result, mimetype='image/jpeg')
+
+@app.route('/renders/<key>', methods=['GET'])
+def render_result(key):
+    cache = get_pipeline().render_cache
+    data = cache.get(key) if cache is not None else None
+    if data is None:
+        return jsonify(error="unknown render"), 404
+
+    # a key names one exact render, it never changes
+    response = Response(data, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_text():
+    return Response(app.extensions['metrics'].render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run(debug=True)
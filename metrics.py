@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Counters, histograms and span timers for finding out where a batch spends its
+time: the reddit listing, the downloads, the face detector or the swap math.
+
+Code records measurements with count(), observe() and span(), and they are
+handed to every registered sink. With no sinks registered recording does
+nothing, so instrumented hot loops cost next to nothing by default. Three
+sinks are provided: LogSink writes each measurement to a logger,
+PrometheusSink keeps running totals and renders them in the Prometheus text
+format (the Flask app serves it at /metrics), and MemorySink keeps every
+measurement for tests to inspect.
+
+Sinks live in the process that registered them, so swaps run by
+Pipeline.render_memes() in worker processes are not recorded.
+
+Example Usage:
+    sink = metrics.add_sink(metrics.MemorySink())
+    with metrics.span('download'):
+        ...
+    metrics.count('images_fetched')
+    sink.total('images_fetched')  # 1
+"""
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+# upper bounds of the histogram buckets, in seconds for spans
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# every name is prefixed with this in the Prometheus output
+NAMESPACE = 'memeswap'
+
+_sinks = ()
+_sinks_lock = threading.Lock()
+
+
+class Sink:
+    """
+    Receives every measurement. Subclasses implement record(), which can be called
+    from several threads at once.
+    """
+
+    def record(self, kind, name, value, labels):
+        """
+        :param kind: COUNTER or HISTOGRAM
+        :param name: name of the metric, e.g. 'images_fetched' or 'download_seconds'
+        :param value: amount added to a counter, or the observed value
+        :param labels: dict of label name -> value, e.g. {'backend': 'cloud'}
+        """
+        raise NotImplementedError
+
+
+class LogSink(Sink):
+    def __init__(self, logger=None, level=logging.DEBUG):
+        """
+        :param logger: logging.Logger to write to, defaults to the 'metrics' logger
+        :param level: level the measurements are logged at
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def record(self, kind, name, value, labels):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, "%s %s=%g %s", kind, name, value,
+                            ' '.join('%s=%s' % item for item in sorted(labels.items())))
+
+
+class MemorySink(Sink):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = []  # (kind, name, value, labels) in the order they were recorded
+
+    def record(self, kind, name, value, labels):
+        with self._lock:
+            self.records.append((kind, name, value, labels))
+
+    def values(self, name, **labels):
+        """
+        :param name: name of the metric
+        :param labels: only measurements with these labels are returned
+        :return: list of the recorded values
+        """
+        with self._lock:
+            return [value for _, record_name, value, record_labels in self.records
+                    if record_name == name and all(record_labels.get(k) == v for k, v in labels.items())]
+
+    def total(self, name, **labels):
+        """
+        :return: sum of the recorded values, e.g. a counter's count
+        """
+        return sum(self.values(name, **labels))
+
+    def clear(self):
+        with self._lock:
+            del self.records[:]
+
+
+class PrometheusSink(Sink):
+    def __init__(self, buckets=DEFAULT_BUCKETS, namespace=NAMESPACE):
+        """
+        :param buckets: upper bounds of the histogram buckets
+        :param namespace: prefix of every metric name
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> total
+        self._histograms = {}  # (name, labels) -> [count per bucket, sum, count]
+
+    def record(self, kind, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if kind == COUNTER:
+                self._counters[key] = self._counters.get(key, 0) + value
+                return
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), total in counters:
+            name = '%s_%s_total' % (self.namespace, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, _labels(labels), _number(total)))
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            name = '%s_%s' % (self.namespace, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', _number(bound)),)), cumulative))
+            lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (name, _labels(labels), _number(total)))
+            lines.append('%s_count%s %d' % (name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{%s}' % ','.join('%s="%s"' % (k, v) for (k, _), v in zip(labels, escaped))
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def add_sink(sink):
+    """
+    Start sending measurements to a sink.
+    :param sink: a Sink
+    :return: the sink
+    """
+    global _sinks
+    with _sinks_lock:
+        if sink not in _sinks:
+            _sinks = _sinks + (sink,)
+    return sink
+
+
+def remove_sink(sink):
+    """
+    Stop sending measurements to a sink.
+    """
+    global _sinks
+    with _sinks_lock:
+        _sinks = tuple(s for s in _sinks if s is not sink)
+
+
+def count(name, value=1, **labels):
+    """
+    Add to a counter.
+    :param name: name of the counter, e.g. 'images_fetched'
+    :param value: amount to add
+    :param labels: labels of the measurement, e.g. backend='cloud'
+    """
+    for sink in _sinks:
+        sink.record(COUNTER, name, value, labels)
+
+
+def observe(name, value, **labels):
+    """
+    Add a value to a histogram.
+    :param name: name of the histogram, e.g. 'vision_batch_images'
+    :param value: the observed value
+    :param labels: labels of the measurement
+    """
+    for sink in _sinks:
+        sink.record(HISTOGRAM, name, value, labels)
+
+
+@contextlib.contextmanager
+def span(name, **labels):
+    """
+    Time a block and observe its duration in seconds in the histogram '<name>_seconds'.
+    The duration is recorded even if the block raises.
+    :param name: name of the span, e.g. 'download'
+    :param labels: labels of the measurement
+    """
+    if not _sinks:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name + '_seconds', time.perf_counter() - start, **labels)
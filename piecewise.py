@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Piecewise-affine warp of one face onto another over a Delaunay triangulation
+of their landmarks.
+
+faceSwap2.transformation_from_points() fits one similarity transform to the
+corners of the two face boxes, so the eyes, nose and mouth only line up as
+well as the boxes do. Here the source face's landmarks that the target also
+has, the corners of its bounding poly and a ring around them are
+triangulated with cv2.Subdiv2D, and every triangle gets its own affine
+transform onto the matching triangle of the target face, so each landmark
+lands exactly on its counterpart. The ring is placed where the similarity
+transform would put it, so the warp blends into the similarity transform at
+the ring and is exactly that transform everywhere outside it.
+
+The triangulation only depends on the source face and on which landmarks are
+used, so Triangulation objects are built once per source face and kept on
+faceSwap2.PreparedFace. Warping is one cv2.remap() over the box the triangles
+cover: the triangles are rasterized into a label map, each within its own
+bounding box, and the source coordinates of every pixel are computed at once
+from its triangle's transform.
+
+Example Usage:
+    triangulation = Triangulation(source_face, common_mask)
+    points1 = triangulation.target_points(target_face, M)
+    maps = warp_maps(triangulation, points1, M, target_image.shape)
+    warped = warp(source_image, M, maps, target_image.shape)
+"""
+import cv2
+import numpy as np
+
+# how far the ring of extra control points lies outside the face box, as a fraction of its size
+RING_FRAC = 0.25
+
+
+class Triangulation:
+    def __init__(self, face, valid):
+        """
+        :param face: face_record.Face of the source face, with a bounding poly (see Face.bound())
+        :param valid: (35,) bool array of the landmarks to use, those the target face also has
+        """
+        self.indices = np.flatnonzero(valid & face.valid_mask())
+        outer = face.bound().astype(np.float64)
+        x0, y0 = outer.min(axis=0)
+        x1, y1 = outer.max(axis=0)
+        pad = RING_FRAC * max(x1 - x0, y1 - y0, 1)
+        ring = np.array([(x0 - pad, y0 - pad), (x1 + pad, y0 - pad), (x1 + pad, y1 + pad), (x0 - pad, y1 + pad),
+                         ((x0 + x1) / 2, y0 - pad), (x1 + pad, (y0 + y1) / 2),
+                         ((x0 + x1) / 2, y1 + pad), (x0 - pad, (y0 + y1) / 2)])
+        # source points: landmarks, then the outer poly, then the ring
+        self.points = np.vstack([face.landmarks[self.indices].astype(np.float64), outer, ring])
+        self.ring = ring
+        self.triangles = triangulate(self.points)
+
+    def target_points(self, face, M):
+        """
+        :param face: face_record.Face of the target face, with the landmarks in self.indices
+        :param M: transformation matrix from the target image to the source image, see
+                  faceSwap2.transformation_from_points
+        :return: (n, 2) array of the target's points, matching self.points
+        """
+        ring = np.linalg.inv(np.asarray(M, dtype=np.float64))
+        ring = self.ring.dot(ring[:2, :2].T) + ring[:2, 2]
+        return np.vstack([face.landmarks[self.indices].astype(np.float64),
+                          face.bound().astype(np.float64), ring])
+
+
+def triangulate(points):
+    """
+    Delaunay triangulation of a set of points.
+    :param points: (n, 2) array of points; repeated points are triangulated once
+    :return: (t, 3) int32 array of indices into points, one row per triangle
+    """
+    x0, y0 = np.floor(points.min(axis=0)) - 1
+    x1, y1 = np.ceil(points.max(axis=0)) + 1
+    subdiv = cv2.Subdiv2D((int(x0), int(y0), int(x1 - x0) + 1, int(y1 - y0) + 1))
+    index = {}
+    for i, (x, y) in enumerate(points):
+        key = (np.float32(x), np.float32(y))  # Subdiv2D keeps float32 coordinates
+        if key not in index:
+            index[key] = i
+            subdiv.insert((float(x), float(y)))
+    triangles = []
+    for x1, y1, x2, y2, x3, y3 in subdiv.getTriangleList():
+        vertices = [index.get((np.float32(x), np.float32(y))) for x, y in ((x1, y1), (x2, y2), (x3, y3))]
+        # triangles reaching Subdiv2D's outer bounding vertices are not part of the hull
+        if None not in vertices:
+            triangles.append(vertices)
+    return np.array(triangles, dtype=np.int32).reshape(-1, 3)
+
+
+def affines(dst, src):
+    """
+    Affine transforms from every target triangle to its source triangle, solved all at once.
+    :param dst: (t, 3, 2) target triangles
+    :param src: (t, 3, 2) source triangles
+    :return: (t, 2, 3) transforms, NaN for degenerate triangles
+    """
+    a = np.concatenate([dst, np.ones(dst.shape[:2] + (1,))], axis=2)
+    out = np.full((len(dst), 2, 3), np.nan)
+    ok = np.abs(np.linalg.det(a)) > 1e-6
+    if ok.any():
+        out[ok] = np.linalg.solve(a[ok], src[ok]).transpose(0, 2, 1)
+    return out
+
+
+def warp_maps(triangulation, points1, M, dshape):
+    """
+    Source coordinates of every target pixel the triangles cover.
+    :param triangulation: Triangulation of the source face
+    :param points1: the target's points, see Triangulation.target_points()
+    :param M: transformation matrix from the target image to the source image, used for the
+              pixels of the box that no triangle covers
+    :param dshape: shape of the target image
+    :return: (box, map_x, map_y) where box is the (x0, y0, x1, y1) of the target the float32
+             maps cover, or None if the triangles lie outside the target
+    """
+    triangles = triangulation.triangles
+    dst = points1[triangles]
+    src = triangulation.points[triangles]
+    x0, y0 = np.floor(dst.reshape(-1, 2).min(axis=0)).astype(int)
+    x1, y1 = np.ceil(dst.reshape(-1, 2).max(axis=0)).astype(int) + 1
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, dshape[1]), min(y1, dshape[0])
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    # one transform per triangle, and the similarity transform last for everything else
+    transforms = np.concatenate([affines(dst, src), np.asarray(M, dtype=np.float64)[np.newaxis, :2]])
+    transforms[np.isnan(transforms[:, 0, 0])] = transforms[-1]
+
+    labels = np.full((y1 - y0, x1 - x0), len(triangles), dtype=np.int32)
+    corners = np.rint(dst - (x0, y0)).astype(np.int32)
+    for i, triangle in enumerate(corners):
+        # draw each triangle in its own bounding box only
+        tx0, ty0 = np.maximum(triangle.min(axis=0), 0)
+        tx1, ty1 = triangle.max(axis=0) + 1
+        roi = labels[ty0:ty1, tx0:tx1]
+        if roi.size:
+            cv2.fillConvexPoly(roi, triangle - (tx0, ty0), int(i))
+
+    # each pixel's source coordinates from its triangle's transform, in float64 so that a pixel
+    # gets the same float32 coordinates whatever the origin of the image it is in
+    xs = np.arange(x0, x1, dtype=np.float64)[np.newaxis, :]
+    ys = np.arange(y0, y1, dtype=np.float64)[:, np.newaxis]
+    maps = []
+    for row in transforms.transpose(1, 0, 2):  # the x row, then the y row, of every transform
+        coordinate = row[:, 0][labels] * xs
+        coordinate += row[:, 1][labels] * ys
+        coordinate += row[:, 2][labels]
+        maps.append(coordinate.astype(np.float32))
+    return (x0, y0, x1, y1), maps[0], maps[1]
+
+
+def warp(im, M, maps, dshape, out=None):
+    """
+    Piecewise-affine version of faceSwap2.warp_im: the similarity transform M everywhere,
+    replaced by the triangles' transforms inside the box of the maps.
+    :param im: Image to be warped
+    :param M: Transformation matrix from the target image to im
+    :param maps: see warp_maps()
+    :param dshape: shape of the output image
+    :param out: optional array of shape dshape and im's dtype to warp into
+    :return: The image after being transformed
+    """
+    if out is None:
+        out = np.zeros(dshape, dtype=im.dtype)
+    else:
+        out.fill(0)
+    cv2.warpAffine(im, np.asarray(M)[:2], (dshape[1], dshape[0]), dst=out,
+                   borderMode=cv2.BORDER_TRANSPARENT, flags=cv2.WARP_INVERSE_MAP)
+    if maps is not None:
+        (x0, y0, x1, y1), map_x, map_y = maps
+        view = out[y0:y1, x0:x1]
+        view.fill(0)
+        cv2.remap(im, map_x, map_y, cv2.INTER_LINEAR, dst=view, borderMode=cv2.BORDER_TRANSPARENT)
+    return out
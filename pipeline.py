@@ -2,151 +2,542 @@
 """
 Module to connect reddit web scraping to the google cloud api and create art form it
 """
-import meme, vision_detector, faceSwap2
+import meme, detectors, faceSwap2, roi, streaming
+import async_detector
+import compositor
+import dedup
+import annotation_cache
+import face_record
+import image_store
+import metrics
+import render_cache
+import collections
 import cv2
-from google.cloud import vision
-from google.cloud.vision import types
+import itertools
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout
 import random
-import numpy as np
+
+logger = logging.getLogger(__name__)
 
 class Pipeline:
-    def __init__(self):
+    def __init__(self, detector='cloud', cache_dir='.cache/annotations', dedup_path='.cache/dedup.json',
+                 scraper_state='.cache/reddit.json', render_cache_dir='.cache/renders', **detector_options):
+        """
+        :param detector: face detector backend, one of 'cloud', 'local' or 'fixture' (see detectors.py)
+        :param cache_dir: where face annotations are cached between runs, None to disable the cache
+        :param dedup_path: where the perceptual hash index of scraped images is kept (see dedup.py)
+        :param scraper_state: where the reddit paging cursors and seen submissions are kept
+                              (see meme.MemeGenerator), None to start from the top every run
+        :param render_cache_dir: where finished swaps are cached (see render_cache.py), None to render
+                                 every meme again
+        :param detector_options: passed on to the backend's constructor
+        """
         # probably a good idea to use wholesome memes instead of dankmemes for presentation
         self.subreddit = 'wholesomememes'
-        self.vision_detector = vision_detector.VisionDetector()
+        # each backend gets its own cache, their landmarks are not interchangeable
+        cache = annotation_cache.AnnotationCache(os.path.join(cache_dir, detector)) if cache_dir else None
+        self.detector = detectors.get_detector(detector, cache=cache, **detector_options)
+        self.dedup = dedup.DedupIndex(dedup_path)
+        self.scraper_state = scraper_state
+        self._generator = None
+        self.render_cache = render_cache.RenderCache(render_cache_dir) if render_cache_dir else None
+
+    def memes(self, n):
+        """
+        Method to get the next submissions from the subreddit. The same meme.MemeGenerator is kept
+        for the Pipeline's lifetime, so later calls page on from where earlier ones stopped and the
+        next page is fetched in the background in between.
+        :param n: The number of submissions to return
+        :return: list of up to n submissions not handed out before
+        """
+        if self._generator is None:
+            reddit = meme.get_secrets('cert.txt')
+            self._generator = meme.MemeGenerator(reddit, self.subreddit, limit=max(n, 25),
+                                                 state_path=self.scraper_state)
+        return self._generator.get_memes(num=n)
         
     def get_n_memes(self, n):
         """
-        Method to grab images from a given subreddit.
+        Method to grab images from a given subreddit. Images already in the dedup index are not
+        downloaded again: a known URL, or a preview that looks like an image we have, maps to the
+        existing file, and a download that turns out to be a near-duplicate is swapped for the
+        existing file before it reaches the detector.
         :param subreddit: The subreddit to grab images from
         :param n: The number of images to return
-        :return:
+        :return: list of paths of distinct images
         """
-        reddit = meme.get_secrets('cert.txt')
-   
-        gen = meme.MemeGenerator(reddit, self.subreddit, limit=n)
-        memes = gen.get_memes(num=n)
+        memes = self.memes(n)
+        self.dedup.index_folder(meme.img_folder)
 
+        session = meme.make_session()
         img_paths = []
-        for m in memes:
-            local_image_url = meme.download_img(m.url)
-            if local_image_url != None:
-                img_paths.append(local_image_url)
-        # print("get_n_memes output len %d" %len(img_paths))
+        to_download = []
+        for m, preview in zip(memes, self._previews(session, memes)):
+            known = self.dedup.seen_url(m.url) or self.dedup.find_duplicate(preview)
+            if known:
+                metrics.count('duplicates_skipped', stage='preview')
+                img_paths.append(known)
+            else:
+                to_download.append(m.url)
+
+        # fetched concurrently over pooled connections
+        for url, path in zip(to_download, meme.download_imgs(to_download, session=session)):
+            if path == None:
+                continue
+            value = dedup.dhash_file(path)
+            if value is None:
+                # not an image OpenCV can decode (an HTML error page, a truncated file, ...)
+                metrics.count('undecodable_downloads')
+                logger.warning("Dropping %s from %s, it is not a readable image", path, url)
+                os.remove(path)
+                continue
+            known = self.dedup.find_duplicate(value, exclude=path)
+            if known:
+                metrics.count('duplicates_skipped', stage='download')
+                self.dedup.add_url(url, known)
+                img_paths.append(known)
+            else:
+                self.dedup.add(path, value, url)
+                img_paths.append(path)
+        self.dedup.save()
+
+        # the same image can come back from several submissions
+        img_paths = list(collections.OrderedDict.fromkeys(img_paths))
+        logger.debug("get_n_memes found %d distinct images", len(img_paths))
         return img_paths
+
+    def _previews(self, session, memes):
+        """
+        :return: the dHash of each submission's preview image, None where there is none
+        """
+        def preview_hash(m):
+            url = meme.preview_url(m)
+            content = meme.fetch_bytes(session, url) if url else None
+            return dedup.dhash_bytes(content) if content else None
+
+        with ThreadPoolExecutor(max_workers=meme.DOWNLOAD_WORKERS) as pool:
+            return list(pool.map(preview_hash, memes))
             
-    def study_memes(self, img_paths):
+    def study_memes(self, img_paths, with_paths=False):
         """
-        Method to use google cloud api to analyze faces in images.
+        Method to use the face detector backend to analyze faces in images.
         :param img_paths: list of paths to images to study
+        :param with_paths: return (path, faces) pairs instead, so every result keeps the image it
+                           belongs to when images without faces are left out
         :return: a list of lists of dictionaries describing the faces
                   See: vision_detector.clean_face_features() for one entry in that list
         """
-        clean_faces = []
-        for local_path in img_paths:
-            face = self.vision_detector.read_image(local_path)
-            # print("TRUE FACE VALUE:\n%s\n\n" % face)
-            # print("Type:\t%s" %type(face))
-            try:  # hope to throw an error if object is too complicated
-                isValid = type(None) != type(face) and face != None
-            except TypeError :
-                isValid = True
-
-            if isValid:
-                cleaned_face = self.vision_detector.clean_face_features(face)
-
-                if not (cleaned_face is None):
-                    # add cleaned face dictionary to list
-                    clean_faces.append(cleaned_face)
-            
-        return clean_faces
+        # one batched request per group of images; cached images are not sent at all
+        with metrics.span('study_memes'):
+            studied = self.detector.find_faces_batch(img_paths)
+        return _clean_faces(studied, with_paths)
+
+    async def study_memes_async(self, img_paths, concurrency=async_detector.CONCURRENCY,
+                                rate=async_detector.RATE, with_paths=False):
+        """
+        Coroutine version of study_memes() that keeps many single-image detections in flight at
+        once instead of sending batches one after the other, see async_detector.AsyncDetector.
+        :param img_paths: list of paths to images to study
+        :param concurrency: most detections in flight at once
+        :param rate: most detections started per second, None for no limit
+        :param with_paths: see study_memes()
+        :return: the same as study_memes()
+        """
+        with metrics.span('study_memes', mode='async'):
+            async with async_detector.AsyncDetector(self.detector, concurrency, rate) as detector:
+                studied = await detector.find_faces_batch(img_paths)
+        return _clean_faces(studied, with_paths)
     
     def create_meme(self, image1, image2, features1, features2, location):
         """
         Method to perform face swap on two individual images. The resulting image will superimpose image2's
-        face over image1's face.
-        :param image1: The base image whose faces will be covered as np.array
-        :param image2: The image whose faces will cover another face as np.array
-        :param features1: the feature dictionaries for image one
-        :param features2: the feature dictionaries for image2
+        face over image1's face. See render_meme().
+        :param image1: path to the base image whose faces will be covered
+        :param image2: path to the image whose faces will cover another face
+        :param features1: the faces (face_record.Face) found in image one
+        :param features2: the faces (face_record.Face) found in image2
         :param location: The location to write the resulting work of art to
         :return: One face-swapped art-transcending work of genius
         """
-        # turn image filepaths into np.arrays
-        print("Test of feature1 %s\nLen: %s" % (str(features1), len(features1)))
-        print("Test of feature2 values:\n%s\nLen: %d" % (str(features2), len(features2)))
-        image1 = cv2.imread(image1, cv2.IMREAD_COLOR)
-        image1 = cv2.resize(image1, (image1.shape[1] * 1,
-                                 image1.shape[0] * 1))
-        image2 = cv2.imread(image2, cv2.IMREAD_COLOR)
-        image2 = cv2.resize(image2, (image2.shape[1] * 1,
-                                     image2.shape[0] * 1))
-        print("Test of feature1 values:\n%s\nLen: %d" % (str(features1), len(features1)))
-        print("Test of feature2 values:\n%s\nLen: %d" % (str(features2), len(features2)))
-        random.seed(69)  # for debugging and the memes
-        count = 1
-        for feature2 in features2:
-            print("swapping face #%d" %count)
-            feature1 = random.choice(features1)
-            
-            # make subimage1
-            print("OUTER BOUND \n%s\n" % str(feature1['outer_bound_dict']))
-            if feature1['outer_bound_dict']:  # handle no bound box edge case
-                xT1, yL1 = feature1['outer_bound_dict']['UPPER_LEFT']
-                xB1, yR1 = feature1['outer_bound_dict']['LOWER_RIGHT']
-            elif feature1[1]:
-                xT1, yL1 = feature1['inner_bound_dict']['UPPER_LEFT']
-                xB1, yR1 = feature1['inner_bound_dict']['LOWER_RIGHT']
-            else:
-                print("Something went wrong, spicy boi")
-            width1 = abs(yR1 - yL1) # col values
-            height1 = abs(xB1 - xT1)  # row values
-            print("width ", width1, "\nheight ", height1 )
-            sub_image1 = np.array([np.array([image1[i + min(yR1, yL1)][j + min(xB1, xT1)] for j in range(width1)]) for i in range(height1)])
-            print(sub_image1)
-            # shift values in dictionaray
-            subfeature1 = {}
-            for key1 in feature1['facial_features_dict'].keys():
-                orig1 = (feature1['facial_features_dict'])[key1]
-                subfeature1[key1] = np.array(orig1) - np.array([xT1, yL1])
-                
-            # make subimage2
-            # print("Feature 1:\t%s" %str(feature1))
-            # print("Feature 2:\t%s" %str(feature2))
-            if feature2['outer_bound_dict']:  # handle no bound box edge case
-                xT2, yL2 = feature2['outer_bound_dict']['UPPER_LEFT']
-                xB2, yR2 = feature2['outer_bound_dict']['LOWER_RIGHT']
-            elif feature2[1]:
-                xT2, yL2 = feature2['inner_bound_dict']['UPPER_LEFT']
-                xB2, yR2 = feature2['inner_bound_dict']['LOWER_RIGHT']
+        # the settings are read once, so the cache key and the render always agree
+        options = swap_options()
+        if self.render_cache is None:
+            return render_meme(image1, image2, features1, features2, location, **options)
+        # the same pair of images swapped with the same faces and settings is read back instead
+        ext = os.path.splitext(location)[1] or '.jpg'
+        key = render_cache.render_key(render_cache.file_key(image1), render_cache.file_key(image2),
+                                      self.render_params(options, format=ext.lower(),
+                                                         faces=render_cache.faces_key(features1, features2)))
+        data = self.render_cache.get_or_render(
+            key, lambda: render_cache.encode(swap_meme(image1, image2, features1, features2, **options), ext))
+        with metrics.span('imwrite'):
+            with open(location, 'wb') as out:
+                out.write(data)
+
+    def render_params(self, options, **extra):
+        """
+        :param options: the swap_meme() settings of the render, see swap_options()
+        :param extra: anything else that changes the result, e.g. the output format or the
+                      render_cache.faces_key() of the faces
+        :return: the swap parameters this Pipeline renders with, see render_cache.swap_params()
+        """
+        params = dict(options, **extra)
+        return render_cache.swap_params(self.detector.name, detector=self.detector.params(), **params)
+
+    def render_memes(self, jobs, workers=None, timeout=None):
+        """
+        Method to run many face swaps in parallel on a pool of processes. Each job is sent to a
+        worker as paths and Face records, and the worker reads the images itself.
+        :param jobs: list of (image1, image2, features1, features2, location) tuples, see create_meme()
+        :param workers: number of worker processes, defaults to the number of CPUs
+        :param timeout: seconds to wait for each job's result once the jobs before it have been
+                        collected, None to wait forever. A job that takes longer is stopped, see
+                        _render_on_pool().
+        :return: list of (location, error) in the same order as jobs; error is None on success
+        """
+        results = [None] * len(jobs)
+        pending = list(range(len(jobs)))
+        # the workers get the settings from here, they may not see changes made to this module
+        options = swap_options()
+        while pending:
+            pending = _render_on_pool(jobs, pending, results, workers, timeout, options)
+        return results
+
+    def stream_memes(self, n, user_image, location_pattern="louvre/art#%d.jpg", submissions=None,
+                     fetch_workers=8, detect_workers=4, render_workers=2, write_workers=1, queue_size=4):
+        """
+        Method to scrape, study, swap and write memes as a stream instead of in phases. Each meme moves
+        on to the next stage as soon as it is ready, so the first one is written after a single meme's
+        latency, and bounded queues between the stages keep memory flat. See streaming.run_stream().
+        :param n: The number of memes to pull from the subreddit
+        :param user_image: path to the image whose face is put on every meme
+        :param location_pattern: where to write the results, formatted with a running count
+        :param submissions: optional iterable of objects with a .url to use instead of scraping reddit
+        :param fetch_workers: number of concurrent downloads
+        :param detect_workers: number of concurrent face detections
+        :param render_workers: number of concurrent swaps
+        :param write_workers: number of concurrent image encodes and writes
+        :param queue_size: capacity of each queue between stages
+        :return: generator of the locations written, in the order they finish
+        """
+        user_faces = self.detector.find_faces(user_image)
+        if not user_faces:
+            raise ValueError("no face found in %s" % user_image)
+        if submissions is None:
+            submissions = self.memes(n)
+        session = meme.make_session(fetch_workers)
+        count = itertools.count(1)
+
+        def fetch(submission):
+            return meme.download_with(session, submission.url)
+
+        def detect(path):
+            faces = self.detector.find_faces(path)
+            return (path, faces) if faces else None
+
+        def render(item):
+            path, faces = item
+            return swap_meme(path, user_image, faces, user_faces)
+
+        def write(image):
+            location = location_pattern % next(count)
+            cv2.imwrite(location, image)
+            return location
+
+        stages = [streaming.Stage('fetch', fetch, fetch_workers),
+                  streaming.Stage('detect', detect, detect_workers),
+                  streaming.Stage('render', render, render_workers),
+                  streaming.Stage('write', write, write_workers)]
+        return streaming.run_stream(submissions, stages, queue_size)
+
+
+# faceSwap2.swap_faces precision used for rendering, see faceSwap2.PRECISIONS
+SWAP_PRECISION = 'float32'
+# part of the meme each face is swapped in, one of SWAP_REGIONS
+SWAP_REGION = 'window'
+# 'window': faceSwap2.swap_window(), the same result as swapping across the whole meme
+# 'box':    the target face's bounding box, cheaper but the feathering is cut off at its edges
+SWAP_REGIONS = ('window', 'box')
+# how the source face is warped onto each target face, see faceSwap2.WARPS
+SWAP_WARP = 'affine'
+# how the swapped faces are blended into the meme, see faceSwap2.BLENDS and the latency budget of
+# each in benchmarks/bench_swap.py
+SWAP_BLEND = 'alpha'
+# longest side, in pixels, memes are rendered at; larger memes are shrunk first and the result
+# is that size. None renders at full resolution.
+RENDER_MAX_SIDE = None
+# swap_meme() reads the settings above when it is called, not when this module is imported, so
+# they can be changed at runtime
+# where decoded images are kept between swaps, see image_store.py; None decodes every time
+IMAGE_STORE_DIR = '.cache/pixels'
+
+# faceSwap2.PreparedFace of every source face this process has swapped, see prepare_source()
+_prepared_sources = {}
+PREPARED_SOURCES_MAX = 64
+# buffers reused by every float32 swap, one set per thread
+_workspaces = threading.local()
+# image_store.ImageStore of this process, by directory
+_image_stores = {}
+
+
+def _clean_faces(studied, with_paths=False):
+    """
+    :param studied: (path, faces, error) of every image, see detectors.FaceDetector.find_faces_batch()
+    :param with_paths: keep each image's path with its faces
+    :return: the faces of the images that have some, or (path, faces) pairs if with_paths
+    """
+    clean_faces = []
+    for local_path, cleaned_face, error in studied:
+        if error is not None:
+            logger.warning("Could not study %s: %s", local_path, error)
+        elif not (cleaned_face is None):
+            # add cleaned face dictionary to list
+            clean_faces.append((local_path, cleaned_face) if with_paths else cleaned_face)
+    return clean_faces
+
+
+def _workspace():
+    if not hasattr(_workspaces, 'workspace'):
+        _workspaces.workspace = faceSwap2.Workspace()
+    return _workspaces.workspace
+
+
+def read_image(path):
+    """
+    Decode an image file, only the first time it is seen when IMAGE_STORE_DIR is set. Every
+    process opens the same store, so render_memes()'s workers share the decoded pixels.
+    :param path: path of the image
+    :return: the image as np.array, read-only when it comes from the store; None if it cannot be read
+    """
+    if not IMAGE_STORE_DIR:
+        return cv2.imread(path, cv2.IMREAD_COLOR)
+    store = _image_stores.get(IMAGE_STORE_DIR)
+    if store is None:
+        store = _image_stores.setdefault(IMAGE_STORE_DIR, image_store.ImageStore(IMAGE_STORE_DIR))
+    return store.imread(path, cv2.IMREAD_COLOR)
+
+
+def swap_options(**options):
+    """
+    :param options: swap_meme() settings to use instead of the module's, None to keep its
+    :return: dict of precision, region, max_side, warp and blend; SWAP_PRECISION, SWAP_REGION,
+             RENDER_MAX_SIDE, SWAP_WARP and SWAP_BLEND as they are now, where options do not say
+    """
+    resolved = {'precision': SWAP_PRECISION, 'region': SWAP_REGION, 'max_side': RENDER_MAX_SIDE,
+                'warp': SWAP_WARP, 'blend': SWAP_BLEND}
+    resolved.update((name, value) for name, value in options.items() if value is not None)
+    return resolved
+
+
+def prepare_source(path, im, features, precision):
+    """
+    Get the faceSwap2.PreparedFace for a source face, building it only the first time the face is
+    seen. The user's face stays the same for a whole batch, so its mask is computed once per
+    process instead of once per meme.
+    :param path: path the source image was read from, or another key unique to it
+    :param im: the source face's subimage
+    :param features: the source face's face_record.Face, relative to the subimage
+    :param precision: the faceSwap2.swap_faces precision it will be used with
+    :return: a faceSwap2.PreparedFace
+    """
+    # the mask follows the bounding poly, the piecewise triangulation every landmark
+    key = (path, precision, im.shape, features.bound().tobytes(), features.landmarks.tobytes(), features.valid)
+    prepared = _prepared_sources.get(key)
+    if prepared is None:
+        if len(_prepared_sources) >= PREPARED_SOURCES_MAX:
+            _prepared_sources.clear()
+        prepared = _prepared_sources[key] = faceSwap2.PreparedFace(im, features, precision)
+    return prepared
+
+
+def _init_render_worker():
+    # one OpenCV thread per process, otherwise the workers fight over the cores
+    cv2.setNumThreads(1)
+
+
+def _render_on_pool(jobs, indices, results, workers, timeout, options):
+    """
+    Render some of render_memes()'s jobs on a new process pool.
+    A running task cannot be cancelled, so when a job times out the pool's processes are killed
+    and the jobs it had not finished yet are handed back to be run on another pool.
+    :param jobs: see Pipeline.render_memes()
+    :param indices: indices of the jobs to render
+    :param results: list the (location, error) of each finished job is stored in, by index
+    :param workers: see Pipeline.render_memes()
+    :param timeout: see Pipeline.render_memes()
+    :param options: swap settings passed on to render_meme(), see swap_options()
+    :return: indices of the jobs that still have to be rendered
+    """
+    def collect(i, future, wait):
+        location = jobs[i][4]
+        try:
+            future.result(timeout=wait)
+            results[i] = (location, None)
+        except FuturesTimeout:
+            raise
+        except Exception as e:  # one failed swap should not lose the rest
+            metrics.count('render_failures')
+            results[i] = (location, "%s: %s" % (type(e).__name__, e))
+
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker)
+    try:
+        futures = [(i, pool.submit(render_meme, *jobs[i], **options)) for i in indices]
+        for n, (i, future) in enumerate(futures):
+            try:
+                collect(i, future, timeout)
+            except FuturesTimeout:
+                metrics.count('render_failures')
+                results[i] = (jobs[i][4], "timed out after %s seconds" % timeout)
+                later = futures[n + 1:]
+                for j, other in later:
+                    if other.done():
+                        collect(j, other, 0)
+                _kill_pool(pool)
+                return [j for j, _ in later if results[j] is None]
+    except BaseException:
+        _kill_pool(pool)
+        raise
+    pool.shutdown()
+    return []
+
+
+def _kill_pool(pool):
+    """
+    Shut a process pool down without waiting for the tasks it is running, which are killed.
+    """
+    # ProcessPoolExecutor has no public way to reach its workers. _processes, a dict of pid ->
+    # multiprocessing.Process (None once shut down), is there in every CPython 3 release so far
+    # and this was tested on 3.11; without it the running tasks are left to finish on their own.
+    if not hasattr(pool, '_processes'):
+        logger.warning("cannot reach the render workers to stop them, they will finish their tasks")
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def render_meme(image1, image2, features1, features2, location, precision=None, **options):
+    """
+    Perform a face swap on two individual images and write the result. The resulting image will
+    superimpose image2's face over image1's face. Kept at module level, away from any Pipeline
+    state, so process pool workers can run it.
+    :param image1: path to the base image whose faces will be covered
+    :param image2: path to the image whose faces will cover another face
+    :param features1: the faces (face_record.Face) found in image one
+    :param features2: the faces (face_record.Face) found in image2
+    :param location: The location to write the resulting work of art to
+    :param precision: faceSwap2.swap_faces precision, see faceSwap2.PRECISIONS; None for SWAP_PRECISION
+    :param options: further settings passed on to swap_meme(), e.g. warp or blend
+    :return: One face-swapped art-transcending work of genius
+    """
+    image1 = swap_meme(image1, image2, features1, features2, precision, **options)
+    # write image file to location specified
+    with metrics.span('imwrite'):
+        cv2.imwrite(location, image1)
+
+
+def swap_meme(image1, image2, features1, features2, precision=None, source_key=None,
+              region=None, max_side=None, warp=None, blend=None):
+    """
+    Perform a face swap on two individual images. The resulting image will superimpose image2's
+    face over image1's face. Every face is swapped against the untouched image1 and they are all
+    blended in together in one pass, see compositor.Compositor. Settings left at None are read
+    from this module when it is called, see swap_options().
+    :param image1: path to the base image whose faces will be covered, or the decoded image as np.array
+                   (which is left untouched)
+    :param image2: path to the image whose faces will cover another face, or the decoded image as np.array
+    :param features1: the faces (face_record.Face) found in image one
+    :param features2: the faces (face_record.Face) found in image2
+    :param precision: faceSwap2.swap_faces precision, see faceSwap2.PRECISIONS; None for SWAP_PRECISION
+    :param source_key: identifies image2 for reusing its prepared faces (see prepare_source());
+                       defaults to image2's path, and nothing is reused for an unnamed np.array
+    :param region: where each face is swapped, see SWAP_REGIONS; None for SWAP_REGION
+    :param max_side: working resolution, image1 is shrunk to this longest side before swapping
+                     and the result is that size; 0 to work at full resolution, None for
+                     RENDER_MAX_SIDE
+    :param warp: how the source face is warped onto each target face, see faceSwap2.WARPS;
+                 None for SWAP_WARP
+    :param blend: how the swapped faces are blended into image1, see faceSwap2.BLENDS;
+                  None for SWAP_BLEND
+    :return: the swapped image as np.array
+    """
+    options = swap_options(precision=precision, region=region, max_side=max_side, warp=warp, blend=blend)
+    precision, region, max_side = options['precision'], options['region'], options['max_side']
+    warp, blend = options['warp'], options['blend']
+    if region not in SWAP_REGIONS:
+        raise ValueError("unknown swap region %r" % region)
+    if source_key is None and isinstance(image2, str):
+        source_key = image2
+    # turn image filepaths into np.arrays
+    with metrics.span('imread'):
+        # the result is written into a copy of image1, which may be a read-only view of the store
+        out = None
+        if isinstance(image1, str):
+            image1 = read_image(image1)
+        if isinstance(image2, str):
+            image2 = read_image(image2)
+    features1 = face_record.from_dicts(features1)
+    features2 = face_record.from_dicts(features2)
+    if max_side and max(image1.shape[:2]) > max_side:
+        height, width = image1.shape[:2]
+        scale = max_side / float(max(height, width))
+        size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+        image1 = out = cv2.resize(image1, size, interpolation=cv2.INTER_AREA)
+        features1 = detectors.rescale_faces(features1, size[0] / float(width))
+    composite = compositor.Compositor(image1, precision, blend)
+    # for debugging and the memes; a generator of its own, since swaps run on several threads at
+    # once and must pick the same faces every time for the render cache
+    rng = random.Random(69)
+    count = 1
+    for feature2 in features2:
+        feature1 = rng.choice(features1)
+        
+        box1 = roi.face_box(feature1)
+        box2 = roi.face_box(feature2)
+        if box1 is None or box2 is None:  # handle no bound box edge case
+            logger.debug("face #%d has no bounding box, skipped", count)
+            continue
+        box1 = roi.clamp_box(box1, image1.shape)
+        if region == 'window':
+            # leave room for the source mask's feathering
+            reach = faceSwap2.FEATHER_REACH
+            box2 = (box2[0] - reach, box2[1] - reach, box2[2] + reach, box2[3] + reach)
+        box2 = roi.clamp_box(box2, image2.shape)
+        if box1 is None or box2 is None:  # face lies entirely off the image
+            continue
+        sub_image2 = roi.crop(image2, box2)
+        subfeature2 = roi.shift_features(feature2, box2)
+        # reuse the source face's mask from earlier memes
+        if source_key is None:
+            prepared2 = None
+        else:
+            prepared2 = prepare_source(source_key, sub_image2, subfeature2, precision)
+
+        with metrics.span('swap_face', precision=precision, region=region, warp=warp):
+            if region == 'window':
+                # the window is worked out from the landmarks, it can reach past the face box
+                window, layer, alpha = faceSwap2.face_layer_window(image1, sub_image2, feature1, subfeature2,
+                                                                   prepared2, precision, _workspace(), warp)
             else:
-                print("Something went wrong, spicy boi")
-            width2 = abs(yR2 - yL2)  #  row values
-            height2 = abs(xB2 - xT2)  # col values
-            print("width ", width2, "\nheight ", height2)
-            sub_image2 = np.array([np.array([image2[i + min(yR2, yL2)][j + min(xB2, xT2)] for j in range(width2)]) for i in range(height2)])
-                
-            # shift values in dictionary
-            subfeature2 = {}
-            for key2 in feature2['facial_features_dict'].keys():
-                orig2 = (feature2['facial_features_dict'])[key2]
-                subfeature2[key2] = np.array([orig2]) - np.array([xT2, yL2])
-
-            # get swapped subimage
-            sub_swap_img = faceSwap2.swap_faces(sub_image1, sub_image2, feature1, feature2)
-            print("swapped %d faces" % count)
-            count += 1
-
-            # insert subimage
-            for i in range(height1):
-                for j in range(width1):
-                    image1[i + min(yR1, yL1)][j + min(xB1, xT1)] = sub_swap_img[i][j]
-
-            # write image file to location specified
-            cv2.imwrite(location, image1)
+                # shift the faces so they refer to the subimages
+                window = box1
+                layer, alpha = faceSwap2.face_layer(roi.crop(image1, box1), sub_image2,
+                                                    roi.shift_features(feature1, box1), subfeature2, prepared2,
+                                                    precision=precision, workspace=_workspace(), warp=warp)
+        composite.add(window, layer, alpha)
+        metrics.count('faces_swapped')
+        count += 1
+
+    return composite.render(out)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
     # setup user data
     pipeline = Pipeline()
     user_image = "photos/aaron.jpg"
@@ -157,13 +548,13 @@ if __name__ == "__main__":
     # scrape data
     image_urls = pipeline.get_n_memes(10)
     # process data
-    cleaned_faces = pipeline.study_memes(image_urls)
-    # print("CLEANED FACE:\n%s\n\n" % str(cleaned_faces))
-    # swap individual images
-    count = 1
-    for face, meme in zip(cleaned_faces, image_urls):
-        print("creating art # %d" % count)
-        pipeline.create_meme(meme, user_image, face , user_faces, "louvre/art#%d.jpg" % count)
-        count += 1
-
-        print("Cleaned %d dirty faces" %count)
+    # images without faces are left out, so each meme stays paired with its own faces
+    cleaned_faces = pipeline.study_memes(image_urls, with_paths=True)
+    # swap individual images, spread across all cores
+    jobs = [(meme, user_image, face, user_faces, "louvre/art#%d.jpg" % count)
+            for count, (meme, face) in enumerate(cleaned_faces, 1)]
+    for location, error in pipeline.render_memes(jobs):
+        if error is None:
+            logger.info("created art %s", location)
+        else:
+            logger.warning("failed to create %s: %s", location, error)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of finished swaps, so the same meme with the same face is only rendered
+once.
+
+An entry is the encoded output image, keyed by the SHA-256 of the target
+image, of the source image and of the swap parameters (see swap_params()), so
+changing FEATHER_AMOUNT, the faces or the detector never serves a stale render.
+Entries live on disk, evicted least recently used once they pass max_bytes,
+with the most recently used ones also kept in memory. When several threads
+miss on the same key at once only the first renders it and the others wait
+for its result (see RenderCache.get_or_render()).
+
+Example Usage:
+    cache = RenderCache('.cache/renders')
+    key = render_key(content_key(meme_bytes), content_key(face_bytes), swap_params('cloud'))
+    jpeg = cache.get_or_render(key, lambda: encode(swap_meme(...), '.jpg'))
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future
+
+import cv2
+
+import faceSwap2
+import metrics
+from annotation_cache import DiskIndex, content_key, file_key
+from face_record import from_dicts, to_dicts
+
+SCHEMA_VERSION = 1
+
+
+def swap_params(backend, **options):
+    """
+    Everything besides the two images that changes what a swap looks like.
+    :param backend: the face detector backend the landmarks come from, see detectors.get_detector()
+    :param options: further settings of the render, e.g. precision, region, max_side, the
+                    detector's FaceDetector.params(), faces_key() or the output format
+    :return: dict of parameter name -> value
+    """
+    params = {'feather_amount': faceSwap2.FEATHER_AMOUNT,
+              'colour_correct_blur_frac': faceSwap2.COLOUR_CORRECT_BLUR_FRAC,
+              'backend': backend}
+    params.update(options)
+    return params
+
+
+def faces_key(*faces):
+    """
+    :param faces: lists of face_record.Face (or feature dictionaries), e.g. the target image's
+                  and the source image's
+    :return: hex SHA-256 digest of the faces, for swap_params()
+    """
+    description = json.dumps([to_dicts(from_dicts(features)) for features in faces], sort_keys=True)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def render_key(target_key, source_key, params):
+    """
+    :param target_key: content_key() of the image whose faces are covered
+    :param source_key: content_key() of the image the face comes from
+    :param params: see swap_params()
+    :return: hex SHA-256 digest used as the cache key
+    """
+    description = json.dumps([SCHEMA_VERSION, target_key, source_key, params], sort_keys=True)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def encode(image, ext='.jpg'):
+    """
+    :param image: the swapped image as np.array
+    :param ext: image format, as a file extension
+    :return: the encoded image as bytes
+    """
+    ok, encoded = cv2.imencode(ext, image)
+    if not ok:
+        raise ValueError("could not encode the result as %s" % ext)
+    return encoded.tobytes()
+
+
+class RenderCache:
+    def __init__(self, directory='.cache/renders', max_bytes=256 * 1024 * 1024, memory_bytes=32 * 1024 * 1024):
+        """
+        :param directory: folder the entries are kept in, created if missing
+        :param max_bytes: total size of the entries on disk to keep before evicting
+        :param memory_bytes: total size of the entries also kept in memory
+        """
+        self.directory = os.path.join(directory, 'v%d' % SCHEMA_VERSION)
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self._lock = threading.Lock()
+        # key -> bytes, least recently used first; only ever entries that are also on disk
+        self._memory = collections.OrderedDict()
+        self._memory_total = 0
+        # key -> Future of the render in progress
+        self._flights = {}
+        self._index = DiskIndex(self.directory, '.bin', max_bytes, on_drop=self._forget)
+
+    def get(self, key):
+        """
+        Look up a render.
+        :param key: see render_key()
+        :return: the encoded image, or None on a miss
+        """
+        data, tier = self._lookup(key)
+        if data is None:
+            metrics.count('render_cache_misses')
+        else:
+            metrics.count('render_cache_hits', tier=tier)
+        return data
+
+    def _lookup(self, key):
+        """
+        :return: (encoded image or None, 'memory' or 'disk')
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._index.touch(key)
+                return data, 'memory'
+            if key not in self._index:
+                return None, None
+        try:
+            with open(self._index.path(key), 'rb') as entry_file:
+                data = entry_file.read()
+        except OSError:
+            with self._lock:
+                if key in self._index:
+                    self._index.drop(key)
+            return None, None
+        with self._lock:
+            # evicted while it was being read; keeping it in memory would outlive its index entry
+            if key in self._index:
+                self._index.touch(key)
+                self._remember(key, data)
+        return data, 'disk'
+
+    def put(self, key, data):
+        """
+        Store a render and evict old entries if needed.
+        :param key: see render_key()
+        :param data: the encoded image as bytes
+        """
+        path = self._index.path(key)
+        tmp = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp, 'wb') as entry_file:
+            entry_file.write(data)
+        with self._lock:
+            os.replace(tmp, path)
+            self._index.add(key, len(data))
+            self._remember(key, data)
+            self._index.evict()
+
+    def get_or_render(self, key, render):
+        """
+        Look up a render, rendering and storing it on a miss. Concurrent calls for the same key
+        render it only once: the first call renders and the others wait for its result, or its
+        exception.
+        :param key: see render_key()
+        :param render: called with no arguments on a miss, returns the encoded image as bytes
+        :return: the encoded image
+        """
+        data = self.get(key)
+        if data is not None:
+            return data
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+        if not leader:
+            metrics.count('render_cache_coalesced')
+            return flight.result()
+
+        try:
+            # another render of the key may have finished between get() and taking the lock
+            data, _ = self._lookup(key)
+            if data is None:
+                with metrics.span('render'):
+                    data = render()
+                self.put(key, data)
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(data)
+            return data
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_total -= len(old)
+        self._memory[key] = data
+        self._memory_total += len(data)
+        while self._memory_total > self.memory_bytes:
+            _, dropped = self._memory.popitem(last=False)
+            self._memory_total -= len(dropped)
+
+    def _forget(self, key):
+        # called by the index for every entry it drops
+        data = self._memory.pop(key, None)
+        if data is not None:
+            self._memory_total -= len(data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._index
+
+    def __len__(self):
+        return len(self._index)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Region-of-interest helpers used to cut face boxes out of an image and put the
+swapped result back. Every crop is a NumPy slice view of the original image,
+so nothing is copied until the swap itself runs.
+"""
+import numpy as np
+
+from face_record import as_face
+
+
+def face_box(feature):
+    """
+    Find the pixel box of a face.
+    The corners of a Vision bounding poly do not line up with their labels, so
+    the box is taken from the extremes of all of the vertices instead of from
+    two named corners.
+    :param feature: a face_record.Face (or a feature dictionary in the older format)
+    :return: (x0, y0, x1, y1) with x0 <= x1 and y0 <= y1, or None if the face has no bound
+    """
+    return as_face(feature).box()
+
+
+def clamp_box(box, shape):
+    """
+    Clip a box so that it lies inside an image.
+    :param box: (x0, y0, x1, y1) in pixel coordinates, may run off the image edge
+    :param shape: shape of the image the box refers to
+    :return: the clipped (x0, y0, x1, y1), or None if nothing of the box is left
+    """
+    height, width = shape[:2]
+    x0, y0, x1, y1 = box
+    x0 = min(max(x0, 0), width)
+    x1 = min(max(x1, 0), width)
+    y0 = min(max(y0, 0), height)
+    y1 = min(max(y1, 0), height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
+
+
+def crop(image, box):
+    """
+    Cut a box out of an image without copying it.
+    :param image: image as np.array
+    :param box: (x0, y0, x1, y1) already clipped with clamp_box()
+    :return: a view of the image; writing to it writes to the image
+    """
+    x0, y0, x1, y1 = box
+    return image[y0:y1, x0:x1]
+
+
+def shift_features(feature, box):
+    """
+    Move a face into the coordinates of a crop.
+    :param feature: a face_record.Face (or a feature dictionary in the older format)
+    :param box: the box the crop was cut with
+    :return: a new Face with every point relative to the crop's upper left corner
+    """
+    return as_face(feature).shifted(-box[0], -box[1])
+
+
+def paste(image, box, patch, mask=None):
+    """
+    Write a patch back into an image in place.
+    Values are clipped to the range of the image's dtype, so the float output
+    of faceSwap2.swap_faces() can be written straight into a uint8 image.
+    :param image: image the patch is written into, modified in place
+    :param box: the box the patch was cut with
+    :param patch: np.array with the same height and width as the box
+    :param mask: optional alpha in [0, 1], either (h, w) or (h, w, channels).
+                 When given the patch is blended over what is already there.
+    :return: the view of image that was written to
+    """
+    view = crop(image, box)
+    if mask is not None:
+        if mask.ndim == 2 and view.ndim == 3:
+            mask = mask[:, :, np.newaxis]
+        patch = view + (patch - view) * mask
+    if np.issubdtype(view.dtype, np.integer):
+        info = np.iinfo(view.dtype)
+        patch = np.clip(patch, info.min, info.max)
+    view[...] = patch
+    return view
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Small thread based streaming engine. Items flow through a chain of stages
+connected by bounded queues: a stage that falls behind fills its input queue,
+which blocks the stage before it, so no stage runs more than queue_size items
+ahead and nothing upstream is ever held in memory in full.
+
+Example Usage:
+    stages = [Stage('fetch', download, workers=8),
+              Stage('detect', find_faces, workers=4),
+              Stage('render', swap, workers=2)]
+    for result in run_stream(urls, stages, queue_size=4):
+        print(result)
+"""
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# put on a queue once per downstream worker when a stage has no more items
+_DONE = object()
+# how often blocked workers check whether the stream was abandoned, in seconds
+_POLL = 0.1
+
+
+class Stage:
+    def __init__(self, name, fn, workers=1, on_error=None):
+        """
+        :param name: name of the stage, used in error reports
+        :param fn: called with each item; its return value is passed to the next stage,
+                   and returning None drops the item
+        :param workers: number of threads running fn
+        :param on_error: called as on_error(stage_name, item, exception) when fn raises;
+                         the item is dropped. Defaults to logging the error.
+        """
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.on_error = on_error or _log_error
+
+
+def _log_error(name, item, e):
+    logger.exception("%s failed on %r", name, item, exc_info=e)
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def run_stream(items, stages, queue_size=4):
+    """
+    Run items through the stages, yielding each output of the last stage as soon as it is ready.
+    Outputs are not in input order. Stopping the iteration early shuts the stages down.
+    :param items: iterable of inputs to the first stage, read lazily. If reading it raises, the
+                  items read before go through the stages and the generator then raises the error.
+    :param stages: list of Stage
+    :param queue_size: capacity of each queue between stages
+    :return: generator of outputs of the last stage
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    threads = []
+    # the exception items raised, if any
+    failure = []
+
+    def feed():
+        try:
+            for item in items:
+                if not _put(queues[0], item, stop):
+                    return
+        except Exception as e:
+            failure.append(e)
+        finally:
+            # the stages always hear that the items are over, or the consumer would wait forever
+            for _ in range(stages[0].workers):
+                _put(queues[0], _DONE, stop)
+
+    def work(index, stage, remaining):
+        inbox, outbox = queues[index], queues[index + 1]
+        while True:
+            item = _get(inbox, stop)
+            if item is _DONE:
+                break
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                stage.on_error(stage.name, item, e)
+                continue
+            if result is not None and not _put(outbox, result, stop):
+                return
+        # the last worker of a stage to finish tells the next stage
+        with remaining[1]:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            downstream = stages[index + 1].workers if index + 1 < len(stages) else 1
+            for _ in range(downstream):
+                _put(outbox, _DONE, stop)
+
+    threads.append(threading.Thread(target=feed, name='stream-feed', daemon=True))
+    for index, stage in enumerate(stages):
+        remaining = [stage.workers, threading.Lock()]
+        for n in range(stage.workers):
+            threads.append(threading.Thread(target=work, args=(index, stage, remaining),
+                                            name='stream-%s-%d' % (stage.name, n), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            result = _get(queues[-1], stop)
+            if result is _DONE:
+                break
+            yield result
+        if failure:
+            raise failure[0]
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import annotation_cache
+import async_detector
+from async_detector import AsyncDetector, TokenBucket, backoff_delay, is_retryable
+
+
+class ApiError(Exception):
+    def __init__(self, code=None, grpc_status_code=None, retry_after=None):
+        super().__init__('api error %r' % (code or grpc_status_code,))
+        self.code = code
+        self.grpc_status_code = grpc_status_code
+        self.retry_after = retry_after
+
+
+class FakeDetector:
+    """
+    A detector backend that never hits the cache, and fails with the given errors before it succeeds.
+    """
+    name = 'fake'
+
+    def __init__(self, errors=(), delay=0):
+        self.errors = list(errors)
+        self.delay = delay
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def cached(self, content):
+        return None, annotation_cache.MISS
+
+    def detect_bytes(self, content, key):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            error = self.errors.pop(0) if self.errors else None
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+        if error is not None:
+            raise error
+        return ['face']
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    A clock that asyncio.sleep() moves on instead of waiting.
+    """
+    fake = FakeClock()
+
+    async def sleep(seconds):
+        fake.sleeps.append(seconds)
+        fake.now += seconds
+
+    monkeypatch.setattr(async_detector.asyncio, 'sleep', sleep)
+    return fake
+
+
+def detect(detector, times=1):
+    async def run():
+        async with detector:
+            return await asyncio.gather(*(detector.find_faces_bytes(b'image') for _ in range(times)))
+
+    return asyncio.run(run())
+
+
+def test_in_flight_detections_are_limited():
+    backend = FakeDetector(delay=0.02)
+    results = detect(AsyncDetector(backend, concurrency=3, rate=None), times=12)
+
+    assert results == [['face']] * 12
+    assert backend.peak == 3
+
+
+def test_bucket_lets_rate_through_after_the_burst(clock):
+    bucket = TokenBucket(rate=10, burst=2, clock=clock)
+
+    async def acquire(times):
+        for _ in range(times):
+            await bucket.acquire()
+
+    asyncio.run(acquire(5))
+    assert clock.sleeps[:1] == [pytest.approx(0.1)]
+    assert clock.now == pytest.approx(0.3)
+
+
+def test_pause_holds_every_acquisition_back(clock):
+    bucket = TokenBucket(rate=10, burst=5, clock=clock)
+    bucket.pause(2)
+    # a shorter pause does not cut the longer one short
+    bucket.pause(1)
+
+    asyncio.run(bucket.acquire())
+    assert clock.now == pytest.approx(2.1)
+
+
+def test_retry_after_pauses_the_bucket(clock):
+    backend = FakeDetector([ApiError(code=429, retry_after=1.5)])
+    detector = AsyncDetector(backend, rate=10, burst=1)
+    detector.bucket = TokenBucket(rate=10, burst=1, clock=clock)
+
+    assert detect(detector) == [['face']]
+    assert backend.calls == 2
+    # the backoff waits out Retry-After, and the bucket is still empty after it
+    assert clock.sleeps == [1.5, pytest.approx(0.1)]
+
+
+@pytest.mark.parametrize('error', [ApiError(code=429), ApiError(code=503), TimeoutError(), ConnectionResetError(),
+                                   ApiError(grpc_status_code=14),
+                                   ApiError(grpc_status_code=SimpleNamespace(value=(8, 'resource exhausted')))])
+def test_retryable(error):
+    assert is_retryable(error)
+
+
+@pytest.mark.parametrize('error', [ApiError(code=400), ApiError(code=403), ApiError(grpc_status_code=3),
+                                   ValueError('bad image')])
+def test_not_retryable(error):
+    assert not is_retryable(error)
+
+
+def test_backoff_grows_up_to_the_cap(monkeypatch):
+    monkeypatch.setattr(async_detector.random, 'uniform', lambda low, high: high)
+    assert [backoff_delay(attempt, base=0.5, cap=3) for attempt in range(5)] == [0.5, 1, 2, 3, 3]
+    assert backoff_delay(0, base=0.5, hint=4) == 4
+
+
+def test_retryable_errors_are_retried_with_backoff(clock):
+    backend = FakeDetector([ApiError(code=503), ApiError(grpc_status_code=14)])
+    detector = AsyncDetector(backend, rate=None, backoff=0.5, max_backoff=30)
+
+    assert detect(detector) == [['face']]
+    assert backend.calls == 3
+    assert len(clock.sleeps) == 2
+    assert 0 <= clock.sleeps[0] <= 0.5 and 0 <= clock.sleeps[1] <= 1
+
+
+def test_retries_give_up(clock):
+    backend = FakeDetector([ApiError(code=503)] * 3)
+
+    with pytest.raises(ApiError):
+        detect(AsyncDetector(backend, rate=None, retries=2))
+    assert backend.calls == 3
+
+
+def test_other_errors_are_raised_at_once(clock):
+    backend = FakeDetector([ApiError(code=400)])
+
+    with pytest.raises(ApiError):
+        detect(AsyncDetector(backend, rate=None))
+    assert backend.calls == 1
+    assert clock.sleeps == []
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import batch
+import detectors
+
+TARGET = 'images/T8rcmAj.jpg'
+SOURCES = ['photos/aaron.jpg', 'photos/sam.jpg']
+
+
+def run(tmp_path, journal):
+    return batch.run_batch(detectors.get_detector('fixture'), [TARGET], SOURCES, str(tmp_path / 'out'), journal,
+                           workers=1)
+
+
+def test_a_second_run_does_nothing(tmp_path):
+    with batch.Journal(str(tmp_path / 'journal.jsonl')) as journal:
+        assert run(tmp_path, journal) == (2, 0)
+    outputs = [batch.output_path(str(tmp_path / 'out'), TARGET, source) for source in SOURCES]
+    assert all(os.path.exists(output) for output in outputs)
+
+    with batch.Journal(str(tmp_path / 'journal.jsonl')) as journal:
+        assert all(journal.finished(TARGET, source) for source in SOURCES)
+        assert run(tmp_path, journal) == (0, 0)
+
+
+def test_journaled_pairs_are_skipped(tmp_path):
+    done = batch.output_path(str(tmp_path / 'out'), TARGET, SOURCES[0])
+    os.makedirs(os.path.dirname(done))
+    with open(done, 'wb') as output:
+        output.write(b'from an earlier run')
+    with batch.Journal(str(tmp_path / 'journal.jsonl')) as journal:
+        journal.record(TARGET, SOURCES[0], 'done', output=done)
+        journal.record(TARGET, SOURCES[1], 'failed', error='timed out')
+
+    with batch.Journal(str(tmp_path / 'journal.jsonl')) as journal:
+        # the failed pair is tried again
+        assert run(tmp_path, journal) == (1, 0)
+        assert journal.entries[(TARGET, SOURCES[1])]['status'] == 'done'
+    with open(done, 'rb') as output:
+        assert output.read() == b'from an earlier run'
+
+
+def test_done_pair_without_its_output_is_done_again(tmp_path):
+    with batch.Journal(str(tmp_path / 'journal.jsonl')) as journal:
+        journal.record(TARGET, SOURCES[0], 'done', output=str(tmp_path / 'deleted.jpg'))
+        assert not journal.finished(TARGET, SOURCES[0])
+
+
+def test_recovers_from_a_torn_last_line(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    with batch.Journal(path) as journal:
+        journal.record(TARGET, SOURCES[0], 'no_face')
+    with open(path, 'a') as journal_file:
+        # a run killed in the middle of writing an entry
+        journal_file.write(json.dumps({'target': TARGET, 'source': SOURCES[1], 'status': 'done'})[:30])
+
+    with batch.Journal(path) as journal:
+        assert list(journal.entries) == [(TARGET, SOURCES[0])]
+        journal.record(TARGET, SOURCES[1], 'failed', error='timed out')
+
+    with open(path, 'r') as journal_file:
+        lines = journal_file.read().splitlines()
+    assert len(lines) == 3
+    with batch.Journal(path) as journal:
+        assert journal.finished(TARGET, SOURCES[0])
+        assert journal.entries[(TARGET, SOURCES[1])]['status'] == 'failed'
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import dedup
+
+
+def test_readding_a_path_replaces_its_hash(tmp_path):
+    path = str(tmp_path / 'meme.jpg')
+    open(path, 'wb').close()
+    index = dedup.DedupIndex(str(tmp_path / 'dedup.json'))
+    index.add(path, 0x0f0f0f0f0f0f0f0f)
+
+    # the file was overwritten by a download of another picture
+    index.add(path, 0xf0f0f0f0f0f0f0f0)
+
+    assert index.find_duplicate(0x0f0f0f0f0f0f0f0f) is None
+    assert index.find_duplicate(0xf0f0f0f0f0f0f0f0) == path
+    assert len(index.tree) == 1
+    index.save()
+    assert dedup.DedupIndex(str(tmp_path / 'dedup.json')).hashes == {path: 0xf0f0f0f0f0f0f0f0}
+
+
+def test_bktree_remove_keeps_the_other_entries():
+    tree = dedup.BKTree()
+    values = [0, 1, 3, 7, 0xff, 0xff00, 1]
+    for i, value in enumerate(values):
+        tree.add(value, i)
+
+    assert tree.remove(1, 1)
+    assert not tree.remove(1, 1)
+    assert [item for _, item in tree.search(1, 0)] == [6]
+    assert sorted(item for _, item in tree.search(0, 64)) == [0, 2, 3, 4, 5, 6]
+    assert len(tree) == 6
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import detectors
+
+
+def read_source():
+    with open('photos/aaron.jpg', 'rb') as image_file:
+        return image_file.read()
+
+
+def test_cache_key_follows_the_local_detector_settings():
+    content = read_source()
+    default = detectors.LocalDetector(landmark_model='')
+    assert default.cache_key(content) == detectors.LocalDetector(landmark_model='').cache_key(content)
+    assert default.cache_key(content) != detectors.LocalDetector(landmark_model='', min_face=80).cache_key(content)
+    assert default.cache_key(content) != detectors.LocalDetector(landmark_model='',
+                                                                 dnn_confidence=0.9).cache_key(content)
+
+
+def test_cache_key_without_other_settings_is_unchanged():
+    content = read_source()
+    key = detectors.annotation_cache.content_key(content)
+    assert detectors.FaceDetector().cache_key(content) == key
+    assert detectors.FaceDetector(max_side=640).cache_key(content) == key + '-640'
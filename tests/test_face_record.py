@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import json
+
+import numpy as np
+
+from face_record import BOUND_CORNERS, LANDMARK_INDEX, Face, corners, from_dicts, to_dicts
+
+
+def make_face():
+    # a landmark at the origin is still found, only the validity bits say which ones are
+    points = {'LEFT_EYE': (120, 80), 'RIGHT_EYE': (180, 82), 'NOSE_TIP': (0, 0), 'CHIN_RIGHT_GONION': (210, 260)}
+    return Face.from_points(points, corners(90, 40, 230, 280), corners(100, 60, 220, 270))
+
+
+def test_round_trip_through_the_dictionary_format():
+    face = make_face()
+    again = Face.from_dict(face.to_dict())
+
+    assert again == face
+    assert again.valid == face.valid
+    assert [name for name in LANDMARK_INDEX if again.has(name)] == \
+        ['LEFT_EYE', 'RIGHT_EYE', 'NOSE_TIP', 'CHIN_RIGHT_GONION']
+    assert np.array_equal(again.landmarks[again.valid_mask()], face.landmarks[face.valid_mask()])
+    assert np.array_equal(again.outer, face.outer)
+    assert np.array_equal(again.inner, face.inner)
+
+
+def test_round_trip_through_json():
+    faces = [make_face(), Face.from_points({'MOUTH_CENTER': (5, 6)}, inner=corners(1, 2, 30, 40))]
+    again = from_dicts(json.loads(json.dumps(to_dicts(faces))))
+
+    assert again == faces
+    assert again[1].outer is None
+    assert again[1].box() == (1, 2, 30, 40)
+
+
+def test_bounds_keep_their_corner_order():
+    bound = make_face().to_dict()['outer_bound_dict']
+    assert list(bound) == BOUND_CORNERS
+    assert bound['LOWER_LEFT'] == (90, 40)
+    assert bound['UPPER_LEFT'] == (90, 280)
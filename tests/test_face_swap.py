@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import cv2
+import numpy
+
+import detectors
+import faceSwap2
+import face_record
+import pipeline
+
+MEME = 'images/T8rcmAj.jpg'
+SOURCE = 'photos/aaron.jpg'
+
+
+def without(face, landmarks):
+    """
+    :return: a copy of face missing the given landmark indices
+    """
+    valid = face.valid
+    for i in landmarks:
+        valid &= ~(1 << int(i))
+    return face_record.Face(face.landmarks.copy(), valid, face.outer, face.inner)
+
+
+def test_colour_blur_needs_both_eyes():
+    face = detectors.canonical_face(0, 0, 200, 200)
+    left, right = faceSwap2.eye_points(face)
+    assert faceSwap2.colour_blur_amount(left, right) > 1
+    left, right = faceSwap2.eye_points(without(face, face_record.RIGHT_EYE_LANDMARKS))
+    assert faceSwap2.colour_blur_amount(left, right) == 1
+
+
+def test_swap_with_one_eye(monkeypatch):
+    monkeypatch.setattr(pipeline, 'IMAGE_STORE_DIR', None)
+    height, width = cv2.imread(MEME).shape[:2]
+    target = without(detectors.canonical_face(width // 4, height // 4, width // 2, height // 2),
+                     face_record.LEFT_EYE_LANDMARKS)
+    source = detectors.canonical_face(100, 100, 300, 300)
+    for precision in faceSwap2.PRECISIONS:
+        out = pipeline.swap_meme(MEME, SOURCE, [target], [source], precision=precision)
+        assert out.shape == (height, width, 3)
+
+
+def test_float32_matches_float64(monkeypatch):
+    monkeypatch.setattr(pipeline, 'IMAGE_STORE_DIR', None)
+    detector = detectors.get_detector('fixture')
+    source = detector.find_faces(SOURCE)
+    # faces whose masks reach the edge of the source crop, where the two paths used to differ
+    for meme in ('images/y83xh3bceet11.jpg', 'images/yjwefv3v7et11.jpg', MEME, 'images/ahcd56rhc8t11.jpg'):
+        faces = detector.find_faces(meme)
+        full = pipeline.swap_meme(meme, SOURCE, faces, source, precision='float64', max_side=1024)
+        full = numpy.clip(numpy.rint(full), 0, 255).astype(numpy.int16)
+        fast = pipeline.swap_meme(meme, SOURCE, faces, source, precision='float32', max_side=1024)
+        assert numpy.abs(full - fast).max() <= faceSwap2.FLOAT32_TOLERANCE, meme
+
+
+def test_swap_with_only_inner_bounds(monkeypatch):
+    monkeypatch.setattr(pipeline, 'IMAGE_STORE_DIR', None)
+    height, width = cv2.imread(MEME).shape[:2]
+    target = detectors.canonical_face(width // 4, height // 4, width // 2, height // 2)
+    source = detectors.canonical_face(100, 100, 300, 300)
+    target, source = [face_record.Face(face.landmarks, face.valid, None, face.inner) for face in (target, source)]
+    for warp in faceSwap2.WARPS:
+        out = pipeline.swap_meme(MEME, SOURCE, [target], [source], warp=warp)
+        assert out.shape == (height, width, 3)
+
+
+def test_prepared_source_follows_the_landmarks(monkeypatch):
+    monkeypatch.setattr(pipeline, '_prepared_sources', {})
+    im = cv2.imread(SOURCE)
+    face = detectors.canonical_face(100, 100, 300, 300)
+    moved = face_record.Face(face.landmarks + 5, face.valid, face.outer, face.inner)
+    fewer = without(face, face_record.LEFT_EYE_LANDMARKS)
+
+    prepared = pipeline.prepare_source(SOURCE, im, face, 'float64')
+    assert pipeline.prepare_source(SOURCE, im, face, 'float64') is prepared
+    assert pipeline.prepare_source(SOURCE, im, moved, 'float64') is not prepared
+    assert pipeline.prepare_source(SOURCE, im, fewer, 'float64') is not prepared
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import pytest
+
+import meme
+
+
+class FakeSubreddit:
+    """
+    A hot listing of fixed submissions, paged after a fullname like PRAW's.
+    """
+
+    def __init__(self, name, size):
+        self.submissions = [SimpleNamespace(id='%s%d' % (name, i), fullname='t3_%s%d' % (name, i),
+                                            url='https://i.example.com/%s%d.jpg' % (name, i))
+                            for i in range(size)]
+
+    def hot(self, limit, params):
+        start = 0
+        after = params.get('after')
+        if after:
+            fullnames = [submission.fullname for submission in self.submissions]
+            start = fullnames.index(after) + 1 if after in fullnames else len(fullnames)
+        return iter(self.submissions[start:start + limit])
+
+
+class FakeReddit:
+    def __init__(self, size=100):
+        self.size = size
+
+    def subreddit(self, name):
+        return FakeSubreddit(name, self.size)
+
+
+def ids(submissions):
+    return [submission.id for submission in submissions]
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_restart_resumes_after_the_last_returned(tmp_path, prefetch):
+    state = str(tmp_path / 'state.json')
+    generator = meme.MemeGenerator(FakeReddit(), 'a', limit=25, state_path=state, prefetch=prefetch)
+    assert ids(generator.get_memes(10)) == ['a%d' % i for i in range(10)]
+    generator.close()
+
+    restarted = meme.MemeGenerator(FakeReddit(), 'a', limit=25, state_path=state, prefetch=prefetch)
+    assert ids(restarted.get_memes(3)) == ['a10', 'a11', 'a12']
+    restarted.close()
+
+
+def test_no_repeats_or_gaps_across_calls_and_restarts(tmp_path):
+    state = str(tmp_path / 'state.json')
+    handed_out = []
+    for size in [7, 30, 1, 12]:
+        generator = meme.MemeGenerator(FakeReddit(), ['a', 'b'], limit=10, state_path=state)
+        handed_out += ids(generator.get_memes(size))
+        handed_out += ids(generator.get_memes(size))
+        generator.close()
+
+    assert len(handed_out) == len(set(handed_out)) == 100
+    for name in 'ab':
+        assert [i for i in handed_out if i.startswith(name)] == ['%s%d' % (name, i) for i in range(50)]
+
+
+def test_seen_keeps_the_newest(tmp_path, monkeypatch):
+    monkeypatch.setattr(meme, 'SEEN_MAX', 5)
+    state = str(tmp_path / 'state.json')
+    generator = meme.MemeGenerator(FakeReddit(size=8), 'a', limit=4, state_path=state, prefetch=False)
+    assert ids(generator.get_memes(8)) == ['a%d' % i for i in range(8)]
+    assert list(generator.seen) == ['a3', 'a4', 'a5', 'a6', 'a7']
+
+    # the listing starts again from the top, where only the pruned submissions are new
+    restarted = meme.MemeGenerator(FakeReddit(size=8), 'a', limit=4, state_path=state, prefetch=False)
+    assert list(restarted.seen) == ['a3', 'a4', 'a5', 'a6', 'a7']
+    assert ids(restarted.get_memes(3)) == ['a0', 'a1', 'a2']
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip('flask')
+
+import jobs  # noqa: E402
+import meme_swap  # noqa: E402
+import pipeline  # noqa: E402
+
+MEME = 'images/T8rcmAj.jpg'
+SOURCE = 'photos/aaron.jpg'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setitem(meme_swap.app.config, 'TESTING', True)
+    return meme_swap.app.test_client()
+
+
+@pytest.fixture
+def job_queue(monkeypatch, tmp_path):
+    """
+    A fixture-detector pipeline without caches, and a job queue with no worker threads, so the
+    test runs each job itself with run_next().
+    """
+    monkeypatch.setattr(pipeline, 'IMAGE_STORE_DIR', None)
+    swapper = pipeline.Pipeline(detector='fixture', cache_dir=None, dedup_path=str(tmp_path / 'dedup.json'),
+                                scraper_state=None, render_cache_dir=None)
+    queue = jobs.JobQueue(meme_swap.run_swap, workers=0, max_pending=1)
+    monkeypatch.setitem(meme_swap.app.extensions, 'pipeline', swapper)
+    monkeypatch.setitem(meme_swap.app.extensions, 'job_queue', queue)
+    return queue
+
+
+def upload(client):
+    with open(SOURCE, 'rb') as image_file:
+        return client.post('/upload?meme=' + MEME, data=image_file.read(), content_type='image/jpeg')
+
+
+def test_invalid_base64_is_a_bad_request(client):
+    response = client.post('/upload', data={'file': 'data:image/jpeg;base64,abc'})
+    assert response.status_code == 400
+
+
+def test_no_memes_is_unavailable(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(meme_swap.app.config, 'MEME_GLOB', str(tmp_path / '*.jpg'))
+    response = client.post('/upload', data=b'not checked', content_type='image/jpeg')
+    assert response.status_code == 503
+
+
+def test_one_job_queue_for_concurrent_first_requests(monkeypatch):
+    def slow_queue(*args, **kwargs):
+        time.sleep(0.05)
+        return object()
+
+    monkeypatch.setattr(meme_swap.jobs, 'JobQueue', slow_queue)
+    monkeypatch.delitem(meme_swap.app.extensions, 'job_queue', raising=False)
+    queues = []
+    threads = [threading.Thread(target=lambda: queues.append(meme_swap.get_job_queue()))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    meme_swap.app.extensions.pop('job_queue', None)
+
+    assert len(queues) == 8
+    assert all(queue is queues[0] for queue in queues)
+
+
+def test_upload_runs_as_a_job(client, job_queue):
+    response = upload(client)
+    assert response.status_code == 202
+    status_url = response.get_json()['status_url']
+    assert client.get(status_url).get_json()['status'] == jobs.QUEUED
+
+    assert job_queue.run_next(timeout=5) is not None
+    status = client.get(status_url).get_json()
+    assert status['status'] == jobs.DONE, status['error']
+
+    result = client.get(status['result_url'])
+    assert result.status_code == 200
+    assert result.mimetype == 'image/jpeg'
+    image = cv2.imdecode(np.frombuffer(result.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert image.shape == cv2.imread(MEME).shape
+
+
+def test_full_queue_is_too_many_requests(client, job_queue):
+    assert upload(client).status_code == 202
+    assert upload(client).status_code == 429
+    assert job_queue.depth() == 1
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import detectors
+import metrics
+import pipeline
+
+MEME = 'images/T8rcmAj.jpg'
+SOURCE = 'photos/aaron.jpg'
+
+
+@pytest.fixture
+def sink():
+    sink = metrics.add_sink(metrics.MemorySink())
+    yield sink
+    metrics.remove_sink(sink)
+
+
+def names(sink, kind):
+    return set(name for record_kind, name, _, _ in sink.records if record_kind == kind)
+
+
+def test_detect_stage_records_its_timer_and_counters(sink):
+    faces = detectors.get_detector('fixture').find_faces(SOURCE)
+
+    assert names(sink, metrics.HISTOGRAM) == {'detect_seconds'}
+    assert names(sink, metrics.COUNTER) == {'detect_bytes', 'faces_found'}
+    assert len(sink.values('detect_seconds', backend='fixture')) == 1
+    assert sink.total('faces_found', backend='fixture') == len(faces)
+
+
+def test_swap_stage_records_its_timers_and_counters(sink, monkeypatch):
+    monkeypatch.setattr(pipeline, 'IMAGE_STORE_DIR', None)
+    detector = detectors.get_detector('fixture')
+    meme_faces, source_faces = detector.find_faces(MEME), detector.find_faces(SOURCE)
+    sink.clear()
+
+    pipeline.swap_meme(MEME, SOURCE, meme_faces, source_faces, precision='float32', warp='affine')
+
+    assert {'imread_seconds', 'swap_face_seconds'} <= names(sink, metrics.HISTOGRAM)
+    assert len(sink.values('swap_face_seconds', precision='float32', warp='affine')) == len(source_faces)
+    assert sink.total('faces_swapped') == len(source_faces)
+
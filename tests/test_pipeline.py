@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+
+import cv2
+
+import detectors
+import pipeline
+
+MEME = 'images/T8rcmAj.jpg'
+SOURCE = 'photos/aaron.jpg'
+
+
+def sleepy_render(image1, image2, features1, features2, location, **options):
+    # stands in for pipeline.render_meme(); image1 is how many seconds the swap takes
+    time.sleep(float(image1))
+    with open(location, 'w'):
+        pass
+
+
+def make_pipeline(tmp_path):
+    return pipeline.Pipeline(detector='fixture', cache_dir=None, dedup_path=str(tmp_path / 'dedup.json'),
+                             scraper_state=None, render_cache_dir=None)
+
+
+def test_render_memes_stops_a_job_that_times_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'render_meme', sleepy_render)
+    jobs = [('20', None, None, None, str(tmp_path / 'hung.jpg'))]
+
+    start = time.monotonic()
+    results = make_pipeline(tmp_path).render_memes(jobs, workers=1, timeout=1)
+
+    assert time.monotonic() - start < 3
+    assert results[0][1] == "timed out after 1 seconds"
+
+
+def test_render_memes_keeps_the_jobs_around_a_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'render_meme', sleepy_render)
+    delays = ['20', '0', '20', '0', '0']
+    jobs = [(delay, None, None, None, str(tmp_path / ('%d.jpg' % i))) for i, delay in enumerate(delays)]
+
+    start = time.monotonic()
+    results = make_pipeline(tmp_path).render_memes(jobs, workers=2, timeout=1)
+
+    # each hung job costs its own timeout, not the 20 seconds it would run for
+    assert time.monotonic() - start < 6
+    assert [location for location, _ in results] == [job[4] for job in jobs]
+    assert [error is None for _, error in results] == [False, True, False, True, True]
+    assert (tmp_path / '4.jpg').exists()
+
+
+def test_get_n_memes_drops_an_undecodable_download(tmp_path, monkeypatch):
+    folder = tmp_path / 'images'
+    folder.mkdir()
+    broken = folder / 'broken.jpg'
+
+    def download_imgs(urls, session=None):
+        broken.write_bytes(b'<html>not an image</html>')
+        return [str(broken)]
+
+    swapper = make_pipeline(tmp_path)
+    submission = type('Submission', (), {'url': 'http://example.com/broken.jpg'})()
+    monkeypatch.setattr(swapper, 'memes', lambda n: [submission])
+    monkeypatch.setattr(swapper, '_previews', lambda session, memes: [None])
+    monkeypatch.setattr(pipeline.meme, 'img_folder', str(folder))
+    monkeypatch.setattr(pipeline.meme, 'download_imgs', download_imgs)
+
+    assert swapper.get_n_memes(1) == []
+    assert not broken.exists()
+    assert swapper.dedup.seen_url(submission.url) is None
+
+
+def render(swapper, tmp_path, name, target_faces=None):
+    detector = detectors.get_detector('fixture')
+    location = str(tmp_path / name)
+    swapper.create_meme(MEME, SOURCE, target_faces or detector.find_faces(MEME), detector.find_faces(SOURCE),
+                        location)
+    return cv2.imread(location)
+
+
+def test_create_meme_renders_with_the_current_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'IMAGE_STORE_DIR', None)
+    swapper = pipeline.Pipeline(detector='fixture', cache_dir=None, dedup_path=str(tmp_path / 'dedup.json'),
+                                scraper_state=None, render_cache_dir=str(tmp_path / 'renders'))
+    full = render(swapper, tmp_path, 'full.png')
+
+    monkeypatch.setattr(pipeline, 'RENDER_MAX_SIDE', 256)
+    small = render(swapper, tmp_path, 'small.png')
+    assert max(small.shape[:2]) == 256 < max(full.shape[:2])
+
+
+def test_render_cache_key_covers_the_faces(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'IMAGE_STORE_DIR', None)
+    swapper = pipeline.Pipeline(detector='fixture', cache_dir=None, dedup_path=str(tmp_path / 'dedup.json'),
+                                scraper_state=None, render_cache_dir=str(tmp_path / 'renders'))
+    height, width = cv2.imread(MEME).shape[:2]
+    first = render(swapper, tmp_path, 'first.png', [detectors.canonical_face(0, 0, width // 3, height // 3)])
+    moved = render(swapper, tmp_path, 'moved.png',
+                   [detectors.canonical_face(width // 2, height // 2, width * 5 // 6, height * 5 // 6)])
+    assert (first != moved).any()
+
+
+def test_swap_warp_changes_the_render(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'IMAGE_STORE_DIR', None)
+    detector = detectors.get_detector('fixture')
+    faces = (detector.find_faces(MEME), detector.find_faces(SOURCE))
+    swapper = pipeline.Pipeline(detector='fixture', cache_dir=None, dedup_path=str(tmp_path / 'dedup.json'),
+                                scraper_state=None, render_cache_dir=str(tmp_path / 'renders'))
+    affine = render(swapper, tmp_path, 'affine.png')
+
+    monkeypatch.setattr(pipeline, 'SWAP_WARP', 'piecewise')
+    expected = pipeline.swap_meme(MEME, SOURCE, *faces, warp='piecewise')
+    assert (affine != expected).any()
+    assert (render(swapper, tmp_path, 'piecewise.png') == expected).all()
+    # and in render_memes()'s worker processes
+    location = str(tmp_path / 'pooled.png')
+    assert swapper.render_memes([(MEME, SOURCE) + faces + (location,)], workers=1) == [(location, None)]
+    assert (cv2.imread(location) == expected).all()
+
+
+def test_swap_blend_changes_the_render(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'IMAGE_STORE_DIR', None)
+    detector = detectors.get_detector('fixture')
+    faces = (detector.find_faces(MEME), detector.find_faces(SOURCE))
+    swapper = pipeline.Pipeline(detector='fixture', cache_dir=None, dedup_path=str(tmp_path / 'dedup.json'),
+                                scraper_state=None, render_cache_dir=str(tmp_path / 'renders'))
+    alpha = render(swapper, tmp_path, 'alpha.png')
+
+    for blend in ('pyramid', 'seamless'):
+        monkeypatch.setattr(pipeline, 'SWAP_BLEND', blend)
+        expected = pipeline.swap_meme(MEME, SOURCE, *faces, blend=blend)
+        assert (alpha != expected).any(), blend
+        assert (render(swapper, tmp_path, blend + '.png') == expected).all(), blend
+
+
+def test_swap_meme_picks_faces_independently_of_other_threads(monkeypatch):
+    monkeypatch.setattr(pipeline, 'IMAGE_STORE_DIR', None)
+    height, width = cv2.imread(MEME).shape[:2]
+    targets = [detectors.canonical_face(0, 0, width // 3, height // 3),
+               detectors.canonical_face(width // 2, height // 2, width * 5 // 6, height * 5 // 6)]
+    sources = [detectors.canonical_face(100, 100, 300, 300)] * 3
+    expected = pipeline.swap_meme(MEME, SOURCE, targets, sources)
+
+    face_box = pipeline.roi.face_box
+
+    def face_box_with_another_draw(face):
+        # as if another thread's swap drew from the global generator between two picks
+        random.random()
+        return face_box(face)
+
+    monkeypatch.setattr(pipeline.roi, 'face_box', face_box_with_another_draw)
+    assert (pipeline.swap_meme(MEME, SOURCE, targets, sources) == expected).all()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import render_cache
+
+
+def test_eviction_drops_the_memory_copy_too(tmp_path):
+    cache = render_cache.RenderCache(str(tmp_path), max_bytes=10)
+    cache.put('old', b'12345678')
+    cache.put('new', b'12345678')
+
+    assert 'old' not in cache
+    assert cache.get('old') is None
+    assert cache.get('new') == b'12345678'
+
+
+def test_entry_evicted_during_a_disk_read_is_not_remembered(tmp_path, monkeypatch):
+    render_cache.RenderCache(str(tmp_path)).put('key', b'image')
+    # a fresh cache has nothing in memory, so the entry is read from disk
+    cache = render_cache.RenderCache(str(tmp_path))
+
+    def racing_open(path, mode='r'):
+        entry_file = open(path, mode)
+        # another thread evicts the entry after the file is opened
+        with cache._lock:
+            cache._index.drop('key')
+        return entry_file
+
+    monkeypatch.setattr(render_cache, 'open', racing_open, raising=False)
+    assert cache.get('key') == b'image'
+    monkeypatch.undo()
+    assert cache.get('key') is None
+    assert len(cache) == 0
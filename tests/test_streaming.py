@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import streaming
+
+
+def failing_source():
+    yield 1
+    yield 2
+    raise RuntimeError("listing failed")
+
+
+def consume(items, stages):
+    """
+    :return: (outputs, exception) of the stream, read on a thread so a hung stream fails the test
+    """
+    outputs = []
+    errors = []
+
+    def run():
+        try:
+            for result in streaming.run_stream(items, stages, queue_size=1):
+                outputs.append(result)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "the stream hung"
+    return outputs, errors[0] if errors else None
+
+
+def test_stream_runs_every_item_through_the_stages():
+    stages = [streaming.Stage('double', lambda x: 2 * x, workers=2),
+              streaming.Stage('odd', lambda x: x + 1 if x % 4 else None, workers=3)]
+    outputs, error = consume(range(10), stages)
+    assert error is None
+    assert sorted(outputs) == [3, 7, 11, 15, 19]
+
+
+def test_failing_source_ends_the_stream_with_its_error():
+    stages = [streaming.Stage('double', lambda x: 2 * x, workers=2)]
+    outputs, error = consume(failing_source(), stages)
+    assert sorted(outputs) == [2, 4]
+    assert isinstance(error, RuntimeError) and str(error) == "listing failed"
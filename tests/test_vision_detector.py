@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+VisionDetector's batching, against a local stub client that records the RPCs
+it is sent instead of calling the Vision API. Without google-cloud-vision
+installed, the few names vision_detector imports from it are stubbed too.
+"""
+import importlib
+import sys
+import types
+from types import SimpleNamespace
+
+
+def _stub_vision():
+    """
+    Register stand-ins for google.cloud.vision and google.cloud.vision.types,
+    keeping any parent package that is really installed.
+    """
+    parent = None
+    for name in ('google', 'google.cloud', 'google.cloud.vision'):
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            module = sys.modules[name] = types.ModuleType(name)
+            module.__path__ = []
+            if parent is not None:
+                setattr(parent, name.rsplit('.', 1)[1], module)
+        parent = module
+    vision = sys.modules['google.cloud.vision']
+    vision.types = sys.modules['google.cloud.vision.types'] = types.ModuleType('google.cloud.vision.types')
+    vision.types.Image = SimpleNamespace
+    vision.enums = SimpleNamespace(Feature=SimpleNamespace(Type=SimpleNamespace(FACE_DETECTION=1)))
+
+
+try:
+    importlib.import_module('google.cloud.vision')
+except ImportError:
+    _stub_vision()
+
+import annotation_cache  # noqa: E402
+import vision_detector  # noqa: E402
+
+
+class RecordingClient:
+    """
+    Stands in for vision.ImageAnnotatorClient: finds no faces and keeps the size of every
+    batch_annotate_images call.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.single = 0
+
+    def batch_annotate_images(self, requests):
+        self.batches.append(len(requests))
+        ok = SimpleNamespace(error=SimpleNamespace(code=0, message=''), face_annotations=[])
+        return SimpleNamespace(responses=[ok] * len(requests))
+
+    def face_detection(self, image):
+        self.single += 1
+        return SimpleNamespace(error=SimpleNamespace(code=0, message=''), face_annotations=[])
+
+
+def make_images(tmp_path, n, size=100):
+    paths = []
+    for i in range(n):
+        path = tmp_path / ('%d.jpg' % i)
+        path.write_bytes(b'%d' % i * size)
+        paths.append(str(path))
+    return paths
+
+
+def test_batches_by_image_count(tmp_path):
+    client = RecordingClient()
+    detector = vision_detector.VisionDetector(client=client)
+    paths = make_images(tmp_path, 2 * vision_detector.BATCH_MAX_IMAGES + 3)
+
+    results = detector.find_faces_batch(paths)
+
+    assert [path for path, _, _ in results] == paths
+    assert client.batches == [vision_detector.BATCH_MAX_IMAGES, vision_detector.BATCH_MAX_IMAGES, 3]
+    assert client.single == 0
+
+
+def test_batches_by_bytes(tmp_path, monkeypatch):
+    monkeypatch.setattr(vision_detector, 'BATCH_MAX_BYTES', 1000)
+    client = RecordingClient()
+    detector = vision_detector.VisionDetector(client=client)
+
+    detector.find_faces_batch(make_images(tmp_path, 5, size=400))
+
+    assert client.batches == [2, 2, 1]
+
+
+def test_cached_images_are_not_sent(tmp_path, monkeypatch):
+    client = RecordingClient()
+    cache = annotation_cache.AnnotationCache(str(tmp_path / 'cache'))
+    detector = vision_detector.VisionDetector(client=client, cache=cache)
+    paths = make_images(tmp_path, 20)
+    reads = []
+    read_bytes = detector._read_bytes
+    monkeypatch.setattr(detector, '_read_bytes', lambda path: reads.append(path) or read_bytes(path))
+
+    detector.find_faces_batch(paths)
+    assert client.batches == [vision_detector.BATCH_MAX_IMAGES, 4]
+    # every file is read once, for its cache key and its request alike
+    assert reads == paths
+
+    new = tmp_path / 'new.jpg'
+    new.write_bytes(b'new')
+    detector.find_faces_batch(paths + [str(new)])
+    assert client.batches == [vision_detector.BATCH_MAX_IMAGES, 4, 1]
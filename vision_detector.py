@@ -1,7 +1,5 @@
 # run this before running file
 # export GOOGLE_APPLICATION_CREDENTIALS="meme_swap_owner_account_key.json"
-import io
-import os
 
 # Imports the Google Cloud client library
 from google.cloud import vision
@@ -9,11 +7,54 @@ from google.cloud.vision import types
 
 import base64
 
-class VisionDetector:
-    def __init__(self):
+import annotation_cache
+import detectors
+import metrics
+from face_record import Face, from_dicts, to_dicts
+
+# limits for a single batch_annotate_images call
+BATCH_MAX_IMAGES = 16
+BATCH_MAX_BYTES = 8 * 1024 * 1024
+
+class VisionError(Exception):
+    '''
+    An error in a Vision API response. grpc_status_code is the google.rpc.Code of
+    the error, e.g. 8 (RESOURCE_EXHAUSTED) when the quota is used up.
+    '''
+    def __init__(self, message, grpc_status_code):
+        super().__init__(message)
+        self.grpc_status_code = grpc_status_code
+
+class VisionDetector(detectors.FaceDetector):
+    name = 'cloud'
+
+    def __init__(self, client=None, cache=None, max_side=detectors.DETECT_MAX_SIDE):
+        '''
+        Input:
+            client: object with the ImageAnnotatorClient interface; a real
+                    client is created when None (tests pass in a fake)
+            cache: optional annotation_cache.AnnotationCache for find_faces
+            max_side: longest side images are shrunk to before they are
+                      uploaded, None to upload them as they are
+        '''
+        super().__init__(cache, max_side)
         # Instantiates a client
-        self.client = vision.ImageAnnotatorClient()
-    
+        if client is None:
+            client = vision.ImageAnnotatorClient()
+        self.client = client
+
+    def detect(self, content):
+        '''
+        Find the cleaned facial features in raw image bytes
+
+        Input:
+            content: bytes of an encoded image
+        Output:
+            list of face_record.Face, or None if there are no usable faces
+        '''
+        faces = self.annotate(content)
+        return self.clean_face_features(faces) if faces else None
+
     def read_image(self, image):
         '''
         Send an image to Vision API and find facial features
@@ -23,15 +64,27 @@ class VisionDetector:
         Output:
             returns list of FaceAnnotation objects (each being a face in the image)
         '''
-        # The name of the image file to annotate
-        file_name = os.path.join(os.path.dirname(__file__), image)
-        
-        with io.open(file_name, 'rb') as image_file:
-            content = image_file.read()
+        return self.annotate(self._read_bytes(image))
 
+    def annotate(self, content):
+        '''
+        Send raw image bytes to Vision API and find facial features
+
+        Input:
+            content: bytes of an encoded image
+        Output:
+            returns list of FaceAnnotation objects, or None if there are none
+            raises VisionError if the response is an error, so that callers can
+            tell a throttled request from an image without faces
+        '''
         image_obj = types.Image(content=content)
         # Performs landmark detection on the image file (eyes, etc.)
-        response = self.client.face_detection(image_obj)
+        with metrics.span('vision_request'):
+            response = self.client.face_detection(image_obj)
+        error = getattr(response, 'error', None)
+        if error is not None and error.code:
+            metrics.count('vision_errors')
+            raise VisionError(error.message or 'error code %d' % error.code, error.code)
         if response:
             face = response.face_annotations
             if face:
@@ -42,154 +95,190 @@ class VisionDetector:
         else:
             return None
 
-    # def read_images(self, img_paths):
-    #     '''
-    #     Send an image to Vision API and find facial features
-
-    #     Input:
-    #         image: list of tuple of directory/file_name of (local, foreign)
-    #     Output:
-    #         returns list of FaceAnnotation objects
-    #     '''
-    #     requests = []
-    #     for img_path_pair in img_paths:
-    #         # make dictionary matching AnnotateImageRequest JSON type
-    #         # return the FACE_DETECTION type features on that image
-    #         # full list of types here:
-    #         # https://cloud.google.com/vision/docs/reference/rest/v1/Feature#Type
-
-    #         # read unaltered bytes of image into content
-    #         with open(img_path_pair[0], "rb") as imageFile:
-    #             imgString = base64.b64encode(imageFile.read())
-
-    #         print(str(img_path_pair[1]))
-    #         annotate_image_request_dict = {
-    #             'image': {
-    #                 'content': imgString,
-    #                 'source': {
-    #                     'imageUri': img_path_pair[1] # foreign
-    #                 }
-    #             },
-    #             'features': [
-    #                 {
-    #                     'type': 'FACE_DETECTION'
-    #                 }
-    #             ]
-    #         }
-
-    #         print(type(annotate_image_request_dict['image']['source']['imageUr']))
-    #         # add dictionary request to list of requests
-    #         requests.append(annotate_image_request_dict)
-
-    #     batch_response = self.client.batch_annotate_images(requests)
-    #     faces = []
-    #     for response in batch_response.responses:
-    #         # for each image annotation response, get FaceAnnotation object
-    #         print(response)
-    #         if not response.error:
-    #             face = response.face_annotations[0]
-    #             faces.append(face)
-
-    #     return faces
+    def read_images(self, img_paths):
+        '''
+        Send several images to Vision API in as few batch_annotate_images
+        calls as the batch limits allow and find facial features
+
+        Input:
+            img_paths: list of strings of directory/file_name
+        Output:
+            dict of path -> (list of FaceAnnotation objects or None, error string or None,
+                             scale from the uploaded image's coordinates to the file's)
+            A failed image (unreadable file, error in its response, or a failed
+            RPC for its batch) only has its own error set; the rest are kept.
+            Images are shrunk to max_side before they are sent, see detectors.downscale().
+        '''
+        results = {}
+        items = []
+        for path in img_paths:
+            try:
+                items.append((path, self._read_bytes(path)))
+            except OSError as e:
+                results[path] = (None, str(e), 1.0)
+        results.update(self.annotate_contents(items))
+        return results
+
+    def annotate_contents(self, items):
+        '''
+        read_images for images that are already in memory
+
+        Input:
+            items: list of (path, bytes of an encoded image)
+        Output:
+            the same as read_images
+        '''
+        results = {}
+        pending = []
+        scales = {}
+        for path, content in items:
+            content, scales[path] = detectors.downscale(content, self.max_side)
+            metrics.count('detect_bytes', len(content), backend=self.name)
+            pending.append((path, content))
+
+        for batch in self._batches(pending):
+            for path, (faces, error) in self.annotate_batch(batch).items():
+                results[path] = (faces, error, scales[path])
+        return results
+
+    def _batches(self, items):
+        '''
+        Group (path, content) pairs so that no batch has more than
+        BATCH_MAX_IMAGES images or BATCH_MAX_BYTES bytes of content.
+        An image larger than BATCH_MAX_BYTES is sent on its own.
+        '''
+        batch = []
+        size = 0
+        for path, content in items:
+            if batch and (len(batch) >= BATCH_MAX_IMAGES or
+                          size + len(content) > BATCH_MAX_BYTES):
+                yield batch
+                batch = []
+                size = 0
+            batch.append((path, content))
+            size += len(content)
+        if batch:
+            yield batch
+
+    def annotate_batch(self, batch):
+        '''
+        Send one batch_annotate_images request
+
+        Input:
+            batch: list of (path, bytes of an encoded image)
+        Output:
+            dict of path -> (list of FaceAnnotation objects or None, error string or None)
+        '''
+        # make dictionaries matching AnnotateImageRequest JSON type
+        # return the FACE_DETECTION type features on that image
+        # full list of types here:
+        # https://cloud.google.com/vision/docs/reference/rest/v1/Feature#Type
+        requests = [{'image': types.Image(content=content),
+                     'features': [{'type': vision.enums.Feature.Type.FACE_DETECTION}]}
+                    for _, content in batch]
+        metrics.observe('vision_batch_images', len(batch))
+        try:
+            with metrics.span('vision_batch_request'):
+                batch_response = self.client.batch_annotate_images(requests)
+        except Exception as e:  # the whole RPC failed, report it against every image in it
+            metrics.count('vision_errors', len(batch))
+            return {path: (None, str(e)) for path, _ in batch}
+
+        # responses come back in the same order as the requests
+        results = {}
+        for (path, _), response in zip(batch, batch_response.responses):
+            if response.error.code:
+                metrics.count('vision_errors')
+                results[path] = (None, response.error.message or 'error code %d' % response.error.code)
+            else:
+                results[path] = (response.face_annotations or None, None)
+        for path, _ in batch[len(batch_response.responses):]:
+            results[path] = (None, 'missing from batch response')
+        return results
+
+    def find_faces_batch(self, img_paths):
+        '''
+        Batched version of find_faces; only images missing from the cache are sent
+
+        Input:
+            img_paths: list of strings of directory/file_name
+        Output:
+            list of (path, list of face_record.Face or None, error string or None),
+            in the same order as img_paths
+        '''
+        found = {}
+        misses = []
+        keys = {}
+        for path in img_paths:
+            # each file is read once, the same bytes are hashed and sent
+            try:
+                content = self._read_bytes(path)
+            except OSError as e:
+                found[path] = (None, str(e))
+                continue
+            if self.cache is not None:
+                keys[path] = self.cache_key(content)
+                cleaned = self.cache.get(keys[path])
+                if cleaned is not annotation_cache.MISS:
+                    metrics.count('cache_hits', backend=self.name)
+                    found[path] = (from_dicts(cleaned), None)
+                    continue
+            misses.append((path, content))
+        if self.cache is not None:
+            metrics.count('cache_misses', len(misses), backend=self.name)
+
+        for path, (faces, error, scale) in self.annotate_contents(misses).items():
+            cleaned = self.clean_face_features(faces, scale) if faces else None
+            metrics.count('faces_found', len(cleaned) if cleaned else 0, backend=self.name)
+            if error is None and self.cache is not None:
+                self.cache.put(keys[path], to_dicts(cleaned))
+            found[path] = (cleaned, error)
+
+        return [(path,) + found[path] for path in img_paths]
         
-    def clean_face_features(self, faces):
+    def clean_face_features(self, faces, scale=1.0):
         '''
         Given a set of facial features, return relevant data points
 
         Input:
             faces: list of JSONs of facial features (list of faces)
+            scale: factor every point is multiplied by, to bring faces found
+                   in a shrunk image back to the original's coordinates
         Output:
-            A list of dictionaries of:
+            A list of face_record.Face, one for each face, holding:
+                outer: vertices of the bounding poly of the entire face
+                inner: vertices of the bounding poly of only the skin part
+                landmarks: (x,y) of every landmark, indexed by its type
+            Face.to_dict() gives the older dictionary format:
                 outer_bound_dict: dict(corner, (x,y)),
                 inner_bound_dict: dict(corner, (x,y)),
                 facial_features:           dict(feature_name, (x,y))
-
-            One entry for each face
         NOTE: roll_angle is angle theta relative to vertical y-axis clockwise
         '''
         cleaned_faces = []
         for face in faces:
-            corners = ['LOWER_LEFT', 'LOWER_RIGHT', 'UPPER_RIGHT', 'UPPER_LEFT']
-        
             # outer square
-            # print("Original face dictionarry:\n%s\n\n" %face)
             try:
-                outer_bound = face.bounding_poly     # entire face
-                outer_bound_dict = {}
-                for corner, vertex in zip(corners, outer_bound.vertices):
-                    outer_bound_dict[corner] = (vertex.x, vertex.y)
+                outer = [(vertex.x, vertex.y) for vertex in face.bounding_poly.vertices]  # entire face
             except AttributeError:
-                outer_bound_dict = None
-            
+                outer = None
+
             # inner square
             try:
-                inner_bound = face.fd_bounding_poly  # only skin part
-                inner_bound_dict = {}
-                for corner, vertex in zip(corners, inner_bound.vertices):
-                    inner_bound_dict[corner] = (vertex.x, vertex.y)
+                inner = [(vertex.x, vertex.y) for vertex in face.fd_bounding_poly.vertices]  # only skin part
             except AttributeError:
-                inner_bound_dict = None
+                inner = None
 
-            if outer_bound_dict == None and inner_bound_dict == None:
+            if outer == None and inner == None:
                 return None
-        
-            # map int (constant type) to readable string
-            type_int_to_string_dict = {
-                0: 'UNKNOWN_LANDMARK',
-                1: 'LEFT_EYE',
-                2: 'RIGHT_EYE',
-                3: 'LEFT_OF_LEFT_EYEBROW',
-                4: 'RIGHT_OF_LEFT_EYEBROW',
-                5: 'LEFT_OF_RIGHT_EYEBROW',
-                6: 'RIGHT_OF_RIGHT_EYEBROW',
-                7: 'MIDPOINT_BETWEEN_EYES',
-                8: 'NOSE_TIP',
-                9: 'UPPER_LIP',
-                10: 'LOWER_LIP',
-                11: 'MOUTH_LEFT',
-                12: 'MOUTH_RIGHT',
-                13: 'MOUTH_CENTER',
-                14: 'NOSE_BOTTOM_RIGHT',
-                15: 'NOSE_BOTTOM_LEFT',
-                16: 'NOSE_BOTTOM_CENTER',
-                17: 'LEFT_EYE_TOP_BOUNDARY',
-                18: 'LEFT_EYE_RIGHT_CORNER',
-                19: 'LEFT_EYE_BOTTOM_BOUNDARY',
-                20: 'LEFT_EYE_LEFT_CORNER',
-                21: 'RIGHT_EYE_TOP_BOUNDARY',
-                22: 'RIGHT_EYE_RIGHT_CORNER',
-                23: 'RIGHT_EYE_BOTTOM_BOUNDARY',
-                24: 'RIGHT_EYE_LEFT_CORNER',
-                25: 'LEFT_EYEBROW_UPPER_MIDPOINT',
-                26: 'RIGHT_EYEBROW_UPPER_MIDPOINT',
-                27: 'LEFT_EAR_TRAGION',
-                28: 'RIGHT_EAR_TRAGION',
-                29: 'LEFT_EYE_PUPIL',
-                30: 'RIGHT_EYE_PUPIL',
-                31: 'FOREHEAD_GLABELLA',
-                32: 'CHIN_GNATHION',
-                33: 'CHIN_LEFT_GONION',
-                34: 'CHIN_RIGHT_GONION'
-            }
-            
-            # map (x,y) to feature type in dictionary
-            landmarks_dict = {}
-            for landmark in face.landmarks:
-                # convert 'type' (int) to a string name
-                feature_type_int = landmark.type
-                landmark_key = type_int_to_string_dict[feature_type_int]
-            
-                # match (x,y) tuple and insert
-                position = (landmark.position.x, landmark.position.y)
-                landmarks_dict[landmark_key] = position
-
-            out = {'outer_bound_dict': outer_bound_dict,
-                   'inner_bound_dict': inner_bound_dict,
-                   'facial_features_dict': landmarks_dict}
-
-            cleaned_faces.append(out)
-
-        return cleaned_faces
+
+            # map (x,y) to the landmark's type (int)
+            points = {landmark.type: (landmark.position.x, landmark.position.y)
+                      for landmark in face.landmarks}
+
+            cleaned_faces.append(Face.from_points(points, outer, inner))
+
+        return detectors.rescale_faces(cleaned_faces, scale)
 
 """vision = VisionDetector()
 single_image_annotated = vision.read_image('images/multface.jpg')